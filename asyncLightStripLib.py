@@ -0,0 +1,578 @@
+"""
+asyncio engine for elgato light strips.
+
+One event loop drives every light in the room, so a transition does not need
+a thread per light just to sleep through the scene.
+
+The payload building (scenes, colors, transitions) is shared with
+lightStripLib.LightStrip, only the I/O is replaced with coroutines.
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import threading
+from time import monotonic
+
+import metrics
+import tracing
+from resilience import RequestPolicy, CircuitOpenError, check_deadline
+from lightStripLib import LightStrip, LightStripState, Scene, CompiledTransition, compile_transition
+
+HTTP_OK = 200
+
+
+class AsyncResponse:
+    """Minimal response object, mirrors the parts of requests.Response we use."""
+
+    def __init__(self, status_code: int, content: bytes):
+        """Init the response."""
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        """Return the body as a string."""
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        """Return the body parsed as json."""
+        return json.loads(self.content)
+
+
+class AsyncLightSession:
+    """
+    Keep-alive HTTP/1.1 client for lights built on asyncio streams.
+
+    The Elgato API is plain JSON over HTTP, so a tiny client is enough and
+    avoids pulling in another dependency.
+    Each light gets one connection that is reused for every request and
+    reopened when the light drops it.
+    Requests follow the same RequestPolicy as LightSession.
+    """
+
+    def __init__(self, recorder=None, policy: RequestPolicy = None):
+        """
+        Init the session.
+
+            recorder: recorder.TrafficRecorder that logs every request
+            policy: resilience.RequestPolicy, pass the sync session's to
+            share its circuit breakers
+        """
+        self.log = logging.getLogger(__name__)
+        self.recorder = recorder
+        self.policy = policy if policy is not None else RequestPolicy()
+        self.connections = dict()
+        self.locks = dict()
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+        self.retries = 0
+
+    async def request(self, method: str, addr: str, port: int, path: str,
+                      data: str = None) -> AsyncResponse:
+        """
+        Send a request to a light and wait for the response.
+
+        Requests to the same light are serialized over its connection,
+        requests to different lights run concurrently.
+        Raises resilience.DeadlineExceeded or CircuitOpenError without
+        sending anything, like LightSession.request.
+        """
+        with tracing.span('http', method=method,
+                          url=f"http://{addr}:{port}{path}") as span:
+            check_deadline()
+            if not self.policy.breaker(f"{addr}:{port}").allow():
+                raise CircuitOpenError(f"{addr}:{port} keeps failing, not sending")
+            start = monotonic()
+            try:
+                response = await self._retry(method, addr, port, path, data)
+            except Exception as e:
+                self.observe(method, f"{addr}:{port}", path, data, start, error=e)
+                raise
+            span.set(status=response.status_code,
+                     response_bytes=len(response.content))
+            self.observe(method, f"{addr}:{port}", path, data, start,
+                         response.status_code, response.content)
+            return response
+
+    def observe(self, method: str, light: str, path: str, body, start: float,
+                status: int = None, content: bytes = None, error=None):
+        """Feed a finished request to the metrics, the breaker and the recorder, if any."""
+        metrics.observe_request(light, method, monotonic() - start, status, error)
+        self.policy.record(light, status, error)
+        if self.recorder is not None:
+            self.recorder.record(method, light, path, body, start, status, content, error)
+
+    async def _retry(self, method: str, addr: str, port: int, path: str,
+                     data: str = None) -> AsyncResponse:
+        """
+        Send a request with the policy's timeout and retries.
+
+        Like LightSession._send, connection errors and 5xx answers are
+        retried after a jittered backoff and timeouts are not.
+        """
+        attempt = 0
+        while True:
+            timeout = sum(self.policy.timeout())
+            try:
+                response = await asyncio.wait_for(
+                    self._request(method, addr, port, path, data), timeout)
+                if response.status_code < 500:
+                    return response
+                failure = response
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                failure = e
+            attempt += 1
+            delay = self.policy.retry_delay(attempt)
+            if delay is None:
+                if isinstance(failure, Exception):
+                    raise failure
+                return failure
+            self.retries += 1
+            self.log.debug(f"Request to {addr}:{port} failed, retrying in {delay:.3f}s: "
+                           f"{getattr(failure, 'status_code', failure)}")
+            await asyncio.sleep(delay)
+
+    async def _request(self, method: str, addr: str, port: int, path: str,
+                       data: str = None) -> AsyncResponse:
+        """Send a request over the light's connection, see request."""
+        key = (addr, port)
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        async with self.locks[key]:
+            reused = key in self.connections
+            try:
+                return await self._send(key, method, path, data)
+            except asyncio.CancelledError:
+                # timed out half way through, the connection is unusable
+                self._drop(key)
+                raise
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self._drop(key)
+                if not reused:
+                    raise
+                # the light closed the pooled connection, try a fresh one
+                self.reconnects += 1
+                self.log.debug(f"Stale connection to {addr}:{port}, reconnecting: {e}")
+                return await self._send(key, method, path, data)
+
+    async def get(self, addr: str, port: int, path: str) -> AsyncResponse:
+        """Send a get request."""
+        return await self.request('GET', addr, port, path)
+
+    async def put(self, addr: str, port: int, path: str,
+                  data: str) -> AsyncResponse:
+        """Send a put request."""
+        return await self.request('PUT', addr, port, path, data)
+
+    async def _send(self, key, method, path, data) -> AsyncResponse:
+        """Write one request on the light's connection and read the response."""
+        if key in self.connections:
+            self.hits += 1
+            reader, writer = self.connections[key]
+        else:
+            self.misses += 1
+            reader, writer = await asyncio.open_connection(*key)
+            self.connections[key] = (reader, writer)
+
+        body = data.encode('utf-8') if data else b''
+        head = (f"{method} {path} HTTP/1.1\r\n"
+                f"Host: {key[0]}:{key[1]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: keep-alive\r\n\r\n")
+        writer.write(head.encode('ascii') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by light")
+        status_code = int(status_line.split()[1])
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header, _, value = line.decode('latin-1').partition(':')
+            headers[header.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self._read_chunked(reader)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            # no framing, the body ends when the light closes the socket
+            content = await reader.read()
+            keep_alive = False
+        if not keep_alive:
+            self._drop(key)
+        return AsyncResponse(status_code, content)
+
+    async def _read_chunked(self, reader) -> bytes:
+        """Read a chunked transfer-encoded body."""
+        content = b''
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # skip the trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return content
+            content += await reader.readexactly(size)
+            await reader.readline()
+
+    def _drop(self, key):
+        """Forget a connection and close its socket."""
+        if key in self.connections:
+            _, writer = self.connections.pop(key)
+            writer.close()
+
+    def stats(self) -> dict:
+        """Return the same pool counters as LightSession.stats."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'reconnects': self.reconnects,
+            'retries': self.retries}
+
+    async def close(self):
+        """Close every connection."""
+        for key in list(self.connections):
+            _, writer = self.connections[key]
+            self._drop(key)
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+
+class AsyncLightStrip(LightStripState):
+    """
+    asyncio version of LightStrip.
+
+    Use `await AsyncLightStrip.create(...)` to build a light, the constructor
+    does not talk to the light.
+    Every method that talks to the light is a coroutine, the state and
+    payload building come from lightStripLib.LightStripState.
+    """
+
+    def __init__(self, addr, port, name="", session=None,
+                 max_state_age: float = 60.0):
+        """Initialize the light without any I/O."""
+        # LightStrip.__init__ is skipped on purpose because it blocks on I/O
+        self.log = logging.getLogger(__name__)
+        self.addr = addr
+        self.port = port
+        self.name = name
+        self.full_addr = self.addr + ':' + str(self.port)
+        self.session = session if session is not None else AsyncLightSession()
+        self.data = {}
+        self.info = {}
+        self.settings = {}
+        self.is_scene = False
+        self.acknowledged = None
+        self.suppressed_writes = 0
+        self.partial_writes = 0
+        self.state_time = None
+        self.max_state_age = max_state_age
+        self.lock = threading.RLock()
+        self.available = True
+
+    @classmethod
+    async def create(cls, addr, port, name="", session=None):
+        """Create a light and fetch its data/info/settings concurrently."""
+        light = cls(addr, port, name, session)
+        await asyncio.gather(
+            light.get_strip_data(),
+            light.get_strip_info(),
+            light.get_strip_settings())
+        light.check_scene()
+        return light
+
+    @classmethod
+    def from_light(cls, light: LightStrip, session=None):
+        """Wrap an already initialized LightStrip without any I/O."""
+        async_light = cls(light.addr, light.port, light.name, session,
+                          light.max_state_age)
+        # copy what the light already loaded, without triggering lazy loads
+        async_light.data = light._data if light._data is not None else {}
+        async_light.info = light.info
+        async_light.settings = light._settings if light._settings is not None else {}
+        async_light.is_scene = bool(light._is_scene)
+        async_light.acknowledged = light.acknowledged
+        async_light.state_time = light.state_time
+        async_light.suppressed_writes = light.suppressed_writes
+        async_light.partial_writes = light.partial_writes
+        if hasattr(light, 'scene'):
+            async_light.scene = light.scene
+        return async_light
+
+    async def get_strip_data(self):
+        """Send a get request for the light data."""
+        r = await self.session.get(self.addr, self.port, '/elgato/lights')
+        self.data = r.json()
+        self.acknowledged = copy.deepcopy(self.data)
+        self.state_time = monotonic()
+        return self.data
+
+    async def get_strip_info(self):
+        """Send a get request for the accessory info."""
+        r = await self.session.get(self.addr, self.port, '/elgato/accessory-info')
+        self.info = r.json()
+        return self.info
+
+    async def get_strip_settings(self):
+        """Get the strip's settings."""
+        r = await self.session.get(self.addr, self.port, '/elgato/lights/settings')
+        self.settings = r.json()
+        return self.settings
+
+    async def get_strip_color(self, max_age: float = None):
+        """
+        Return the color of the light.
+
+            If the light is not set to a specific color
+            (i.e. when it is in a scene) then the tuple is empty
+
+            The cached state is used when it is newer than `max_age` seconds
+        """
+        if (cached := self.cached_color(max_age)) is not None:
+            return cached
+        try:
+            light_color = (await self.get_strip_data())['lights'][0]
+            return (
+                light_color['on'],
+                light_color['hue'],
+                light_color['saturation'],
+                light_color['brightness'])
+        except (KeyError, IndexError, TypeError):
+            return ()  # the light strip is not set to a static color
+        except Exception as e:
+            self.log.debug(f"Failed to read the color of {self.full_addr}: {e}")
+            return ()
+
+    async def set_strip_data(self, new_data: json) -> bool:
+        """
+        Send a put request to update the light data.
+
+        Skips or trims the write like LightStrip.set_strip_data.
+        Returns True if successful
+        """
+        payload = self.make_payload(new_data)
+        if payload is None:
+            return True
+        try:
+            r = await self.session.put(
+                self.addr, self.port, '/elgato/lights', json.dumps(payload))
+            if r.status_code == HTTP_OK:
+                self.acknowledge(new_data, r.json())
+                return True
+            self.log.debug(r.text)
+        except Exception as e:
+            self.log.debug(f"Failed to update {self.full_addr}: {e}")
+        return False
+
+    async def send_compiled(self, data: dict, body: str, is_scene: bool) -> bool:
+        """Send compiled `data`, see LightStrip.send_compiled."""
+        body = self.stage_compiled(data, body)
+        if body is not None:
+            try:
+                r = await self.session.put(
+                    self.addr, self.port, '/elgato/lights', body)
+                if r.status_code != HTTP_OK:
+                    self.log.debug(r.text)
+                    return False
+                self.acknowledge(data, r.json())
+            except Exception as e:
+                self.log.debug(f"Failed to update {self.full_addr}: {e}")
+                return False
+        self.is_scene = is_scene
+        return True
+
+    async def set_strip_settings(self, new_data: json) -> bool:
+        """
+        Send a put request to update the light settings.
+
+        Returns True on success
+        """
+        try:
+            r = await self.session.put(
+                self.addr, self.port, '/elgato/lights/settings',
+                json.dumps(new_data))
+            self.log.debug(r.text)
+            if r.status_code == HTTP_OK:
+                self.settings = new_data
+                return True
+        except Exception as e:
+            self.log.debug(f"Failed to update settings of {self.full_addr}: {e}")
+        return False
+
+    async def set_strip_info(self, new_data: json) -> bool:
+        """Set the strip info."""
+        try:
+            r = await self.session.put(
+                self.addr, self.port, '/elgato/accessory-info',
+                json.dumps(new_data))
+            if r.status_code == HTTP_OK:
+                self.info = new_data
+                return True
+            self.log.debug(r.text)
+        except Exception as e:
+            self.log.debug(f"Failed to update info of {self.full_addr}: {e}")
+        return False
+
+    async def update_color(self, on, hue, saturation, brightness) -> bool:
+        """Change the color of the light."""
+        self.make_color(on, hue, saturation, brightness)
+        return await self.set_strip_data(self.data)
+
+    async def update_scene(self, scene: Scene,
+                           scene_name="transition-scene",
+                           scene_id="") -> bool:
+        """Set the light to a scene."""
+        self.update_scene_data(
+            Scene(scene.data), scene_name=scene_name, scene_id=scene_id)
+        return await self.set_strip_data(self.data)
+
+    async def transition_start(self,
+                               colors: list,
+                               name='transition-scene',
+                               scene_id='transition-scene-id') -> float:
+        """Start a transition scene, returns how long to wait."""
+        wait_time = self.make_transition(
+            colors, await self.get_strip_color(), name, scene_id)
+        await self.set_strip_data(self.data)
+        return wait_time
+
+    async def transition_end(self,
+                             end_scene: list,
+                             end_scene_name='end-scene',
+                             end_scene_id='end-scene-id') -> bool:
+        """End the transition scene and replace it with the end scene."""
+        self.make_end_scene(end_scene, end_scene_name, end_scene_id)
+        return await self.set_strip_data(self.data)
+
+    async def start_compiled(self, transition: CompiledTransition) -> float:
+        """Start a compiled transition, returns how long to wait."""
+        with tracing.span('light.start', light=self.name):
+            data, body, wait_time = transition.start(await self.get_strip_color())
+            await self.send_compiled(data, body, True)
+            return wait_time
+
+    async def end_compiled(self, transition: CompiledTransition) -> bool:
+        """End a compiled transition."""
+        with tracing.span('light.end', light=self.name):
+            return await self.send_compiled(
+                transition.end_data, transition.end_body, transition.end_is_scene)
+
+    async def transition_compiled(self, transition: CompiledTransition) -> bool:
+        """Run a whole compiled transition: start, wait, end."""
+        with self.session.policy.deadline():
+            sleep_time = await self.start_compiled(transition)
+        self.log.info(f"Sleep time: {sleep_time}")
+        with tracing.span('light.wait', light=self.name, seconds=sleep_time):
+            await asyncio.sleep(sleep_time)
+        with self.session.policy.deadline():
+            return await self.end_compiled(transition)
+
+    async def transition(self,
+                         colors: list,
+                         name='transition-scene',
+                         scene_id='transition-scene-id',
+                         end_scene: list = [],
+                         end_scene_name="end-scene",
+                         end_scene_id="end-scene-id") -> bool:
+        """Run a whole transition: start, wait, end."""
+        sleep_time = await self.transition_start(colors, name, scene_id)
+        self.log.info(f"Sleep time: {sleep_time}")
+        await asyncio.sleep(sleep_time)
+        return await self.transition_end(end_scene, end_scene_name, end_scene_id)
+
+
+class AsyncRoom:
+    """Collection of AsyncLightStrips driven by a single event loop."""
+
+    def __init__(self, lights: list = None, session=None):
+        """Init the room."""
+        self.lights: list[AsyncLightStrip] = lights if lights else []
+        self.session = session if session is not None else AsyncLightSession()
+        self.log = logging.getLogger(__name__)
+
+    @classmethod
+    def from_room(cls, room, lights: list = None, session=None):
+        """
+        Build an AsyncRoom from the lights of a lightStripLib.Room.
+
+            lights: the room's lights to use, its available lights by default
+            session: AsyncLightSession to keep connections in across rooms,
+            a new one sharing the room's recorder and policy if not given
+        """
+        if lights is None:
+            lights = room.available_lights()
+        if session is None:
+            session = AsyncLightSession(room.session.recorder, room.session.policy)
+        async_room = cls(session=session)
+        async_room.lights = [
+            AsyncLightStrip.from_light(light, async_room.session)
+            for light in lights]
+        return async_room
+
+    async def add_light(self, addr, port, name="") -> bool:
+        """Add a light to the room if it is a light strip."""
+        try:
+            light = await AsyncLightStrip.create(addr, port, name, self.session)
+            if 'Strip' in light.info['productName']:
+                self.lights.append(light)
+                self.log.info(f"Found new light strip: {light.info['displayName']}")
+                return True
+        except Exception as e:
+            self.log.debug(f"Failed to connect to light... skipping\n{e}")
+        return False
+
+    async def room_color(self, on, hue, saturation, brightness) -> bool:
+        """Set color for the whole room."""
+        with self.session.policy.deadline():
+            results = await asyncio.gather(*(
+                light.update_color(on, hue, saturation, brightness)
+                for light in self.lights))
+        return all(results)
+
+    async def room_scene(self, scene: Scene) -> bool:
+        """Set all lights in the room to a specific scene."""
+        with self.session.policy.deadline():
+            results = await asyncio.gather(*(
+                light.update_scene(scene) for light in self.lights))
+        return all(results)
+
+    async def room_transition(self,
+                              colors: list,
+                              name='transition-scene',
+                              scene_id='transition-scene-id',
+                              end_scene: list = [],
+                              end_scene_name="end-scene",
+                              end_scene_id="end-scene-id") -> tuple[str]:
+        """
+        Transition every light in the room concurrently.
+
+        `colors` can be a CompiledTransition, the payloads are compiled
+        once for the whole room either way.
+        Returns tuple of successful names
+        """
+        if not colors:
+            self.log.warning("Cannot transition an empty scene")
+            return False
+        transition = compile_transition(
+            colors, end_scene, name, scene_id, end_scene_name, end_scene_id)
+        results = await asyncio.gather(
+            *(light.transition_compiled(transition) for light in self.lights),
+            return_exceptions=True)
+        return tuple(
+            light.name for light, result in zip(self.lights, results)
+            if result is True)
+
+    async def close(self):
+        """Close the room's connections."""
+        await self.session.close()
@@ -0,0 +1,5 @@
+"""
+Benchmarks for the light controller.
+
+Run from the project directory, e.g. `python3 -m benchmarks.bench_room_transition`
+"""
@@ -0,0 +1,155 @@
+"""
+Compare the string built masks in timer.py with the bit arithmetic ones.
+
+The old functions are kept here as the reference implementation,
+the benchmark also checks both produce the same masks.
+
+    python3 -m benchmarks.bench_masks [REPEAT]
+"""
+import sys
+from timeit import timeit
+
+import timer
+from timer import MONTH_LENGTH, DAYS_OF_THE_WEEK
+
+
+def string_month_mask(active_month: str, leap: bool = False) -> int:
+    """generate_month_mask before the rewrite."""
+    month_order = ("january", "feburary", "march", "april", "may", "june",
+                   "july", "august", "september", "october", "november",
+                   "december")
+    if leap:
+        month_order = ("january", "feburary-leap", "march", "april", "may",
+                       "june", "july", "august", "september", "october",
+                       "november", "december")
+    assert active_month in MONTH_LENGTH, f"Invalid Month: {active_month}"
+    # "feburary" and "feburary-leap" are the same month
+    active_month = active_month.split('-')[0]
+    mask = ''
+    for month in month_order:
+        # see if there is a string method that fills these in more efficiently
+        if month.split('-')[0] == active_month:
+            # add the month filled in with 1s
+            mask += "".join("1" for _ in range(MONTH_LENGTH[month]))
+        else:
+            # add the month filled in with 0s
+            mask += "".join("0" for _ in range(MONTH_LENGTH[month]))
+    # return the int that represents the mask
+    return int(mask, 2)
+
+
+def string_weekday_mask(active_day: str,
+                        days_of_the_week: tuple = (
+                              "monday", "tuesday", "wednesday", "thursday",
+                                "friday", "saturday", "sunday"),
+                        year_length: int = 365,
+                        start_day: str = "monday"
+                        ) -> int:
+    """generate_weekday_mask before the rewrite."""
+    assert active_day in days_of_the_week, f"Invalid Day: {active_day}"
+    mask = ''
+    days = 0
+    shift = False
+    # Account for years that do not start on the first day of the week
+    # by inserting a partial week to the beginning of
+    for day in days_of_the_week:
+        if day == start_day:
+            shift = True
+        if shift:
+            mask += '1' if day in active_day else '0'
+            days += 1
+
+    while days < year_length:
+        for day in days_of_the_week:
+            mask += '1' if day in active_day else '0'
+            days += 1
+            if days >= year_length:
+                break
+
+    assert len(mask) == year_length, f"Invalid mask length, len: {len(mask)}"
+    return int(mask, 2)
+
+
+def string_date_mask(date: int, leap: bool = False) -> int:
+    """generate_date_mask before the rewrite."""
+    month_order = ("january", "feburary", "march", "april", "may", "june",
+                   "july", "august", "september", "october", "november",
+                   "december")
+    if leap:
+        month_order = ("january", "feburary-leap", "march", "april", "may",
+                       "june", "july", "august", "september", "october",
+                       "november", "december")
+    assert 0 < date and date < 32, f"Invalid date: {date}"
+    mask = ''
+    # adjust date for zero-indexed months
+    date -= 1
+    for month in month_order:
+        # see if there is a string method that fills these in more efficiently
+        mask += "".join(
+            "1" if d == date else "0" for d in range(MONTH_LENGTH[month]))
+
+    # return the int that represents the mask
+    return int(mask, 2)
+
+
+def year_cases():
+    """Return (symbol kind, symbol, leap, year length, start day) for every case."""
+    cases = []
+    for leap, year_length in ((False, 365), (True, 366)):
+        for month in MONTH_LENGTH:
+            cases.append(('month', month, leap, year_length, 'monday'))
+        for date in range(1, 32):
+            cases.append(('date', date, leap, year_length, 'monday'))
+        for start_day in DAYS_OF_THE_WEEK:
+            for day in DAYS_OF_THE_WEEK:
+                cases.append(('weekday', day, leap, year_length, start_day))
+    return cases
+
+
+def old_mask(kind, symbol, leap, year_length, start_day):
+    """Build a mask with the string implementation."""
+    if kind == 'month':
+        return string_month_mask(symbol, leap=leap)
+    if kind == 'date':
+        return string_date_mask(symbol, leap=leap)
+    return string_weekday_mask(symbol, year_length=year_length,
+                               start_day=start_day)
+
+
+def new_mask(kind, symbol, leap, year_length, start_day):
+    """Build a mask with timer.py."""
+    if kind == 'month':
+        return timer.generate_month_mask(symbol, leap=leap)
+    if kind == 'date':
+        return timer.generate_date_mask(symbol, leap=leap)
+    return timer.generate_weekday_mask(symbol, year_length=year_length,
+                                       start_day=start_day)
+
+
+def uncached_mask(kind, symbol, leap, year_length, start_day):
+    """Build a mask with timer.py, skipping the cache."""
+    if kind == 'month':
+        return timer.generate_month_mask.__wrapped__(symbol, leap=leap)
+    if kind == 'date':
+        return timer.generate_date_mask.__wrapped__(symbol, leap=leap)
+    return timer.generate_weekday_mask.__wrapped__(
+        symbol, year_length=year_length, start_day=start_day)
+
+
+def main():
+    """Run the benchmark."""
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    cases = year_cases()
+    for case in cases:
+        assert old_mask(*case) == new_mask(*case), f"masks differ: {case}"
+    print(f"{len(cases)} masks match")
+    for name, build in (("string", old_mask),
+                        ("bit arithmetic", uncached_mask),
+                        ("cached", new_mask)):
+        seconds = timeit(lambda: [build(*case) for case in cases],
+                         number=repeat)
+        print(f"{name:<16} {1e6 * seconds / (repeat * len(cases)):8.2f} us/mask")
+
+
+if __name__ == "__main__":
+    main()
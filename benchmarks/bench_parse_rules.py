@@ -0,0 +1,55 @@
+"""
+Time parse_rules.parser over long generated rule expressions.
+
+The time per token should stay flat as the expressions get longer.
+
+    python3 -m benchmarks.bench_parse_rules [MAX_TOKENS]
+"""
+import random
+import sys
+from time import perf_counter
+
+from parse_rules import parser
+
+SYMBOLS = ("monday", "tuesday", "friday", "sunday", "january", "march",
+           "december", "d1", "d5", "d15", "d28")
+
+
+def generate_term(rng, depth=0) -> list:
+    """Return the tokens of a concatenation of one to three factors."""
+    tokens = []
+    for _ in range(rng.randint(1, 3)):
+        if depth < 3 and rng.random() < 0.3:
+            tokens += ['('] + generate_term(rng, depth + 1) + ['|'] \
+                + generate_term(rng, depth + 1) + [')']
+        else:
+            tokens.append(rng.choice(SYMBOLS))
+    return tokens
+
+
+def generate_expression(num_tokens: int, seed: int = 0) -> list:
+    """Return a valid expression of at least `num_tokens` tokens."""
+    rng = random.Random(seed)
+    tokens = generate_term(rng)
+    while len(tokens) < num_tokens:
+        tokens += ['|'] + generate_term(rng)
+    return tokens
+
+
+def main():
+    """Run the benchmark."""
+    max_tokens = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+    num_tokens = 125
+    print(f"{'tokens':>8} {'seconds':>10} {'us/token':>10}")
+    while num_tokens <= max_tokens:
+        expression = generate_expression(num_tokens)
+        start = perf_counter()
+        parser(expression)
+        elapsed = perf_counter() - start
+        print(f"{len(expression):>8} {elapsed:>10.4f} "
+              f"{1e6 * elapsed / len(expression):>10.2f}")
+        num_tokens *= 2
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+End-to-end Room benchmarks against the local light simulator.
+
+The simulator runs in its own process so the CPU time reported is only
+what the controller side spends. For every room size this measures:
+
+    setup       admitting every light from its discovery record
+    room_color  one color sent to every light
+    threaded    room_transition_threaded
+    heap        room_transition (deadline heap, one thread)
+
+Transitions use very short scenes, so their wall time is mostly I/O.
+
+    python3 -m benchmarks.bench_room_io [SIZES] [LATENCY_MS] [JITTER_MS] [FAIL_RATE]
+
+SIZES is a comma separated list of room sizes (default 1,10,50,100,250,500)
+"""
+import json
+import os
+import subprocess
+import sys
+from time import monotonic, process_time
+
+from lightStripLib import Room
+from simulator import Simulator
+
+COLORS = [(10.0, 100.0, 50.0, 20, 20), (200.0, 100.0, 50.0, 20, 20)]
+END_SCENE = [(30.0, 50.0, 40.0, 0, 0)]
+
+
+def start_simulator(num_lights, latency_ms, jitter_ms, failure_rate):
+    """Start the simulator in a subprocess, returns (process, ports)."""
+    simulator = subprocess.Popen(
+        [sys.executable, "simulator.py", "-n", str(num_lights),
+         "-l", str(latency_ms), "-j", str(jitter_ms), "-f", str(failure_rate)],
+        stdout=subprocess.PIPE, text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    ports = json.loads(simulator.stdout.readline())
+    return simulator, ports
+
+
+def measure(name, num_lights, function):
+    """Print wall time, throughput and cpu of a single call."""
+    wall_start = monotonic()
+    cpu_start = process_time()
+    result = function()
+    cpu = process_time() - cpu_start
+    wall = monotonic() - wall_start
+    print(f"{num_lights:5d} {name:<11} wall: {wall * 1000:9.1f}ms  "
+          f"lights/s: {num_lights / wall:8.1f}  cpu: {cpu * 1000:8.1f}ms  "
+          f"cpu/wall: {100 * cpu / wall:5.1f}%")
+    return result
+
+
+def bench_size(num_lights, latency_ms, jitter_ms, failure_rate):
+    """Run every benchmark against a room of `num_lights`."""
+    simulator, ports = start_simulator(
+        num_lights, latency_ms, jitter_ms, failure_rate)
+    try:
+        # the discovery records, without waiting on mDNS
+        services = Simulator(num_lights)
+        services.ports = ports
+        room = Room(max_workers=min(64, num_lights))
+        for name, info in services.service_infos():
+            room.service_events.put(('add', name, info))
+        measure("setup", num_lights, lambda: room.apply_service_events(0))
+        if len(room.lights) < num_lights:
+            print(f"      only {len(room.lights)} of {num_lights} lights were admitted")
+        measure("room_color", num_lights,
+                lambda: room.room_color(1, 120.0, 80.0, 60))
+        measure("threaded", num_lights,
+                lambda: room.room_transition_threaded(COLORS, end_scene=END_SCENE))
+        measure("heap", num_lights,
+                lambda: room.room_transition(COLORS, end_scene=END_SCENE))
+        room.close()
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+
+def main():
+    """Run the benchmark for every room size."""
+    sizes = [1, 10, 50, 100, 250, 500]
+    if len(sys.argv) > 1:
+        sizes = [int(size) for size in sys.argv[1].split(',')]
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    jitter_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    failure_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    print(f"latency {latency_ms}ms, jitter {jitter_ms}ms, failure rate {failure_rate}")
+    for num_lights in sizes:
+        bench_size(num_lights, latency_ms, jitter_ms, failure_rate)
+
+
+if __name__ == "__main__":
+    main()
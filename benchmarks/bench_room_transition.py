@@ -0,0 +1,76 @@
+"""
+CPU time spent by Room.room_transition waiting for lights to finish.
+
+The lights are stand-ins that do no I/O, so the only cost measured is the
+loop that waits for each transition to end.
+Compares the old busy-wait loop with the deadline heap.
+
+    python3 -m benchmarks.bench_room_transition [NUM_LIGHTS] [SECONDS]
+"""
+import sys
+from time import monotonic, process_time, time
+
+from lightStripLib import LightStrip, Room
+
+
+class IdleLight(LightStrip):
+    """LightStrip that skips the network."""
+
+    def __init__(self, name, wait_time):
+        self.name = name
+        self.addr = name
+        self.wait_time = wait_time
+        self.available = True
+
+    def transition_start(self, colors, name='', scene_id=''):
+        return self.wait_time
+
+    def transition_end(self, end_scene, end_scene_name='', end_scene_id=''):
+        return True
+
+    def start_compiled(self, transition):
+        return self.wait_time
+
+    def end_compiled(self, transition):
+        return True
+
+
+def busy_wait_transition(room, colors, end_scene=[]):
+    """The room_transition loop before the deadline heap."""
+    times = []
+    for light in room.lights:
+        times.append((light, light.transition_start(colors), time()))
+    while times:
+        light, sleep_time, start_time = times.pop(0)
+        if sleep_time + start_time < time():
+            light.transition_end(end_scene)
+        else:
+            times.append((light, sleep_time, start_time))
+
+
+def measure(name, transition, room, colors):
+    """Print wall and cpu time of a single transition."""
+    wall_start = monotonic()
+    cpu_start = process_time()
+    transition(room, colors)
+    cpu = process_time() - cpu_start
+    wall = monotonic() - wall_start
+    print(f"{name:<12} wall: {wall:7.3f}s  cpu: {cpu:7.3f}s  "
+          f"cpu/wall: {100 * cpu / wall:5.1f}%")
+
+
+def main():
+    """Run the benchmark."""
+    num_lights = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    # stagger the lights so the loop has several deadlines to wait on
+    room = Room([IdleLight(f"light-{i}", seconds * (i + 1) / num_lights)
+                 for i in range(num_lights)])
+    colors = [(0.0, 0.0, 100.0, 1000, 1000)]
+    print(f"{num_lights} lights, longest transition {seconds}s")
+    measure("busy-wait", busy_wait_transition, room, colors)
+    measure("deadline", lambda r, c: r.room_transition(c), room, colors)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Sharded controller benchmark against the local light simulator.
+
+The lights are served by several simulator processes so the simulator is
+not the bottleneck. For every number of workers the lights are routed to
+a ShardSupervisor and one threaded transition is fired; the time until
+every worker reported back is printed.
+
+    python3 -m benchmarks.bench_shards [NUM_LIGHTS] [WORKERS] [LATENCY_MS]
+
+WORKERS is a comma separated list of worker counts (default 1,2,4)
+"""
+import os
+import queue
+import sys
+import tempfile
+from datetime import datetime
+from time import monotonic, sleep
+from types import SimpleNamespace
+
+from benchmarks.bench_room_io import COLORS, END_SCENE, start_simulator
+from lightStripLib import CompiledTransition
+from shard_controller import ShardSupervisor
+from simulator import Simulator
+
+SIMULATORS = 4
+
+
+def fire_and_wait(supervisor, timer, results) -> tuple:
+    """Fire `timer` on every worker, returns (wall time, successful, lights)."""
+    start = monotonic()
+    sent = supervisor.fire(datetime.now(), timer)
+    fired = [results.get(timeout=300) for _ in range(sent)]
+    successful = sum(result[2] for result in fired)
+    lights = sum(result[3] for result in fired)
+    return monotonic() - start, successful, lights
+
+
+def bench_workers(num_workers, services, timer, num_lights):
+    """Time one transition over `num_workers` shards."""
+    results = queue.Queue()
+    with tempfile.TemporaryDirectory() as directory:
+        options = {'quiet': True, 'use_async': False, 'synchronized': False,
+                   'cache_file': os.path.join(directory, 'light_cache.json'),
+                   'metrics_port': None, 'record_file': None,
+                   'trace_file': None, 'probe_interval': 0}
+        supervisor = ShardSupervisor(
+            num_workers, options, on_fired=lambda *result: results.put(result))
+        supervisor.start(discovery=False)
+        try:
+            for name, info in services.service_infos():
+                supervisor.service_events.put(('add', name, info))
+            # warm up until every light has been admitted by its worker
+            for _ in range(30):
+                _, _, lights = fire_and_wait(supervisor, timer, results)
+                if lights >= num_lights:
+                    break
+                sleep(0.5)
+            wall, successful, lights = fire_and_wait(supervisor, timer, results)
+            print(f"{num_workers:3d} workers  {lights:5d} lights  wall: {wall * 1000:9.1f}ms  "
+                  f"lights/s: {lights / wall:8.1f}  successful: {successful}")
+        finally:
+            supervisor.stop()
+
+
+def main():
+    """Run the benchmark for every number of workers."""
+    num_lights = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    workers = [1, 2, 4]
+    if len(sys.argv) > 2:
+        workers = [int(count) for count in sys.argv[2].split(',')]
+    latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 2.0
+    print(f"{num_lights} lights, latency {latency_ms}ms, {os.cpu_count()} cores")
+    simulators = []
+    ports = []
+    try:
+        for index in range(SIMULATORS):
+            count = num_lights // SIMULATORS + (index < num_lights % SIMULATORS)
+            simulator, simulator_ports = start_simulator(count, latency_ms, 1.0, 0.0)
+            simulators.append(simulator)
+            ports += simulator_ports
+        # the discovery records, every light with its own name
+        services = Simulator(num_lights)
+        services.ports = ports
+        timer = SimpleNamespace(
+            compiled_transition=CompiledTransition(COLORS, END_SCENE),
+            get_activation_time=lambda: "bench")
+        for num_workers in workers:
+            bench_workers(num_workers, services, timer, num_lights)
+    finally:
+        for simulator in simulators:
+            simulator.terminate()
+            simulator.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -7,15 +7,18 @@ Timers are stored in the file pointed to by LIGHT_TIMERS
 
 Use cron or equivalent to have this program automatically run at startup
 """
-from lightStripLib import Room
+from lightStripLib import Room, CompiledTransition
 from timer import Timer
+from scheduler import Scheduler
+from file_watcher import FileWatcher
+from light_cache import LightCache
+from recorder import TrafficRecorder
+from metrics import MetricsServer, TIMER_LATENESS
+import tracing
 import sys
-import subprocess
 import logging
 import asyncio
-from time import sleep
-
-WINDOWS = sys.platform == "win32"
+from datetime import datetime
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -27,10 +30,21 @@ def usage(status):
 Elgato Light Controller
     USAGE python3 controller.py [FLAGS]
 
+    -a              run transitions on the asyncio engine
+    -c CACHE_FILE   change location of the light cache
     -h              display this message
     -l LOG_FILE     change location of log file
+    -m PORT         serve metrics on http://127.0.0.1:PORT/metrics
+    -n NUM_LIGHTS   stop the initial wait for lights once this many are found,
+                    lights found later are still admitted
+    -p SECONDS      probe every light this often, lights that stop answering
+                    are left out until they answer again (default: 10, 0 for off)
     -q              turn off logging
+    -r RECORD_FILE  record every request to the lights (see recorder.py)
+    -s              release every light's requests at the same moment
     -t TIMER_FILE   change location of timer file
+    -T TRACE_FILE   write tracing spans, a .json file is a Chrome trace
+                    (open in https://ui.perfetto.dev), anything else JSONL
     """)
     sys.exit(status)
 
@@ -41,7 +55,8 @@ def get_timers(timer_file):
 
         Timers read from `timer_file`
 
-        On failure, the function returns `timers` in its current state
+        Lines that fail to parse are logged and skipped, the same as
+        TimerCache.reload, so startup and reloads see the same timers
 
         YEAR RANGE, RULESET, ACTIVATION TIME, TRANSITION SCENE, END SCENE
 
@@ -63,112 +78,191 @@ def get_timers(timer_file):
 
         TODO: when timer goes out of range, delete it from the list of timers (year ranges only)
     """
-    timers = []  # list of timers
-
-    with open(timer_file, 'r') as timer_file:
-        for raw_timer in timer_file:
-            # first split it looking for comments and removing everything after the comment
-            # comments are the same as single line comments in python
-            remove_comments = raw_timer.split("#")[0]
-            if not remove_comments:
-                # skip the line if it was all comments
-                continue
-            raw_input = remove_comments.split(',')
-            # first thing: year range
-            raw_year = raw_input.pop(0)
-
-            # second thing: bit mask rules
-            raw_rules = raw_input.pop(0).split(" ")
-            # third thing: activation time
-            activation_time = ""
-            try:
-                activation_time = int(raw_input.pop(0))
-            except Exception:
-                logger.error("Failed to parse activation time")
-
-            # fourth thing: lights
-            lights = raw_input.pop(0)
-            lights = []  # TODO make this usable
-            # fourth thing: transition
-            raw_transition = raw_input.pop(0).split(';')  # might change this
-            transition_elements = []
-            while raw_transition:
-                scene_element = raw_transition.pop(0).split('|')
-                try:
-                    transition_elements.append((
-                        float(scene_element[0]),
-                        float(scene_element[1]),
-                        float(scene_element[2]),
-                        int(scene_element[3]),
-                        int(scene_element[4])))
-                except Exception:
-                    logger.error("Failed to parse scene element")
-                    return timers
-
-            # fifth thing: end state
-            raw_end_state = raw_input.pop(0).split(';')  # might change this
-            end_elements = []
-            while raw_end_state:
-                scene_element = raw_end_state.pop(0).split('|')
+    return TimerCache().reload(timer_file)[0]
+
+
+def parse_scene(raw_scene: str) -> list:
+    """Parse `HUE|SATURATION|BRIGHTNESS|DURATION_MS|TRANSITION_MS;...`."""
+    raw_elements = raw_scene.split(';')  # might change this
+    elements = []
+    while raw_elements:
+        scene_element = raw_elements.pop(0).split('|')
+        try:
+            elements.append((
+                float(scene_element[0]),
+                float(scene_element[1]),
+                float(scene_element[2]),
+                int(scene_element[3]),
+                int(scene_element[4])))
+        except Exception:
+            raise ValueError("Failed to parse scene element")
+    return elements
+
+
+def strip_comments(raw_timer: str) -> str:
+    """Remove everything after a `#`, the same as python comments."""
+    return raw_timer.split("#")[0].strip()
+
+
+def parse_timer(raw_timer: str):
+    """
+    Parse a single line of the timer file.
+
+    Returns None if the line is empty or only a comment,
+    raises ValueError if the line could not be parsed
+    """
+    remove_comments = strip_comments(raw_timer)
+    if not remove_comments:
+        # skip the line if it was all comments
+        return None
+    raw_input = remove_comments.split(',')
+    if len(raw_input) < 6:
+        raise ValueError(f"Failed to parse timer: {remove_comments}")
+    # first thing: year range
+    raw_year = raw_input.pop(0)
+
+    # second thing: bit mask rules
+    raw_rules = raw_input.pop(0).split(" ")
+    # third thing: activation time
+    activation_time = ""
+    try:
+        activation_time = int(raw_input.pop(0))
+    except Exception:
+        logger.error("Failed to parse activation time")
+
+    # fourth thing: lights
+    lights = raw_input.pop(0)
+    lights = []  # TODO make this usable
+    # fourth thing: transition
+    transition_elements = parse_scene(raw_input.pop(0))
+    # fifth thing: end state
+    end_elements = parse_scene(raw_input.pop(0))
+    return Timer(
+        year_range=raw_year,
+        rules=raw_rules,
+        time=activation_time,
+        active_lights=lights,
+        transition_scene=transition_elements,
+        end_scene=end_elements,
+        # built once here, firing the timer only sends the bodies
+        compiled_transition=CompiledTransition(
+            transition_elements, end_elements),
+        )
+
+
+class TimerCache:
+    """
+    Reload the timer file incrementally.
+
+    Every compiled Timer is cached under its line (with comments removed),
+    so after an edit only the lines that were added or changed get parsed.
+    Identical lines are kept apart by how many times the line was seen.
+    """
+
+    def __init__(self):
+        """Init the cache."""
+        self.timers = dict()
+
+    def reload(self, timer_file) -> tuple:
+        """
+        Read `timer_file` and update the cache.
+
+        Lines that fail to parse are logged and skipped.
+        Returns (timers, added, removed, kept)
+        """
+        timers = dict()
+        added = []
+        seen = dict()
+        with open(timer_file, 'r') as timer_lines:
+            for raw_timer in timer_lines:
+                line = strip_comments(raw_timer)
+                if not line:
+                    continue
+                seen[line] = seen.get(line, 0) + 1
+                key = (line, seen[line])
+                if key in self.timers:
+                    timers[key] = self.timers[key]
+                    continue
                 try:
-                    end_elements.append((
-                        float(scene_element[0]),
-                        float(scene_element[1]),
-                        float(scene_element[2]),
-                        int(scene_element[3]),
-                        int(scene_element[4])))
-                except Exception:
-                    logger.error("Failed to parse scene element")
-                    return timers
-            timers.append(Timer(
-                year_range=raw_year,
-                rules=raw_rules,
-                time=activation_time,
-                active_lights=lights,
-                transition_scene=transition_elements,
-                end_scene=end_elements,
-                ))  # add the timer to the list
-    return timers
-
-
-def check_file(filename: str, old_hash: str) -> str:
-    """Check if a file changed."""
-    if WINDOWS:
-        logging.warning("Windows not supported")
-        return old_hash
-    new_hash = subprocess.run(
-        ['md5sum', filename.encode('utf-8')],
-        stdout=subprocess.PIPE).stdout.decode('utf-8')
-    if old_hash != new_hash:
-        logger.info("Checking for timers.")
-    return new_hash
+                    timer = parse_timer(line)
+                except ValueError as e:
+                    logger.error(e)
+                    continue
+                timers[key] = timer
+                added.append(timer)
+        removed = [timer for key, timer in self.timers.items()
+                   if key not in timers]
+        kept = [timer for key, timer in self.timers.items() if key in timers]
+        self.timers = timers
+        return (list(timers.values()), added, removed, kept)
 
 
 def parse_args():
     """Return variables."""
     LOG_FILE = "controller.log"
     TIMER_FILE = "light.transition"
-    EXPECTED_NUM_LIGHTS = 3
+    EXPECTED_NUM_LIGHTS = None
+    USE_ASYNC = False
+    SYNCHRONIZED = False
+    RECORD_FILE = None
+    METRICS_PORT = None
+    TRACE_FILE = None
+    PROBE_INTERVAL = 10.0
+    CACHE_FILE = "light_cache.json"
     # parse args
     arguments = sys.argv[1:]
     while arguments:
         arg = arguments.pop(0)
         if arg == '-h':
             usage(0)
+        elif arg == '-a':
+            USE_ASYNC = True
+        elif arg == '-c':
+            try:
+                CACHE_FILE = arguments.pop(0)
+            except Exception:
+                logger.error("Failed to parse new CACHE_FILE")
+                usage(1)
         elif arg == '-l':
             try:
                 LOG_FILE = arguments.pop(0)
             except Exception:
                 logger.error("Failed to parse arguments")
                 usage(1)
+        elif arg == '-p':
+            try:
+                PROBE_INTERVAL = float(arguments.pop(0))
+            except Exception:
+                logger.error("Failed to parse probe interval")
+                usage(1)
         elif arg == '-q':
             logging.disable()
+        elif arg == '-s':
+            SYNCHRONIZED = True
+        elif arg == '-m':
+            try:
+                METRICS_PORT = int(arguments.pop(0))
+            except Exception:
+                logger.error("Failed to parse metrics port")
+                usage(1)
+        elif arg == '-r':
+            try:
+                RECORD_FILE = arguments.pop(0)
+            except Exception:
+                logger.error("Failed to parse new RECORD_FILE")
+                usage(1)
         elif arg == '-t':
             try:
                 TIMER_FILE = arguments.pop(0)
             except Exception:
                 logger.error("Failed to parse new TIMER_FILE")
                 usage(1)
+        elif arg == '-T':
+            try:
+                TRACE_FILE = arguments.pop(0)
+            except Exception:
+                logger.error("Failed to parse new TRACE_FILE")
+                usage(1)
         elif arg == '-n':
             try:
                 EXPECTED_NUM_LIGHTS = int(arguments.pop(0))
@@ -178,7 +272,8 @@ def parse_args():
         else:
             usage(1)
 
-    return (LOG_FILE, TIMER_FILE, EXPECTED_NUM_LIGHTS)
+    return (LOG_FILE, TIMER_FILE, EXPECTED_NUM_LIGHTS, USE_ASYNC, CACHE_FILE, SYNCHRONIZED,
+            RECORD_FILE, METRICS_PORT, TRACE_FILE, PROBE_INTERVAL)
 
 def main():
     """
@@ -188,7 +283,8 @@ def main():
     """
     # Set up file handler for logging
 
-    LOG_FILE, TIMER_FILE, EXPECTED_NUM_LIGHTS = parse_args()
+    LOG_FILE, TIMER_FILE, EXPECTED_NUM_LIGHTS, USE_ASYNC, CACHE_FILE, SYNCHRONIZED, \
+        RECORD_FILE, METRICS_PORT, TRACE_FILE, PROBE_INTERVAL = parse_args()
     
     file_handler = logging.FileHandler(LOG_FILE)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -198,41 +294,74 @@ def main():
     console.setFormatter(formatter)
     logging.getLogger().addHandler(console)
 
-    # get hash
-    current_hash = check_file(TIMER_FILE, "")
+    metrics_server = None
+    if METRICS_PORT is not None:
+        metrics_server = MetricsServer(port=METRICS_PORT)
+        metrics_server.start()
+    if TRACE_FILE is not None:
+        tracing.start_tracing(TRACE_FILE)
+
     # get all the timers
-    timers = get_timers(TIMER_FILE)
+    timer_cache = TimerCache()
+    timers, _, _, _ = timer_cache.reload(TIMER_FILE)
     logger.info("Timers:")
     for timer in timers:
         logger.info("Time: %s, Transition scene: %s, End scene: %s", 
                     timer.activation_time, timer.transition_scene, timer.end_scene)
-    # TODO: sort the timers
-    room = Room()
-    assert room.setup(), "Failed to set up room"
+    scheduler = Scheduler(timers)
+    # wake the scheduler as soon as the timer file is edited
+    watcher = FileWatcher(TIMER_FILE, on_change=scheduler.wake)
+    watcher.start()
+    recorder = TrafficRecorder(RECORD_FILE) if RECORD_FILE else None
+    room = Room(light_cache=LightCache(CACHE_FILE), recorder=recorder)
+    assert room.setup(expected_lights=EXPECTED_NUM_LIGHTS), "Failed to set up room"
+    room.start_reconciler()
+    if PROBE_INTERVAL > 0:
+        room.start_health_checker(PROBE_INTERVAL)
     logger.info("Lights: %s", ", ".join([light.info['displayName'] for light in room.lights]))
-    while True:
-        if not timers:
-            raise ValueError("Timer list is empty")
-
-        room.cleanup_inactive_services()
-
-        for timer in timers:
-            if timer.check_timer():
-                transition_scene, end_scene = timer.get_transition()
-                room.room_transition_threaded(
-                    transition_scene,
-                    end_scene=end_scene)
-                logger.info("\t%s - Activated", timer.get_activation_time())
-
-        sleep(60)
-        # check for any new timers only if the timer file has changed
-        new_hash = check_file(TIMER_FILE, current_hash)
-        if current_hash != new_hash:
-            timers = get_timers(TIMER_FILE)
-            current_hash = new_hash
-            times = ",".join([str(t.get_activation_time()) for t in timers])
-            logger.info("Timers: %s", times)
-        # and repeat the process
+    try:
+        while True:
+            if not timers:
+                raise ValueError("Timer list is empty")
+
+            # sleeps until the next timer is due, or at most a minute
+            # so the housekeeping below still runs
+            for fire_time, timer in scheduler.wait():
+                lateness = (datetime.now() - fire_time).total_seconds()
+                TIMER_LATENESS.observe(lateness)
+                transition = timer.compiled_transition
+                with tracing.span('timer.fire', timer=str(timer.get_activation_time()),
+                                  lateness=lateness):
+                    if USE_ASYNC:
+                        room.room_transition_async(transition)
+                    elif SYNCHRONIZED:
+                        room.room_transition_synchronized(transition)
+                    else:
+                        room.room_transition_threaded(transition)
+                logger.info("\t%s - Activated (%.1fs late)", timer.get_activation_time(), lateness)
+                logger.info("Connection pool: %s", room.session.stats())
+                logger.info("Writes: %s", room.write_stats())
+                logger.info("Worker pool: %s", room.pool.stats())
+
+            room.cleanup_inactive_services()
+            # check for any new timers only if the timer file has changed
+            if watcher.has_changed():
+                logger.info("Checking for timers.")
+                with tracing.span('timer.reload', file=TIMER_FILE):
+                    timers, added, removed, kept = timer_cache.reload(TIMER_FILE)
+                    scheduler.remove(removed)
+                    scheduler.add(added)
+                logger.info("Timers added: %d, removed: %d, kept: %d",
+                            len(added), len(removed), len(kept))
+                times = ",".join([str(t.get_activation_time()) for t in timers])
+                logger.info("Timers: %s", times)
+            # and repeat the process
+    finally:
+        watcher.stop()
+        room.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+        tracing.stop_tracing()
 
 
 if __name__ == "__main__":
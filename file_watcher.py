@@ -0,0 +1,154 @@
+"""
+Watch the timer file for changes without spawning processes.
+
+On linux the watcher blocks on inotify events for the file's directory,
+everywhere else it polls os.stat.
+Either way the file is only read and hashed when its stat (mtime, size,
+inode) changed, so touching the file without editing it is ignored.
+"""
+
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import select
+import sys
+import threading
+
+# inotify event masks, see inotify(7)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+def inotify_watch(directory: str):
+    """
+    Return an inotify file descriptor watching `directory`.
+
+    Returns None when inotify is not available
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        # watch the directory, editors often replace the file by renaming
+        if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class FileWatcher:
+    """Notice when a file's contents change."""
+
+    def __init__(self, filename: str, on_change=None,
+                 poll_interval: float = 1.0):
+        """
+        Init the watcher.
+
+            on_change: called from the watcher thread after every change
+            poll_interval: seconds between stat checks when inotify is missing
+        """
+        self.log = logging.getLogger(__name__)
+        self.filename = filename
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.stat_key = self.get_stat_key()
+        self.digest = self.get_digest()
+        self.pending = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.fd = None
+
+    def get_stat_key(self):
+        """Return (mtime, size, inode) of the file, None if it is missing."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def get_digest(self):
+        """Return a hash of the file contents, None if it is missing."""
+        try:
+            with open(self.filename, 'rb') as watched_file:
+                return hashlib.md5(watched_file.read()).hexdigest()
+        except OSError:
+            return None
+
+    def changed(self) -> bool:
+        """Return True if the contents changed since the last check."""
+        stat_key = self.get_stat_key()
+        if stat_key == self.stat_key:
+            return False
+        self.stat_key = stat_key
+        digest = self.get_digest()
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        return True
+
+    def has_changed(self) -> bool:
+        """
+        Return True once for every change seen by the watcher thread.
+
+        Without a running thread this checks the file directly.
+        """
+        if self.thread is None:
+            return self.changed()
+        if self.pending.is_set():
+            self.pending.clear()
+            return True
+        return False
+
+    def start(self):
+        """Start watching in a background thread."""
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        self.fd = inotify_watch(directory)
+        if self.fd is None:
+            self.log.info(f"inotify not available, polling {self.filename}")
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.watch, name="file-watcher", daemon=True)
+        self.thread.start()
+
+    def watch(self):
+        """Wait for events (or poll) until stopped."""
+        while not self.stop_event.is_set():
+            if self.fd is not None:
+                # the timeout only keeps `stop` responsive
+                ready, _, _ = select.select([self.fd], [], [], self.poll_interval)
+                if not ready:
+                    continue
+                try:
+                    while os.read(self.fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                self.stop_event.wait(self.poll_interval)
+            if self.changed():
+                self.log.info(f"{self.filename} changed")
+                self.pending.set()
+                if self.on_change:
+                    self.on_change()
+
+    def stop(self):
+        """Stop the watcher thread."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -4,11 +4,23 @@ controller for elgato light strips.
 Reference: github.com/zunderscore/elgato-light-control/
 """
 
+import asyncio
+import concurrent.futures
+import contextvars
+import copy
+import heapq
 import requests
 import socket
+import http.client
 import json
-from time import sleep, time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import queue
+import threading
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
+from worker_pool import WorkerPool
+import metrics
+import tracing
+from resilience import RequestPolicy, CircuitOpenError, check_deadline
 
 NUM_PORTS = 65536
 ELGATO_PORT = 9123
@@ -17,57 +29,97 @@ ELGATO_PORT = 9123
 import logging
 
 from zeroconf import ServiceListener
-# TODO: fix bug where listener crashes when a light is removed
 class LightServiceListener(ServiceListener):
     """
     Listener for Zeroconf to keep track of active lights.
-    Abusing passing by reference to keep track of active lights.
+
+    Zeroconf calls the listener from its own thread, so instead of touching
+    shared state the listener puts (event, name, info) tuples on a
+    thread-safe queue, where event is 'add', 'update' or 'remove'.
+    The consumer applies them on its own thread.
     """
 
-    def __init__(self, light_dict: dict):
+    def __init__(self, events: queue.Queue = None):
         """Initialize the listener."""
         self.log = logging.getLogger(__name__)
         self.log.info("Initializing LightServiceListener")
-        self.light_dict = light_dict
+        self.events = events if events is not None else queue.Queue()
+        self.light_dict = dict()
 
     def remove_service(self, zeroconf, type, name):
         """
         Remove a service.
         
         Of course, the default timeout for this (when something is unplugged)
-        is an hour
-        TODO: change that timeout
-
-        Right now, I am just deleting the light from the service dict in
-        Room.check_for_new_lights()
+        is an hour, the HealthChecker leaves such lights out long before
         """
-        if name in self.light_dict:
-            try:
-                del self.light_dict[name]
-                self.log.critical(f"Removed light service: {name}")
-            except Exception as e:
-                self.log.error(f"Failed to remove light service: {e}")
+        self.events.put(('remove', name, None))
+        self.log.critical(f"Removed light service: {name}")
 
     def update_service(self, zeroconf, type, name):
         """Update a service."""
         info = zeroconf.get_service_info(type, name)
         if info:
-            self.light_dict[name] = info
+            self.events.put(('update', name, info))
             self.log.critical(f"Updated light service: {name}")
 
     def add_service(self, zeroconf, type, name):
         """Add a service to the list."""
         info = zeroconf.get_service_info(type, name)
         if info:
-            self.light_dict[name] = info
+            self.events.put(('add', name, info))
             self.log.critical(f"Added light service: {name}")
 
     def get_active_lights(self):
-        """Return the active lights."""
+        """
+        Return the active lights.
+
+        Applies the queued events to self.light_dict, only call this from
+        one thread and only when nothing else consumes the queue.
+        """
+        for event, name, info in drain_service_events(self.events):
+            if event == 'remove':
+                self.light_dict.pop(name, None)
+            else:
+                self.light_dict[name] = info
         self.log.info(f"Returning active lights: {self.light_dict}")
         return self.light_dict
 
 
+def wait_until(deadline: float, spin: float = 0.002):
+    """
+    Block until the monotonic clock reaches `deadline`.
+
+    Sleeps for most of the wait and spins for the last `spin` seconds,
+    sleep alone can overshoot by a scheduler tick.
+    """
+    remaining = deadline - monotonic()
+    if remaining > spin:
+        sleep(remaining - spin)
+    while monotonic() < deadline:
+        pass
+
+
+def drain_service_events(events: queue.Queue, timeout: float = None) -> list:
+    """
+    Return every event waiting on the queue.
+
+    With a timeout, waits up to `timeout` seconds for the first event,
+    otherwise it does not block.
+    """
+    drained = []
+    if timeout is not None:
+        try:
+            drained.append(events.get(timeout=timeout))
+        except queue.Empty:
+            return drained
+    while True:
+        try:
+            drained.append(events.get_nowait())
+        except queue.Empty:
+            return drained
+
+
 class Scene:
     """
     Store and manipulate scenes at a high level.
@@ -138,6 +190,414 @@ class Scene:
         return scene_length
 
 
+def scene_element(hue, saturation, brightness, durationMs, transitionMs) -> dict:
+    """Return one element of a scene, the same as Scene.add_scene."""
+    return {'hue': hue,
+            'saturation': saturation,
+            'brightness': brightness,
+            'durationMs': durationMs,
+            'transitionMs': transitionMs}
+
+
+def build_transition_data(colors: list,
+                          current_color: tuple = (),
+                          name='transition-scene',
+                          scene_id='transition-scene-id') -> tuple:
+    """
+    Return (light data, wait time) for a transition scene.
+
+    If the light has already been set to a color (`current_color` is not
+    empty), that color becomes the start of the transition scene.
+    The wait time is how long to wait before ending the transition.
+    """
+    elements = []
+    wait_time_ms = 0
+    if current_color:
+        _, hue, saturation, brightness = current_color
+        elements.append(scene_element(
+            hue, saturation, brightness, colors[0][3], colors[0][4]))
+        wait_time_ms += colors[0][4] + colors[0][3]
+    # add the colors in the new scene
+    for color in colors:
+        elements.append(scene_element(*color))
+        wait_time_ms += color[3] + color[4]
+    data = {
+        'numberOfLights': 1,
+        'lights': [
+            {'on': 1,
+             'id': scene_id,
+             'name': name,
+             'brightness': 100,
+             'numberOfSceneElements': len(elements),
+             'scene': elements
+             }
+        ]
+    }
+    return (data, (wait_time_ms - colors[-1][3] - colors[-1][4]) / 1000)
+
+
+def build_end_data(end_scene: list,
+                   end_scene_name='end-scene',
+                   end_scene_id='end-scene-id') -> dict:
+    """
+    Return the light data that ends a transition.
+
+    No end scene switches to the scene named `end_scene_name`,
+    a single element is a plain color and more elements are a scene.
+    """
+    assert type(end_scene) is list, f"TypeError: {end_scene} is type: {type(end_scene)} not type: list"
+    if not end_scene:
+        light = {'on': 1, 'id': end_scene_id, 'name': end_scene_name,
+                 'brightness': 100}
+    elif len(end_scene) == 1:
+        hue, saturation, brightness, _, _ = end_scene[0]
+        light = {'on': 1 if brightness > 0 else 0,
+                 'hue': hue,
+                 'saturation': saturation,
+                 'brightness': brightness}
+    else:
+        # TODO: make scene brightness variable
+        elements = [scene_element(*item) for item in end_scene]
+        light = {'on': 1,
+                 'id': end_scene_id,
+                 'name': end_scene_name,
+                 'brightness': 100,
+                 'numberOfSceneElements': len(elements),
+                 'scene': elements}
+    return {'numberOfLights': 1, 'lights': [light]}
+
+
+class CompiledTransition:
+    """
+    A transition and its end scene compiled into ready-to-send bodies.
+
+    The light data is built and serialized once and shared by every light.
+    Only the start of the transition depends on the light (its current
+    color), so a body is compiled for each distinct start color the first
+    time it is seen.
+    """
+
+    # distinct start colors kept before the cache is cleared
+    MAX_START_COLORS = 64
+
+    def __init__(self,
+                 colors: list,
+                 end_scene: list = [],
+                 name='transition-scene',
+                 scene_id='transition-scene-id',
+                 end_scene_name="end-scene",
+                 end_scene_id="end-scene-id"):
+        """Compile the end scene and the transition without a start color."""
+        self.colors = [tuple(color) for color in colors]
+        self.end_scene = [tuple(color) for color in end_scene]
+        self.name = name
+        self.scene_id = scene_id
+        self.end_data = build_end_data(
+            list(self.end_scene), end_scene_name, end_scene_id)
+        self.end_body = json.dumps(self.end_data)
+        # the end is a scene unless it is a single color
+        self.end_is_scene = len(self.end_scene) != 1
+        self.lock = threading.Lock()
+        self.starts = dict()
+        if self.colors:
+            self.start(())
+
+    def __bool__(self) -> bool:
+        """Return False if there is nothing to transition through."""
+        return bool(self.colors)
+
+    def start(self, current_color: tuple) -> tuple:
+        """Return (light data, body, wait time) for a light on `current_color`."""
+        # the on flag is not part of the scene
+        key = tuple(current_color[1:]) if current_color else ()
+        with self.lock:
+            if key in self.starts:
+                return self.starts[key]
+        data, wait_time = build_transition_data(
+            self.colors, current_color, self.name, self.scene_id)
+        compiled = (data, json.dumps(data), wait_time)
+        with self.lock:
+            if len(self.starts) >= self.MAX_START_COLORS:
+                self.starts.clear()
+            self.starts[key] = compiled
+        return compiled
+
+
+def compile_transition(colors,
+                       end_scene: list = [],
+                       name='transition-scene',
+                       scene_id='transition-scene-id',
+                       end_scene_name="end-scene",
+                       end_scene_id="end-scene-id") -> CompiledTransition:
+    """Return `colors` if it is already compiled, otherwise compile it."""
+    if isinstance(colors, CompiledTransition):
+        return colors
+    return CompiledTransition(
+        colors, end_scene, name, scene_id, end_scene_name, end_scene_id)
+
+
+class LightSession:
+    """
+    Keep-alive HTTP session for talking to lights.
+
+    Connections are pooled per light address, so repeated requests to the
+    same light reuse a warm socket instead of opening a new TCP connection.
+    A Room shares a single session between all of its lights.
+    Every request is bounded by the policy's timeouts and the current
+    deadline, and is not sent at all while the light's breaker is open.
+    """
+
+    def __init__(self, pool_connections: int = 64, pool_maxsize: int = 4,
+                 recorder=None, policy: RequestPolicy = None):
+        """
+        Init the session.
+
+            pool_connections: number of lights to keep a pool for
+            pool_maxsize: number of sockets to keep open per light
+            recorder: recorder.TrafficRecorder that logs every request
+            policy: resilience.RequestPolicy with the timeouts, retries
+            and circuit breakers
+        """
+        self.log = logging.getLogger(__name__)
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize)
+        self.session.mount('http://', self.adapter)
+        self.reconnects = 0
+        self.retries = 0
+        self.recorder = recorder
+        self.policy = policy if policy is not None else RequestPolicy()
+
+    def request(self, method: str, url: str, **kwargs):
+        """
+        Send a request and observe how it went, see observe.
+
+        Raises resilience.DeadlineExceeded or CircuitOpenError without
+        sending anything when the deadline has passed or the light's
+        breaker is open.
+        """
+        with tracing.span('http', method=method, url=url) as span:
+            check_deadline()
+            light = url.split('/')[2]
+            if not self.policy.breaker(light).allow():
+                raise CircuitOpenError(f"{light} keeps failing, not sending")
+            start = monotonic()
+            try:
+                response = self._send(method, url, **kwargs)
+            except Exception as e:
+                self.observe(method, url, kwargs.get('data'), start, error=e)
+                raise
+            span.set(status=response.status_code,
+                     response_bytes=len(response.content))
+            self.observe(method, url, kwargs.get('data'), start,
+                         response.status_code, response.content)
+            return response
+
+    def observe(self, method: str, url: str, body, start: float,
+                status: int = None, content: bytes = None, error=None):
+        """Feed a finished request to the metrics, the breaker and the recorder, if any."""
+        light = url.split('/')[2]
+        metrics.observe_request(light, method, monotonic() - start, status, error)
+        self.policy.record(light, status, error)
+        if self.recorder is not None:
+            self.recorder.record_url(method, url, body, start, status, content, error)
+
+    def _send(self, method: str, url: str, timeout=None, **kwargs):
+        """
+        Send a request over a pooled connection, retrying as the policy allows.
+
+        Connection errors and 5xx answers are retried after a jittered
+        backoff. The first retry of a connection error goes out right away
+        since the light most likely dropped the pooled socket, which makes
+        urllib3 open a fresh connection.
+        Read timeouts are not retried, the light got the request and a
+        slow light would only be asked again.
+        """
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(
+                    method, url, timeout=self.policy.timeout(timeout), **kwargs)
+                if response.status_code < 500:
+                    return response
+                failure = response
+            except requests.exceptions.ConnectionError as e:
+                failure = e
+            attempt += 1
+            connection_error = isinstance(failure, Exception)
+            delay = self.policy.retry_delay(attempt, immediate=(
+                attempt == 1 and connection_error))
+            if delay is None:
+                if connection_error:
+                    raise failure
+                return failure
+            self.retries += 1
+            if connection_error:
+                self.reconnects += 1
+                self.log.debug(f"Connection to {url} failed, retrying in {delay:.3f}s: {failure}")
+            else:
+                self.log.debug(f"{url} answered {failure.status_code}, retrying in {delay:.3f}s")
+            sleep(delay)
+
+    def probe(self, url: str, timeout: float) -> bool:
+        """
+        Send a single get request, returns True if the light answered.
+
+        Probes ignore the circuit breaker and are not retried, but their
+        result still feeds it, so a light that answers a probe is used
+        again right away. See HealthChecker.
+        """
+        with tracing.span('http.probe', url=url) as span:
+            start = monotonic()
+            try:
+                response = self.session.get(url, timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                self.observe('GET', url, None, start, error=e)
+                return False
+            span.set(status=response.status_code)
+            self.observe('GET', url, None, start,
+                         response.status_code, response.content)
+            return response.status_code < 500
+
+    def get(self, url: str, **kwargs):
+        """Send a get request."""
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        """Send a put request."""
+        return self.request('PUT', url, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Return the pool counters.
+
+            hits: requests that reused an open connection
+            misses: requests that had to open a new connection
+            reconnects: requests retried after a connection error
+            retries: every retry, after connection errors and 5xx answers
+        """
+        connections = 0
+        num_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            num_requests += pool.num_requests
+        return {
+            'hits': num_requests - connections,
+            'misses': connections,
+            'reconnects': self.reconnects,
+            'retries': self.retries}
+
+    def close(self):
+        """Close every pooled connection and the recording."""
+        self.session.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+class StagedPut:
+    """
+    A put request to a light with its connection opened ahead of time.
+
+    The request bytes are built when staged, so sending it is a single
+    write on a connected socket. Used to release many lights at once,
+    see Room.release_staged.
+    """
+
+    def __init__(self, light, data: dict, body: str):
+        """
+        Open the connection and build the request.
+
+        Nothing is staged while the light's breaker is open, finish then
+        fails right away.
+        """
+        self.light = light
+        self.data = data
+        self.body = body
+        encoded = body.encode()
+        self.request = (
+            f"PUT /elgato/lights HTTP/1.1\r\n"
+            f"Host: {light.full_addr}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(encoded)}\r\n"
+            f"Connection: close\r\n\r\n").encode() + encoded
+        self.sent = False
+        self.sock = None
+        policy = light.session.policy
+        self.blocked = not policy.breaker(light.full_addr).allow()
+        if self.blocked:
+            return
+        start = monotonic()
+        try:
+            self.sock = socket.create_connection(
+                (light.addr, light.port), timeout=policy.timeout()[0])
+        except OSError as e:
+            light.session.observe('PUT', 'http://' + light.full_addr + '/elgato/lights',
+                                  body, start, error=e)
+            light.log.debug(f"Failed to stage a connection to {light.full_addr}: {e}")
+
+    def send(self):
+        """Write the request, the response is read by finish."""
+        if self.sock is None:
+            return
+        try:
+            self.light.send_time = monotonic()
+            self.sock.sendall(self.request)
+            self.sent = True
+        except OSError as e:
+            self.light.log.debug(f"Failed to send staged request to {self.light.full_addr}: {e}")
+
+    def finish(self) -> bool:
+        """
+        Read the response and record the state the light accepted.
+
+        A request that could not be staged or sent goes out late over
+        the light's session instead.
+        Returns True if successful
+        """
+        if self.blocked:
+            self.light.log.debug(f"Circuit breaker for {self.light.full_addr} is open, not sending")
+            return False
+        if not self.sent:
+            self.close()
+            return self.light.put_strip_body(self.data, self.body)
+        url = 'http://' + self.light.full_addr + '/elgato/lights'
+        with tracing.span('http.staged', method='PUT', url=url) as span:
+            try:
+                self.sock.settimeout(self.light.session.policy.timeout()[1])
+                response = http.client.HTTPResponse(self.sock)
+                response.begin()
+                payload = response.read()
+                span.set(status=response.status, response_bytes=len(payload))
+                self.light.session.observe('PUT', url, self.body, self.light.send_time,
+                                           response.status, payload)
+                if response.status == requests.codes.ok:
+                    with self.light.lock:
+                        self.light.acknowledge(self.data, json.loads(payload))
+                    return True
+                self.light.log.debug(payload)
+                retry = response.status >= 500
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                self.light.session.observe('PUT', url, self.body, self.light.send_time,
+                                           error=e)
+                self.light.log.debug(f"Failed to read staged response from {self.light.full_addr}: {e}")
+                retry = False
+            finally:
+                self.close()
+        if retry:
+            # the light is busy, retry late rather than not at all
+            return self.light.put_strip_body(self.data, self.body)
+        return False
+
+    def close(self):
+        """Close the staged connection."""
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
 def save_timer_to_file(file: str, time: str, lights: list, scene: list):
     """
     Save a timer in file so the controller can read it in.
@@ -155,7 +615,226 @@ def save_timer_to_file(file: str, time: str, lights: list, scene: list):
         output_file.write(output_str)
 
 
-class LightStrip:
+class LightStripState:
+    """
+    The state and payload building shared by LightStrip and AsyncLightStrip.
+
+    Nothing here talks to the light, the classes using it supply the I/O
+    and the attributes (data, acknowledged, state_time, lock, ...).
+    """
+
+    def check_scene(self):
+        """Work out from self.data whether the light is running a scene."""
+        self.is_scene = False
+        if 'scene' in self.data['lights'][0]:
+            self.is_scene = True
+            self.scene = Scene(self.data['lights'][0]['scene'])
+        elif 'name' in self.data['lights'][0]:
+            self.is_scene = True
+
+    def state_is_fresh(self, max_age: float = None) -> bool:
+        """
+        Return True if the acknowledged state is younger than `max_age` seconds.
+
+        `max_age` defaults to self.max_state_age
+        """
+        max_age = self.max_state_age if max_age is None else max_age
+        if self.state_time is None or self.acknowledged is None:
+            return False
+        return monotonic() - self.state_time <= max_age
+
+    def cached_color(self, max_age: float = None):
+        """
+        Return the color from the cached state.
+
+        Returns None if the cache is older than `max_age` seconds
+        (defaults to self.max_state_age), otherwise the same as get_strip_color
+        """
+        with self.lock:
+            if not self.state_is_fresh(max_age):
+                return None
+            try:
+                light_color = self.acknowledged['lights'][0]
+                return (
+                    light_color['on'],
+                    light_color['hue'],
+                    light_color['saturation'],
+                    light_color['brightness'])
+            except Exception:
+                return ()
+
+    def stage_strip_data(self, new_data: dict):
+        """Return the serialized put body for `new_data`, None if nothing needs sending."""
+        payload = self.make_payload(new_data)
+        if payload is None:
+            return None
+        return json.dumps(payload)
+
+    def make_payload(self, new_data: dict):
+        """
+        Return the part of `new_data` the light needs to be sent.
+
+        Returns None when the light already acknowledged exactly this state.
+        Scenes are always sent whole (sending a scene again restarts it),
+        colors only send the fields that changed.
+        Without a fresh acknowledged state (see state_is_fresh) the light may
+        have been changed since, so everything is sent.
+        """
+        if not self.state_is_fresh():
+            return new_data
+        try:
+            old_light = self.acknowledged['lights'][0]
+            new_light = new_data['lights'][0]
+        except (KeyError, IndexError, TypeError):
+            return new_data
+        if 'scene' in new_light or 'name' in new_light:
+            return new_data
+        if 'scene' in old_light or 'name' in old_light:
+            return new_data
+        changed = {key: value for key, value in new_light.items()
+                   if old_light.get(key) != value}
+        if not changed:
+            self.suppressed_writes += 1
+            self.log.debug(f"{self.full_addr} is already in that state, skipping write")
+            return None
+        if len(changed) < len(new_light):
+            self.partial_writes += 1
+        payload = {key: value for key, value in new_data.items() if key != 'lights'}
+        payload['lights'] = [changed]
+        return payload
+
+    def acknowledge(self, new_data: dict, response: dict):
+        """
+        Record the state the light accepted after a successful put.
+
+        `new_data` is kept by reference, compiled data is shared by every
+        light and never modified. Only when the light answered with values
+        that differ from it is a copy made.
+        """
+        try:
+            # the light answers with the fields it applied
+            sent = new_data['lights'][0]
+            changed = {key: value for key, value in response['lights'][0].items()
+                       if sent.get(key) != value}
+        except (KeyError, IndexError, TypeError, AttributeError):
+            changed = None
+        if changed:
+            new_data = dict(new_data)
+            new_data['lights'] = [dict(sent, **changed)] + new_data['lights'][1:]
+        self.data = new_data
+        self.acknowledged = new_data
+        self.state_time = monotonic()
+
+    def write_stats(self) -> dict:
+        """Return how many writes were skipped or sent partially."""
+        return {
+            'suppressed': self.suppressed_writes,
+            'partial': self.partial_writes}
+
+    def make_color(self, on, hue, saturation, brightness):
+        """Set self.data to a single color without sending it."""
+        self.data = {
+            'numberOfLights': 1,
+            'lights': [
+                {'on': on,
+                 'hue': hue,
+                 'saturation': saturation,
+                 'brightness': brightness}
+            ]
+        }
+
+    def update_scene_data(self, scene,
+                          scene_name="transition-scene",
+                          scene_id="",
+                          brightness: float = 100.0):
+        """Update just the scene data."""
+        self.log.info("updating scene data")
+        if not self.is_scene:
+            self.log.info("light strip is not currently assigned to a scene, autogenerating")
+            self.make_scene(scene_name, scene_id)
+        # self.data can be the acknowledged state or compiled data, see acknowledge
+        self.data = copy.deepcopy(self.data)
+
+        if not scene:
+            self.log.info("assigining scene by name")
+            self.data['lights'][0]['name'] = scene_name
+            if scene_id:
+                self.log.info("also assigining scene by id")
+                self.data['lights'][0]['id'] = scene_id
+            self.log.info("purging scene data")
+            if not self.data['lights'][0].pop('scene', None):
+                self.log.info("scene was not specified")
+            if not self.data['lights'][0].pop('numberOfSceneElements', None):
+                self.log.info("number of scene elements was not specified")
+        else:
+            self.log.info(f"scene: {scene}")
+            assert type(scene) is Scene, "scene is not a list"
+            self.data['lights'][0]['scene'] = scene.data
+            self.data['lights'][0]['numberOfSceneElements'] = len(scene.data)
+
+    def make_scene(self,
+                   name: str,
+                   scene_id: str,
+                   brightness: float = 100.0):
+        """Create a scene."""
+        # self.log.debug("making the light a scene")
+        self.data = {
+            'numberOfLights': 1,
+            'lights': [
+                {'on': 1,
+                 'id': scene_id,
+                 'name': name,
+                 'brightness': brightness,
+                 'numberOfSceneElements': 0,
+                 'scene': []
+                 }
+            ]
+        }
+        self.is_scene = True
+        # if you do not specify an empty scene,
+        # it might copy old scene data... annoying
+        self.scene = Scene([])
+
+    def make_transition(self,
+                        colors: list,
+                        current_color: tuple,
+                        name='transition-scene',
+                        scene_id='transition-scene-id') -> float:
+        """
+        Build the transition scene in self.data without sending it.
+
+        See build_transition_data.
+        Returns how long to wait before ending the transition.
+        """
+        self.data, wait_time = build_transition_data(
+            colors, current_color, name, scene_id)
+        self.is_scene = True
+        self.scene = Scene(self.data['lights'][0]['scene'])
+        return wait_time
+
+    def make_end_scene(self,
+                       end_scene: list,
+                       end_scene_name='end-scene',
+                       end_scene_id='end-scene-id'):
+        """Build the end of a transition in self.data without sending it."""
+        self.data = build_end_data(end_scene, end_scene_name, end_scene_id)
+        self.check_scene()
+
+    def stage_compiled(self, data: dict, body: str):
+        """
+        Return the body to send for compiled `data`, None if nothing needs sending.
+
+        The compiled body is used as is unless only part of a color changed.
+        """
+        payload = self.make_payload(data)
+        if payload is None:
+            return None
+        if payload is not data:
+            return json.dumps(payload)
+        return body
+
+
+class LightStrip(LightStripState):
     """
     LightStrip language.
 
@@ -184,25 +863,91 @@ class LightStrip:
             when there is a 'scene', the light loops through each item in the scene
     """
 
-    def __init__(self, addr, port, name=""):
+    def __init__(self, addr, port, name="", session=None,
+                 max_state_age: float = 60.0, info: dict = None):
         
-        """Initialize the light."""
+        """
+        Initialize the light.
+
+            max_state_age: seconds the cached state can be used instead of
+            asking the light (see get_strip_color)
+            info: accessory info that is already known (e.g. from a
+            LightCache), skips asking the light for it
+        """
         # Configure logging
         self.log = logging.getLogger(__name__)
         self.log.info(f"Initializing LightStrip with address: {addr}:{port}")
         self.addr = addr
         self.port = port
         self.name = name
+        # lights in a room share the room's session so connections stay warm
+        self.session = session if session is not None else LightSession()
+        # last state the light accepted, used to skip writes that change nothing
+        self.acknowledged = None
+        self.suppressed_writes = 0
+        self.partial_writes = 0
+        # when self.acknowledged was last confirmed by the light (monotonic)
+        self.state_time = None
+        # when the last put request was sent (monotonic)
+        self.send_time = None
+        self.max_state_age = max_state_age
+        # the reconciler thread and transitions both touch the state
+        self.lock = threading.RLock()
+        # False while the light fails its health checks, see HealthChecker
+        self.available = True
         self.full_addr = self.addr + ':' + str(self.port)
-        self.get_strip_data()  # fill in the data/info/settings of the light
-        self.get_strip_info()
-        self.get_strip_settings()
-        self.is_scene = False
-        if 'scene' in self.data['lights'][0]:
-            self.is_scene = True
-            self.scene = Scene(self.data['lights'][0]['scene'])
-        elif 'name' in self.data['lights'][0]:
-            self.is_scene = True
+        # only the info is needed to admit the light,
+        # data and settings are fetched the first time they are used
+        self._data = None
+        self._settings = None
+        self._is_scene = None
+        if info is not None:
+            self.info = info
+        else:
+            self.get_strip_info()
+
+    @property
+    def data(self):
+        """The light data, fetched from the light on first access."""
+        if self._data is None:
+            self.get_strip_data()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    @property
+    def settings(self):
+        """The light settings, fetched from the light on first access."""
+        if self._settings is None:
+            self.get_strip_settings()
+        return self._settings
+
+    @settings.setter
+    def settings(self, value):
+        self._settings = value
+
+    @property
+    def is_scene(self):
+        """Whether the light is running a scene, worked out from the data on first access."""
+        if self._is_scene is None:
+            self.check_scene()
+        return self._is_scene
+
+    @is_scene.setter
+    def is_scene(self, value):
+        self._is_scene = value
+
+    def rebind(self, addr, port):
+        """Point the light at a new address, the cached state is dropped."""
+        with self.lock:
+            self.log.info(f"Rebinding {self.name} from {self.full_addr} to {addr}:{port}")
+            self.addr = addr
+            self.port = port
+            self.full_addr = self.addr + ':' + str(self.port)
+            self.acknowledged = None
+            self.state_time = None
 
     def get_strip_data(self):
         """
@@ -211,32 +956,77 @@ class LightStrip:
             format:
             http://<IP>:<port>/elgato/lights
         """
-        self.data = requests.get(
+        data = self.session.get(
             f'http://{self.full_addr}/elgato/lights',
             verify=False).json()
+        with self.lock:
+            self.data = data
+            self.acknowledged = copy.deepcopy(data)
+            self.state_time = monotonic()
         return self.data
 
+    def refresh_state(self) -> bool:
+        """
+        Re-read the light's state into the cache.
+
+        Used by the StateReconciler, a write that lands while the request is
+        in flight wins over the (older) state that was read.
+        Returns True if the light was changed outside the controller
+        """
+        started = self.state_time
+        try:
+            data = self.session.get(
+                f'http://{self.full_addr}/elgato/lights',
+                verify=False).json()
+        except Exception as e:
+            self.log.debug(f"Failed to refresh {self.full_addr}: {e}")
+            return False
+        with self.lock:
+            if self.state_time != started:
+                return False
+            changed = self.acknowledged is not None and data != self.acknowledged
+            self.data = data
+            self.acknowledged = copy.deepcopy(data)
+            self.state_time = monotonic()
+            try:
+                self.check_scene()
+            except (KeyError, IndexError, TypeError):
+                pass
+        if changed:
+            self.log.info(f"{self.name or self.full_addr} was changed outside the controller")
+        return changed
+
     def get_strip_info(self):
         """Send a get request to the light."""
-        self.info = requests.get(
+        self.info = self.session.get(
             f'http://{self.full_addr}/elgato/accessory-info',
             verify=False).json()
         return self.info
 
+    def probe(self, timeout: float = 1.0) -> bool:
+        """Ask the light for its accessory info, returns True if it answered."""
+        return self.session.probe(
+            f'http://{self.full_addr}/elgato/accessory-info', timeout)
+
     def get_strip_settings(self):
         """Get the strip's settings."""
-        self.settings = requests.get(
+        self.settings = self.session.get(
             f'http://{self.full_addr}/elgato/lights/settings',
             verify=False).json()
         return self.settings
 
-    def get_strip_color(self):
+    def get_strip_color(self, max_age: float = None):
         """
         Return the color of the light.
 
             If the light is not set to a specific color
             (i.e. when it is in a scene) then the tuple is empty
+
+            The cached state is used when it is newer than `max_age` seconds,
+            pass 0 to always ask the light
         """
+        if (cached := self.cached_color(max_age)) is not None:
+            return cached
         try:
             light_color = self.get_strip_data()['lights'][0]
             return (
@@ -244,32 +1034,51 @@ class LightStrip:
                 light_color['hue'],
                 light_color['saturation'],
                 light_color['brightness'])
-        except Exception:
+        except (KeyError, IndexError, TypeError):
             return ()  # the light strip is not set to a static color
+        except Exception as e:
+            self.log.debug(f"Failed to read the color of {self.full_addr}: {e}")
+            return ()
 
     def set_strip_data(self, new_data: json) -> bool:
         """
         Send a put request to update the light data.
 
+        Writes that would not change the light are skipped, and when only
+        some fields of a color changed only those fields are sent.
         Returns True if successful
-        TODO: investigate if sending the entire JSON is necessary or if we can just send the things that need to be changed
         """
+        with self.lock:
+            return self.send_strip_data(new_data)
+
+    def send_strip_data(self, new_data: json) -> bool:
+        """Send `new_data` (or the part that changed), see set_strip_data."""
+        body = self.stage_strip_data(new_data)
+        if body is None:
+            return True
+        return self.put_strip_body(new_data, body)
+
+    def put_strip_body(self, new_data: dict, body: str) -> bool:
+        """Send a body from stage_strip_data, `new_data` is recorded once the light accepts it."""
         # self.log.debug("attempting message:")
-        # self.log.debug(json.dumps(new_data))
+        # self.log.debug(body)
         try:
-            r = requests.put(
+            self.send_time = monotonic()
+            r = self.session.put(
                 'http://' + self.full_addr + '/elgato/lights',
-                data=json.dumps(new_data))
+                data=body)
             # if the request was accepted, modify self.data
             if r.status_code == requests.codes.ok:
-                self.data = r.json()
+                self.acknowledge(new_data, r.json())
                 return True
             # self.log.debug("attempted message:")
-            # self.log.debug(json.dumps(new_data))
+            # self.log.debug(body)
             # self.log.debug("response:")
             self.log.debug(r.text)
-        except Exception:
-            pass
+        except CircuitOpenError as e:
+            self.log.debug(f"Skipping update of {self.full_addr}: {e}")
+        except (OSError, ValueError) as e:
+            self.log.warning(f"Failed to update {self.full_addr}: {e}")
         return False
 
     def set_strip_settings(self, new_data: json) -> bool:
@@ -279,93 +1088,36 @@ class LightStrip:
         Returns True on success
         """
         try:
-            r = requests.put(
+            r = self.session.put(
                 'http://' + self.full_addr + '/elgato/lights/settings',
                 data=json.dumps(new_data))
             self.log.debug(r.text)
             if r.status_code == requests.codes.ok:
                 self.settings = new_data
                 return True
-        except Exception:
-            pass
+        except (OSError, ValueError) as e:
+            self.log.warning(f"Failed to update settings of {self.full_addr}: {e}")
         return False
 
     def set_strip_info(self, new_data: json) -> bool:
         """Set the strip info."""
         try:
-            r = requests.put(
+            r = self.session.put(
                 'http://' + self.full_addr + '/elgato/accessory-info',
                 data=json.dumps(new_data))
             if r.status_code == requests.codes.ok:
                 self.info = new_data
                 return True
             self.log.debug(r.text)
-        except Exception:
-            pass
+        except (OSError, ValueError) as e:
+            self.log.warning(f"Failed to update info of {self.full_addr}: {e}")
         return False
 
     def update_color(self, on, hue, saturation, brightness) -> bool:
         """User friendly way to interact with json data to change the color."""
-        self.data = {
-            'numberOfLights': 1,
-            'lights': [
-                {'on': on,
-                 'hue': hue,
-                 'saturation': saturation,
-                 'brightness': brightness}
-            ]
-        }
-        return self.set_strip_data(self.data)
-
-    def update_scene_data(self, scene,
-                          scene_name="transition-scene",
-                          scene_id="",
-                          brightness: float = 100.0):
-        """Update just the scene data."""
-        self.log.info("updating scene data")
-        if not self.is_scene:
-            self.log.info("light strip is not currently assigned to a scene, autogenerating")
-            self.make_scene(scene_name, scene_id)
-
-        if not scene:
-            self.log.info("assigining scene by name")
-            self.data['lights'][0]['name'] = scene_name
-            if scene_id:
-                self.log.info("also assigining scene by id")
-                self.data['lights'][0]['id'] = scene_id
-            self.log.info("purging scene data")
-            if not self.data['lights'][0].pop('scene'):
-                self.log.info("scene was not specified")
-            if not self.data['lights'][0].pop('numberOfSceneElements'):
-                self.log.info("number of scene elements was not specified")
-        else:
-            self.log.info(f"scene: {scene}")
-            assert type(scene) is Scene, "scene is not a list"
-            self.data['lights'][0]['scene'] = scene.data
-            self.data['lights'][0]['numberOfSceneElements'] = len(scene.data)
-
-    def make_scene(self,
-                   name: str,
-                   scene_id: str,
-                   brightness: float = 100.0):
-        """Create a scene."""
-        # self.log.debug("making the light a scene")
-        self.data = {
-            'numberOfLights': 1,
-            'lights': [
-                {'on': 1,
-                 'id': scene_id,
-                 'name': name,
-                 'brightness': brightness,
-                 'numberOfSceneElements': 0,
-                 'scene': []
-                 }
-            ]
-        }
-        self.is_scene = True
-        # if you do not specify an empty scene,
-        # it might copy old scene data... annoying
-        self.scene = Scene([])
+        with self.lock:
+            self.make_color(on, hue, saturation, brightness)
+            return self.set_strip_data(self.data)
 
     def transition_start(self,
                          colors: list,
@@ -378,40 +1130,18 @@ class LightStrip:
         TODO: add ability to transition to a new scene
 
         TODO: see if scenes are callable by name
-        TODO: make asyncronous function to replace this one
 
         TODO: see if you can pick a different way to cycle between colors in a scene
         """
         # self.log.debug("---------transition starting")
-        self.make_scene(name, scene_id, 100)
-        wait_time_ms = 0
-        # check if the light has already been set to a color,
-        # and if it has, make that color the start of the transition scene
-        if current_color := self.get_strip_color():
-            _, hue, saturation, brightness = current_color
-            self.scene.add_scene(
-                hue,
-                saturation,
-                brightness,
-                colors[0][3],
-                colors[0][4])
-            wait_time_ms += colors[0][4] + colors[0][3]
-        # add the colors in the new scene
-        for color in colors:
-            hue, saturation, brightness, durationMs, transitionMs = color
-            self.scene.add_scene(
-                hue,
-                saturation,
-                brightness,
-                durationMs,
-                transitionMs)
-            wait_time_ms += durationMs + transitionMs
-        # update the light with the new scene
-        self.update_scene_data(self.scene, scene_name=name, scene_id=scene_id)
-        self.set_strip_data(self.data)
+        current_color = self.get_strip_color()
+        with self.lock:
+            wait_time = self.make_transition(
+                colors, current_color, name, scene_id)
+            # update the light with the new scene
+            self.set_strip_data(self.data)
         # return the wait time
-        return (wait_time_ms - colors[-1][3] - colors[-1][4]) / 1000
-        
+        return wait_time
 
     def transition_end(self,
                        end_scene: list,
@@ -425,82 +1155,314 @@ class LightStrip:
         almost identical to lightStrip.update_color - primarily used to keep code readable
         """
         # self.log.debug("--------transition ending")
-        assert type(end_scene) is list, f"TypeError: {end_scene} is type: {type(end_scene)} not type: list"
-        # self.log.debug(f"scene passed into transition_end: {end_scene}")
-        if not end_scene:  # TODO: make this cleaner
-            # self.log.debug("missing end scene, using scene name")
-            self.update_scene_data(None, scene_name=end_scene_name, scene_id=end_scene_id)
-            return self.set_strip_data(self.data)
-        elif len(end_scene) == 1:
-            # self.log.debug("setting light to single color")
-            hue, saturation, brightness, _, _ = end_scene[0]
-            is_on = 1 if brightness > 0 else 0
-            return self.update_color(is_on, hue, saturation, brightness)
-        else:
-            # the end scene is an actual scene
-            # TODO: make scene brightness variable
-            # self.log.debug("setting transition to end on a scene")
-            self.make_scene(end_scene_name, end_scene_id, 100)
-            self.scene = Scene([])
-            for item in end_scene:
-                hue, saturation, brightness, durationMs, transitionMs = item
-                self.scene.add_scene(
-                    hue, saturation, brightness, durationMs, transitionMs)
-            self.update_scene_data(
-                self.scene, scene_name=end_scene_name, scene_id=end_scene_id)
+        with self.lock:
+            self.make_end_scene(end_scene, end_scene_name, end_scene_id)
             return self.set_strip_data(self.data)
 
+    def send_compiled(self, data: dict, body: str, is_scene: bool) -> bool:
+        """Send compiled `data`, see CompiledTransition."""
+        with self.lock:
+            body = self.stage_compiled(data, body)
+            if body is not None and not self.put_strip_body(data, body):
+                return False
+            self._is_scene = is_scene
+            return True
+
+    def start_compiled(self, transition: CompiledTransition) -> float:
+        """Start a compiled transition, returns how long to wait."""
+        with tracing.span('light.start', light=self.name):
+            data, body, wait_time = transition.start(self.get_strip_color())
+            self.send_compiled(data, body, True)
+            return wait_time
+
+    def end_compiled(self, transition: CompiledTransition) -> bool:
+        """End a compiled transition."""
+        with tracing.span('light.end', light=self.name):
+            return self.send_compiled(
+                transition.end_data, transition.end_body, transition.end_is_scene)
+
+def admit_light(addr, port, name="", session=None, max_state_age: float = 60.0):
+    """
+    Return a LightStrip for the address if it is a light strip.
+
+    Returns None for other Elgato products and lights that do not answer
+    """
+    try:
+        prospect_light = LightStrip(addr, port, name, session, max_state_age)
+        if 'Strip' in prospect_light.info['productName']:
+            logging.getLogger(__name__).info(f"Found new light strip: {prospect_light.info['displayName']}")
+            return prospect_light
+    except Exception as e:
+        logging.getLogger(__name__).debug(f"Failed to connect to light... skipping\n{e}")
+    return None
+
+
+def admit_service(name: str, info, session=None,
+                  max_state_age: float = 60.0):
+    """
+    Return a LightStrip for a zeroconf service.
+
+    A service can have several addresses that all reach the same light,
+    they are tried in order and the first one that answers is used.
+    Returns None if the service is not a light strip
+    """
+    for addr, port, _ in service_candidates(name, info):
+        if light := admit_light(addr, port, name, session, max_state_age):
+            return light
+    return None
+
+
+def admit_services(services: list, session=None, max_state_age: float = 60.0,
+                   max_workers: int = 16, pool: WorkerPool = None) -> list:
+    """
+    Initialize a light for every (name, info) service concurrently.
+
+        pool: WorkerPool to run on, a temporary pool is used if not given
+
+    Returns the light strips in the same order as the services
+    """
+    if not services:
+        return []
+    admit = lambda service: admit_service(*service, session, max_state_age)
+    if pool is not None:
+        lights = pool.map(admit, services)
+        return [light for light in lights if light is not None]
+    with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(services))) as executor:
+        lights = executor.map(admit, services)
+        return [light for light in lights if light is not None]
+
+
+def service_candidates(name: str, info) -> list:
+    """Return (addr, port, name) for every IPv4 address of a zeroconf service."""
+    candidates = []
+    for addr in info.addresses:
+        try:
+            candidates.append((socket.inet_ntoa(addr), info.port, name))
+        except OSError:
+            # not an IPv4 address
+            pass
+    return candidates
+
+
+class StateReconciler:
+    """
+    Keep the cached state of a room's lights fresh in the background.
+
+    Every `interval` seconds all lights are polled concurrently on the
+    room's worker pool, which also picks up changes made from the Elgato app.
+    """
+
+    def __init__(self, room, interval: float = 30.0):
+        """Init the reconciler."""
+        self.log = logging.getLogger(__name__)
+        self.room = room
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def reconcile(self) -> int:
+        """Refresh every light once, returns how many changed outside the controller."""
+        lights = self.room.available_lights()
+        if not lights:
+            return 0
+        with self.room.policy.deadline():
+            changed = sum(self.room.pool.map(LightStrip.refresh_state, lights))
+        if changed:
+            self.log.info(f"{changed} lights were changed outside the controller")
+        return changed
+
+    def run(self):
+        """Reconcile until stopped."""
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.reconcile()
+            except Exception as e:
+                self.log.error(f"Failed to reconcile light state: {e}")
+
+    def start(self):
+        """Start reconciling in a background thread."""
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="state-reconciler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class HealthChecker:
+    """
+    Find lights that stopped answering long before zeroconf notices.
+
+    Every light is probed once per `interval` seconds with a cheap get
+    request, the probes are spread evenly over the interval and run on the
+    room's worker pool. After `failure_threshold` failed probes in a row a
+    light is marked unavailable and left out of everything the room fans
+    out to, the first probe it answers brings it back.
+    """
+
+    def __init__(self, room, interval: float = 10.0, failure_threshold: int = 3,
+                 timeout: float = 1.0):
+        """
+        Init the checker.
+
+            timeout: seconds a light has to answer a probe
+        """
+        self.log = logging.getLogger(__name__)
+        self.room = room
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # consecutive failed probes and probes in flight, by light
+        self.failures = dict()
+        self.pending = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def check(self, light: LightStrip) -> bool:
+        """Probe one light and update its availability, returns True if it answered."""
+        try:
+            answered = light.probe(self.timeout)
+        finally:
+            with self.lock:
+                self.pending.discard(light)
+        with self.lock:
+            if answered:
+                self.failures.pop(light, None)
+            else:
+                self.failures[light] = self.failures.get(light, 0) + 1
+            failures = self.failures.get(light, 0)
+        if answered and not light.available:
+            self.room.mark_available(light)
+        elif failures >= self.failure_threshold and light.available:
+            self.room.mark_unavailable(light, failures)
+        return answered
+
+    def submit(self, light: LightStrip):
+        """Probe a light on the worker pool unless its last probe is still running."""
+        with self.lock:
+            if light in self.pending:
+                return
+            self.pending.add(light)
+        try:
+            self.room.pool.submit(self.check, light)
+        except RuntimeError:
+            # the pool is shutting down
+            with self.lock:
+                self.pending.discard(light)
+
+    def run(self):
+        """Probe every light once per interval until stopped."""
+        while not self.stop_event.is_set():
+            lights = list(self.room.lights)
+            with self.lock:
+                # forget lights that left the room
+                self.failures = {light: count for light, count in self.failures.items()
+                                 if light in lights}
+            if not lights:
+                self.stop_event.wait(self.interval)
+                continue
+            gap = self.interval / len(lights)
+            for light in lights:
+                if self.stop_event.wait(gap):
+                    return
+                self.submit(light)
+
+    def start(self):
+        """Start probing in a background thread."""
+        self.stop_event.clear()
+        self.thread = threading.Thread(
+            target=self.run, name="health-checker", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
 
 class Room:
     """Collection of lights that are on the same network."""
 
-    def __init__(self, lights: list=[]):
-        """Init the room."""
+    def __init__(self, lights: list=[], max_state_age: float = 60.0,
+                 light_cache=None, max_workers: int = 16, recorder=None,
+                 policy: RequestPolicy = None):
+        """
+        Init the room.
+
+            max_state_age: seconds a light's cached state is trusted,
+            see LightStrip.get_strip_color
+            light_cache: LightCache used to start with the lights from the
+            last run and kept up to date with what discovery finds
+            max_workers: size of the worker pool every fan-out shares
+            recorder: recorder.TrafficRecorder for every request to the lights
+            policy: resilience.RequestPolicy for the timeouts, retries,
+            circuit breakers and the deadline of every room operation
+        """
         if not lights:
             lights = []
         if not isinstance(lights, list):
             raise ValueError(f"TypeError: {lights} is type: {type(lights)} not type: list")
         self.lights: list[LightStrip] = lights
+        # only touched by the room's thread, zeroconf events go through the queue
         self.service_dict = dict()
+        self.service_events = queue.Queue()
+        self.session = LightSession(recorder=recorder, policy=policy)
+        self.policy = self.session.policy
+        self.max_state_age = max_state_age
+        self.reconciler = None
+        self.health_checker = None
+        self.pool = WorkerPool(max_workers)
+        # event loop thread and session of room_transition_async, started on
+        # first use so keep-alive connections outlive a single transition
+        self.async_lock = threading.Lock()
+        self.async_loop = None
+        self.async_thread = None
+        self.async_session = None
+        self.light_cache = light_cache
+        # cached lights that discovery has not confirmed yet
+        self.unconfirmed = set()
+        self.unconfirmed_deadline = 0
         self.log = logging.getLogger(__name__)
     
-    def find_light_strips_zeroconf(service_type='_elg._tcp.local.', TIMEOUT=15):
+    def find_light_strips_zeroconf(service_type='_elg._tcp.local.', TIMEOUT=15,
+                                   expected_lights: int = None):
         """
         Use multicast to find all elgato light strips.
 
             Parameters:
                 the service type to search
-                the timeout period to wait until you stop searching
+                the longest time to wait until you stop searching
+                how many lights to expect, the search stops once they are found
         """
-        # NOTE: need to put this in a try/except statement
-        # just in case they have not imported zeroconf
+        room = Room()
         try:
-            import zeroconf
-        except ImportError:
-            raise ImportError("Please install zeroconf to use this method. You can install it using: pip install zeroconf")
-    
-        zc = zeroconf.Zeroconf()
-        service_dict = dict()
-        listener = LightServiceListener(service_dict)
-        browser = zeroconf.ServiceBrowser(zc, service_type, listener)
-        sleep(TIMEOUT)
-        browser.cancel()
-        new_lights = []
-        for name, info in listener.get_active_lights().items():
-            for addr in info.addresses:
-                try:
-                    prospect_light = LightStrip(socket.inet_ntoa(addr), info.port, name)
-                    if 'Strip' in prospect_light.info['productName']:
-                        new_lights.append(prospect_light)
-                        logging.getLogger(__name__).info(f"Found new light strip: {prospect_light.info['displayName']}")
-                except Exception as e:
-                    logging.getLogger(__name__).error(f"Failed to connect to light: {e}")
-        return new_lights
-        
+            room.start_rolling_admission_zeroconf(
+                service_type, TIMEOUT, expected_lights)
+        finally:
+            # stops discovery and the room's worker pool
+            room.close()
+        return room.lights
 
     def start_rolling_admission_zeroconf( 
-            self, service_type='_elg._tcp.local.', timeout=15):
-        """Start a rolling admission for Zeroconf."""
+            self, service_type='_elg._tcp.local.', timeout=15,
+            expected_lights: int = None, settle: float = 0.5):
+        """
+        Start a rolling admission for Zeroconf.
+
+        Returns once `expected_lights` lights have been admitted, or if the
+        number of lights is not known, once at least one light was admitted
+        and no services showed up for `settle` seconds.
+        Gives up after `timeout` seconds.
+        """
         try:
             import zeroconf
         except ImportError:
@@ -509,9 +1471,41 @@ class Room:
         self.log.info("Starting rolling admission for Zeroconf")
         self.zeroconf = zeroconf.Zeroconf()
         self.service_type = service_type
-        self.listener = LightServiceListener(self.service_dict)
-        self.browser = zeroconf.ServiceBrowser(self.zeroconf, self.service_type, self.listener)
-        sleep(timeout)
+        self.listener = LightServiceListener(self.service_events)
+        # ask for unicast (QU) answers so the lights reply right away
+        # instead of waiting for their next multicast announcement
+        self.browser = zeroconf.ServiceBrowser(
+            self.zeroconf, self.service_type, self.listener,
+            question_type=zeroconf.DNSQuestionType.QU)
+        return self.wait_for_lights(expected_lights, timeout, settle)
+
+    def wait_for_lights(self, expected_lights: int = None, timeout: float = 15,
+                        settle: float = 0.5) -> bool:
+        """
+        Admit lights as their services show up.
+
+        See start_rolling_admission_zeroconf.
+        Returns True if the expected number of lights was found, or without
+        `expected_lights`, if any light was found
+        """
+        deadline = monotonic() + timeout
+        while True:
+            if expected_lights and len(self.lights) >= expected_lights:
+                self.log.info(f"Found all {expected_lights} expected lights")
+                return True
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            wait_time = remaining
+            if not expected_lights and self.lights:
+                wait_time = min(remaining, settle)
+            if not self.apply_service_events(wait_time) and wait_time < remaining:
+                # nothing new within the settle time
+                break
+        if expected_lights:
+            self.log.warning(f"Only found {len(self.lights)} of {expected_lights} expected lights")
+            return False
+        return bool(self.lights)
 
     def stop_rolling_admission_zeroconf(self):
         """Stop the rolling admission for Zeroconf."""
@@ -522,73 +1516,235 @@ class Room:
         else:
             self.log.warning("No active rolling admission to stop")
 
+    def load_cached_lights(self, confirm_timeout: float = 300) -> int:
+        """
+        Add the lights from the light cache without talking to them.
+
+        The lights can be commanded right away, discovery confirms them in
+        the background. Lights that are not confirmed within
+        `confirm_timeout` seconds are dropped (see apply_service_events).
+        Returns the number of lights added
+        """
+        if self.light_cache is None:
+            return 0
+        names = set(light.name for light in self.lights)
+        cached_lights = []
+        for name, entry in self.light_cache.entries().items():
+            if name in names:
+                continue
+            light = LightStrip(entry['addr'], entry['port'], name, self.session,
+                               self.max_state_age, info=entry['info'])
+            if entry.get('settings'):
+                light.settings = entry['settings']
+            cached_lights.append(light)
+            self.log.info(f"Using cached light strip: {light.info.get('displayName', name)}")
+        self.lights = self.lights + cached_lights
+        metrics.ROOM_LIGHTS.set(len(self.lights))
+        self.unconfirmed |= set(light.name for light in cached_lights)
+        self.unconfirmed_deadline = monotonic() + confirm_timeout
+        return len(cached_lights)
+
+    def update_light_cache(self, removed=()):
+        """Write the room's lights to the light cache."""
+        if self.light_cache is None:
+            return
+        for name in removed:
+            self.light_cache.remove(name)
+        for light in self.lights:
+            if light.name not in self.unconfirmed:
+                self.light_cache.store(light)
+        self.light_cache.save()
+
     def add_a_new_light(self, name: str, info):
         """Add a new light to the list."""
-        new_lights = []
-        for addr in info.addresses:
-            try:
-                prospect_light = LightStrip(socket.inet_ntoa(addr), info.port, name)
-                if 'Strip' in prospect_light.info['productName']:
-                    new_lights.append(prospect_light)
-                    self.log.info(f"Found new light strip: {prospect_light.info['displayName']}")
-            except Exception as e:
-                self.log.debug(f"Failed to connect to light... skipping\n{e}")
-        self.lights.extend(new_lights)
+        if light := admit_service(name, info, self.session, self.max_state_age):
+            self.lights = self.lights + [light]
+
+    def apply_service_events(self, timeout: float = None) -> bool:
+        """
+        Apply the queued zeroconf events to the room.
+
+        With a timeout, waits up to `timeout` seconds for an event.
+
+        Only the lights that changed are touched: new services are admitted
+        (concurrently), lights whose address changed are rebound and lights
+        whose service left are removed.
+        Returns True if the room changed
+        """
+        events = drain_service_events(self.service_events, timeout)
+        expired = self.drop_unconfirmed_lights()
+        if not events:
+            if expired:
+                self.update_light_cache(expired)
+            return bool(expired)
+        # only the last event for each service matters
+        latest = dict()
+        for event, name, info in events:
+            metrics.DISCOVERY_EVENTS.inc(event=event)
+            latest[name] = (event, info)
+
+        lights = {light.name: light for light in self.lights}
+        removed = set()
+        rebound = False
+        new_services = []
+        for name, (event, info) in latest.items():
+            if event == 'remove':
+                self.service_dict.pop(name, None)
+                if name in lights:
+                    removed.add(name)
+                continue
+            self.service_dict[name] = info
+            self.unconfirmed.discard(name)
+            if name not in lights:
+                new_services.append((name, info))
+                continue
+            light = lights[name]
+            candidates = service_candidates(name, info)
+            if candidates and (light.addr, light.port) not in (
+                    (addr, port) for addr, port, _ in candidates):
+                light.rebind(candidates[0][0], candidates[0][1])
+                metrics.DISCOVERY_EVENTS.inc(event='rebind')
+                rebound = True
+
+        if removed:
+            self.log.info("Cleaning up inactive services %s", removed)
+        new_lights = admit_services(
+            new_services, self.session, self.max_state_age, pool=self.pool)
+        self.lights = [light for light in self.lights
+                       if light.name not in removed] + new_lights
+        metrics.ROOM_LIGHTS.set(len(self.lights))
+        self.update_light_cache(removed | expired)
+        return bool(removed or new_lights or rebound or expired)
+
+    def drop_unconfirmed_lights(self) -> set:
+        """Remove cached lights discovery did not confirm in time, returns their names."""
+        if not self.unconfirmed or monotonic() < self.unconfirmed_deadline:
+            return set()
+        expired = self.unconfirmed
+        self.unconfirmed = set()
+        self.log.warning(f"Cached lights were not found on the network: {expired}")
+        metrics.DISCOVERY_EVENTS.inc(len(expired), event='expired')
+        self.lights = [light for light in self.lights if light.name not in expired]
+        metrics.ROOM_LIGHTS.set(len(self.lights))
+        return expired
+
+    def available_lights(self) -> list:
+        """Return the lights that answer their health checks, every fan-out goes to these."""
+        return [light for light in self.lights if light.available]
+
+    def mark_unavailable(self, light: LightStrip, failures: int = 0):
+        """Leave a light out of the room's fan-out until it answers again."""
+        light.available = False
+        self.log.warning(f"{light.name or light.full_addr} failed {failures} health checks, "
+                         "leaving it out until it answers")
+        metrics.UNAVAILABLE_LIGHTS.set(len(self.lights) - len(self.available_lights()))
+
+    def mark_available(self, light: LightStrip):
+        """
+        Take a light that answers again back into the room's fan-out.
+
+        The light was most likely power-cycled, so its cached state is
+        dropped and the next transition reads its real color.
+        """
+        with light.lock:
+            light.acknowledged = None
+            light.state_time = None
+        light.available = True
+        self.log.info(f"{light.name or light.full_addr} is answering again")
+        metrics.UNAVAILABLE_LIGHTS.set(len(self.lights) - len(self.available_lights()))
 
     def check_for_new_lights(self):
         """Check for new lights and add them to the list."""
-        new_lights = []
         self.log.info("Checking for new lights")
-        for name, info in self.service_dict.items():
-            for addr in info.addresses:
-                try:
-                    prospect_light = LightStrip(socket.inet_ntoa(addr), info.port, name)
-                    if 'Strip' in prospect_light.info['productName']:
-                        new_lights.append(prospect_light)
-                        self.log.info(f"Found new light strip: {prospect_light.info['displayName']}")
-                except Exception as e:
-                    self.log.debug(f"Failed to connect to light... skipping\n{e}")
-        self.lights = new_lights
+        self.apply_service_events()
         return True
 
     def cleanup_inactive_services(self):
         """Remove inactive services from the list of lights."""
-        active_lights = set(self.service_dict.keys())
-        # if we have new lights, add them to self.lights
-        if active_lights - set(light.name for light in self.lights):
-            self.log.info("Found new lights, checking for them")
-            for name in active_lights - set(light.name for light in self.lights):
-                self.add_a_new_light(name, self.service_dict[name])
-        inactive_lights = set(light.name for light in self.lights if light.name not in active_lights)
-        if inactive_lights: 
-            self.log.info("Cleaning up inactive services %s", inactive_lights)
-            self.lights = [light for light in self.lights if light.name in active_lights]
-
-    def setup(self, service_type='_elg._tcp.local.'):
-        """Find all the lights."""
+        return self.apply_service_events()
+
+    def start_reconciler(self, interval: float = 30.0):
+        """Keep the lights' cached state fresh in the background."""
+        if self.reconciler is None:
+            self.reconciler = StateReconciler(self, interval)
+            self.reconciler.start()
+
+    def stop_reconciler(self):
+        """Stop the background reconciler."""
+        if self.reconciler is not None:
+            self.reconciler.stop()
+            self.reconciler = None
+
+    def start_health_checker(self, interval: float = 10.0,
+                             failure_threshold: int = 3, timeout: float = 1.0):
+        """Probe the lights in the background, see HealthChecker."""
+        if self.health_checker is None:
+            self.health_checker = HealthChecker(
+                self, interval, failure_threshold, timeout)
+            self.health_checker.start()
+
+    def stop_health_checker(self):
+        """Stop the background health checks."""
+        if self.health_checker is not None:
+            self.health_checker.stop()
+            self.health_checker = None
+
+    def close(self):
+        """Stop discovery and background work, then release the pool and connections."""
+        self.stop_reconciler()
+        self.stop_health_checker()
+        if hasattr(self, 'browser'):
+            self.stop_rolling_admission_zeroconf()
+        self.stop_async_engine()
+        self.pool.shutdown()
+        self.session.close()
+
+    def setup(self, service_type='_elg._tcp.local.', expected_lights: int = None,
+              timeout: float = 15):
+        """
+        Find all the lights.
+
+        Returns as soon as `expected_lights` lights were found,
+        see start_rolling_admission_zeroconf
+        """
         self.log.info("Setting up room")
-        self.start_rolling_admission_zeroconf(service_type=service_type)
+        self.load_cached_lights()
+        self.start_rolling_admission_zeroconf(
+            service_type=service_type, timeout=timeout,
+            expected_lights=expected_lights)
         self.check_for_new_lights()
         return True if self.lights else False
 
-    def room_color(self, on, hue, saturation, brightness):
-        """Set color for the whole room."""
+    def write_stats(self) -> dict:
+        """Return the write counters of every light added up."""
+        stats = {'suppressed': 0, 'partial': 0}
         for light in self.lights:
-            light.update_color(on, hue, saturation, brightness)
+            for key, value in light.write_stats().items():
+                stats[key] += value
+        return stats
+
+    def room_color(self, on, hue, saturation, brightness) -> bool:
+        """Set color for the whole room using the worker pool."""
+        with self.policy.deadline():
+            results = self.pool.map(
+                lambda light: light.update_color(on, hue, saturation, brightness),
+                self.available_lights())
+        return all(results)
 
     def room_scene(self, scene: Scene):
-        """Set all lights in the room to a specific scene using a thread pool."""
+        """Set all lights in the room to a specific scene using the worker pool."""
         def update_light_scene(light: LightStrip):
-            light.update_scene_data(scene.copy())
-            return light.set_strip_data(light.data)
-        
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(update_light_scene, light) for light in self.lights]
-            
-            results = []
-            for future in as_completed(futures):
-                results.append(future.result())
-        
+            try:
+                with light.lock:
+                    # every light gets its own copy of the scene
+                    light.update_scene_data(Scene(scene.data))
+                    return light.set_strip_data(light.data)
+            except Exception as e:
+                self.log.warning(f"Failed to set the scene of {light.name or light.full_addr}: {e}")
+                return False
+
+        with self.policy.deadline():
+            results = self.pool.map(update_light_scene, self.available_lights())
         # Check if all updates were successful
         return all(results)
     
@@ -600,31 +1756,247 @@ class Room:
                                  end_scene_name="end-scene",
                                  end_scene_id="end-scene-id") -> tuple[str]:
         """
-        Non-blocking transition for all room lights using a thread pool.
+        Non-blocking transition for all room lights using the worker pool.
 
+        Workers only send the requests, waiting for the transitions to end
+        happens here so a long scene does not hold a worker per light.
+        `colors` can be a CompiledTransition, the end scene arguments are
+        ignored then.
         Returns tuple of successful names
         """
         if not colors:
             self.log.warning("Cannot transition an empty scene")
             return False
+        transition = compile_transition(
+            colors, end_scene, name, scene_id, end_scene_name, end_scene_id)
+        metrics.TRANSITIONS.inc(mode='threaded')
 
-        def process_light_transition(light: LightStrip):
+        def start_light_transition(light: LightStrip) -> float:
             assert type(light) is LightStrip, f"TypeError: {light} is type: {type(light)} not type: LightStrip"
-            sleep_time = light.transition_start(colors.copy(), name, scene_id)
+            sleep_time = light.start_compiled(transition)
             self.log.info(f"Sleep time: {sleep_time}")
-            sleep(sleep_time)
-            transition_status = light.transition_end(end_scene, end_scene_name, end_scene_id)
-            return transition_status
-
-        with ThreadPoolExecutor() as executor:
-            futures = [executor.submit(process_light_transition, light) for light in self.lights]
-            
-            results = []
-            for future in as_completed(futures):
-                results.append(future.result())
-        successful_lights = [light.name for light, result in zip(self.lights, results) if result]
+            return monotonic() + sleep_time
+
+        lights = self.available_lights()
+        with tracing.span('room.transition', mode='threaded', lights=len(lights)):
+            with self.policy.deadline():
+                end_times = self.pool.map(start_light_transition, lights)
+            deadlines = [(end_time, index, light) for index, (end_time, light)
+                         in enumerate(zip(end_times, lights))]
+            heapq.heapify(deadlines)
+            futures = [None] * len(lights)
+            while deadlines:
+                end_time, index, light = heapq.heappop(deadlines)
+                remaining = end_time - monotonic()
+                if remaining > 0:
+                    with tracing.span('room.wait', seconds=remaining):
+                        sleep(remaining)
+                # the worker runs under the deadline set here
+                with self.policy.deadline():
+                    futures[index] = self.pool.submit(light.end_compiled, transition)
+            successful_lights = [light.name for light, future in zip(lights, futures)
+                                 if future.result()]
         return tuple(successful_lights)
 
+    def room_transition_synchronized(self,
+                                     colors: list,
+                                     name='transition-scene',
+                                     scene_id='transition-scene-id',
+                                     end_scene: list = [],
+                                     end_scene_name="end-scene",
+                                     end_scene_id="end-scene-id",
+                                     lead: float = 0.05) -> tuple[str]:
+        """
+        Transition all room lights so they change at the same moment.
+
+        Every light's start color is read and its request body is built
+        first, then all the put requests are released together `lead`
+        seconds later (see release_staged). The end scenes are staged
+        and released the same way once the transitions are due.
+        The spread of the send times is logged for every release.
+        `colors` can be a CompiledTransition, the end scene arguments are
+        ignored then.
+        Returns tuple of successful names
+        """
+        if not colors:
+            self.log.warning("Cannot transition an empty scene")
+            return False
+        transition = compile_transition(
+            colors, end_scene, name, scene_id, end_scene_name, end_scene_id)
+        metrics.TRANSITIONS.inc(mode='synchronized')
+        lights = self.available_lights()
+        if len(lights) > self.pool.max_workers:
+            self.log.warning(f"{len(lights)} lights but only {self.pool.max_workers} workers, "
+                             "the releases will be spread out")
+
+        def stage_start(light: LightStrip):
+            data, body, wait_time = transition.start(
+                light.get_strip_color(max_age=0))
+            with light.lock:
+                return (light, data, light.stage_compiled(data, body), wait_time)
+
+        def stage_end(light: LightStrip):
+            with light.lock:
+                return (light, transition.end_data, light.stage_compiled(
+                    transition.end_data, transition.end_body), 0)
+
+        with tracing.span('room.transition', mode='synchronized', lights=len(lights)):
+            with self.policy.deadline():
+                staged = self.pool.map(stage_start, lights)
+                start_at = monotonic() + lead
+                started = self.release_staged(staged, start_at, "start")
+            # lights that were not on a color before have a shorter transition
+            end_groups = dict()
+            for light, _, _, wait_time in staged:
+                end_groups.setdefault(wait_time, []).append(light)
+            ended = dict()
+            for wait_time in sorted(end_groups):
+                end_at = start_at + wait_time
+                with tracing.span('room.wait', seconds=end_at - lead - monotonic()):
+                    wait_until(end_at - lead)
+                with self.policy.deadline():
+                    staged_ends = self.pool.map(stage_end, end_groups[wait_time])
+                    ended.update(zip(
+                        end_groups[wait_time],
+                        self.release_staged(staged_ends, max(end_at, monotonic()), "end")))
+        successful_lights = [light.name for light, result in zip(lights, started)
+                             if result and ended[light]]
+        return tuple(successful_lights)
+
+    def release_staged(self, staged: list, release_at: float, label="") -> list:
+        """
+        Send staged (light, data, body, _) requests together at `release_at`.
+
+        Connections are opened on the worker pool first, then this thread
+        writes every request back to back, so the skew is a socket write per
+        light rather than a thread wakeup and a full HTTP client call.
+        Logs the spread between the first and last send.
+        Returns whether each request succeeded
+        """
+        def stage(item):
+            light, data, body, _ = item
+            if body is None:
+                # the light is already in that state
+                return None
+            return StagedPut(light, data, body)
+
+        puts = self.pool.map(stage, staged)
+        wait_until(release_at)
+        with tracing.span('room.release', label=label) as span:
+            for put in puts:
+                if put is not None:
+                    put.send()
+            send_times = [put.light.send_time for put in puts
+                          if put is not None and put.sent]
+            span.set(lights=len(send_times))
+        if send_times:
+            self.log.info(
+                f"Released {label} to {len(send_times)} lights: "
+                f"skew {(max(send_times) - min(send_times)) * 1000:.2f}ms, "
+                f"first send {(min(send_times) - release_at) * 1000:.2f}ms after target")
+        return self.pool.map(
+            lambda put: True if put is None else put.finish(), puts)
+
+    def start_async_engine(self):
+        """Start the event loop thread and session room_transition_async runs on."""
+        from asyncLightStripLib import AsyncLightSession
+
+        with self.async_lock:
+            if self.async_loop is None:
+                self.async_loop = asyncio.new_event_loop()
+                self.async_session = AsyncLightSession(
+                    self.session.recorder, self.session.policy)
+                self.async_thread = threading.Thread(
+                    target=self.async_loop.run_forever,
+                    name="room-async", daemon=True)
+                self.async_thread.start()
+            return self.async_loop
+
+    def run_async(self, coroutine):
+        """
+        Run `coroutine` on the room's event loop and wait for its result.
+
+        The coroutine runs in a copy of the caller's context, so the
+        deadline and tracing spans carry over like with asyncio.run.
+        """
+        loop = self.start_async_engine()
+        result = concurrent.futures.Future()
+
+        def copy_result(task):
+            if task.cancelled():
+                result.cancel()
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                result.set_result(task.result())
+
+        def start():
+            loop.create_task(coroutine).add_done_callback(copy_result)
+
+        loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+        return result.result()
+
+    def stop_async_engine(self):
+        """Close the async session's connections and stop its event loop."""
+        with self.async_lock:
+            loop, self.async_loop = self.async_loop, None
+            thread, self.async_thread = self.async_thread, None
+            session, self.async_session = self.async_session, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+        except Exception as e:
+            self.log.debug(f"Failed to close the async session: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    def room_transition_async(self,
+                              colors: list,
+                              name='transition-scene',
+                              scene_id='transition-scene-id',
+                              end_scene: list = [],
+                              end_scene_name="end-scene",
+                              end_scene_id="end-scene-id") -> tuple[str]:
+        """
+        Transition all room lights from the room's asyncio event loop.
+
+        Drop-in replacement for room_transition_threaded that does not hold
+        a thread per light, see asyncLightStripLib.AsyncRoom.
+        `colors` can be a CompiledTransition.
+        Returns tuple of successful names
+        """
+        from asyncLightStripLib import AsyncRoom
+
+        metrics.TRANSITIONS.inc(mode='async')
+        lights = self.available_lights()
+        self.start_async_engine()
+        # the lights are wrapped per call, the session and its connections are kept
+        async_room = AsyncRoom.from_room(self, lights, self.async_session)
+
+        with tracing.span('room.transition', mode='async', lights=len(async_room.lights)):
+            successful_lights = self.run_async(async_room.room_transition(
+                colors, name, scene_id,
+                end_scene, end_scene_name, end_scene_id))
+        # keep the synchronous lights in step with what was sent
+        for light, async_light in zip(lights, async_room.lights):
+            light.suppressed_writes = async_light.suppressed_writes
+            light.partial_writes = async_light.partial_writes
+            # nothing came back from a light that did not answer,
+            # and its async copy may not hold any data at all
+            if not async_light.data or async_light.state_time == light.state_time:
+                continue
+            with light.lock:
+                light.data = async_light.data
+                light.acknowledged = async_light.acknowledged
+                light.state_time = async_light.state_time
+                try:
+                    light.check_scene()
+                except (KeyError, IndexError, TypeError):
+                    pass
+        return successful_lights
+
     def room_transition(self,
                         colors: list,
                         name='transition-scene',
@@ -635,38 +2007,56 @@ class Room:
         """
         Non blocking transition for all room lights.
 
+        `colors` can be a CompiledTransition
         TODO: return status of https request
         """
-        rescan = False
         if not colors:
             self.log.warning("cannot transition an empty scene")
             return
+        transition = compile_transition(
+            colors, end_scene, name, scene_id, end_scene_name, end_scene_id)
+        metrics.TRANSITIONS.inc(mode='heap')
+
+        lights = self.available_lights()
+        with tracing.span('room.transition', mode='heap', lights=len(lights)):
+            deadlines = []
+            for index, light in enumerate(lights):
+                # the lights are started one after another,
+                # so each one gets its own deadline
+                with self.policy.deadline():
+                    sleep_time = light.start_compiled(transition)
+                # index breaks ties so lights never get compared
+                heapq.heappush(deadlines, (monotonic() + sleep_time, index, light))
+            rescan = not self.end_transitions(deadlines, transition)
 
-        times = []
-        for light in self.lights:
-            times.append((
-                light,
-                light.transition_start(colors, name, scene_id),
-                time()))
-        while times:
-            # TODO: check if this can be optimized to use less
-            light, sleep_time, start_time = times.pop(0)
-            self.log.debug(f"Processing light: {light}, sleep_time: {sleep_time}, start_time: {start_time}")
-            
-            if sleep_time + start_time < time():
-                transition_status = light.transition_end(
-                    end_scene, end_scene_name, end_scene_id)
-                self.log.info(f"Transition status: {transition_status}")
-                rescan = rescan or not transition_status
-                self.log.debug(f"Rescan status: {rescan}")
-            else:
-                times.append((light, sleep_time, start_time))
-        
         if rescan:
             self.log.warning("A light failed to transition, rescan recommended")
             #self.setup()
         return not rescan
 
+    def end_transitions(self,
+                        deadlines: list,
+                        transition: CompiledTransition) -> bool:
+        """
+        End every transition in `deadlines` once it is due.
+
+        `deadlines` is a heap of (monotonic end time, index, light),
+        the loop sleeps until the next light is due instead of spinning.
+        Returns True if every light ended its transition
+        """
+        success = True
+        while deadlines:
+            end_time, _, light = heapq.heappop(deadlines)
+            remaining = end_time - monotonic()
+            if remaining > 0:
+                with tracing.span('room.wait', seconds=remaining):
+                    sleep(remaining)
+            with self.policy.deadline():
+                transition_status = light.end_compiled(transition)
+            self.log.info(f"Transition status: {transition_status}")
+            success = success and transition_status
+        return success
+
     def light_transition(self,
                          addr: str,
                          colors: list,
@@ -676,28 +2066,20 @@ class Room:
                          end_scene_name="end-scene",
                          end_scene_id="end-scene-id"):
         """Non blocking transition for specific light in the room."""
-        rescan = False
         if not colors:
             self.log.warning("cannot transition an empty scene")
             return
         if not end_scene:
-            end_scene = colors[-1]
-        times = []
-        for light in self.lights:
+            end_scene = [colors[-1]]
+        transition = compile_transition(
+            colors, end_scene, name, scene_id, end_scene_name, end_scene_id)
+        deadlines = []
+        for index, light in enumerate(self.available_lights()):
             if light.addr == addr:
-                times.append((
-                    light,
-                    light.transition_start(colors, name, scene_id),
-                    time()))
-
-        while times:
-            light, transition_start_output, start_time = times.pop(0)
-            sleep_time, success = transition_start_output
-            if sleep_time + start_time < time():
-                rescan = rescan or light.transition_end(
-                        end_scene, end_scene_name, end_scene_id)
-            else:
-                times.append((light, sleep_time, start_time))
-
-        return
+                with self.policy.deadline():
+                    sleep_time = light.start_compiled(transition)
+                heapq.heappush(
+                    deadlines, (monotonic() + sleep_time, index, light))
+        rescan = not self.end_transitions(deadlines, transition)
 
+        return not rescan
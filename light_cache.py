@@ -0,0 +1,85 @@
+"""
+On-disk cache of the lights found on the network.
+
+Keeps the address, port, accessory info (productName, displayName,
+serialNumber, ...) and settings of every admitted light keyed by its
+zeroconf service name, so a restarted controller can command the lights
+right away instead of waiting for discovery.
+"""
+
+import json
+import logging
+import os
+from time import time
+
+
+class LightCache:
+    """Persistent cache of admitted lights."""
+
+    def __init__(self, filename: str, ttl: float = 7 * 24 * 60 * 60):
+        """
+        Init the cache and load it from `filename`.
+
+            ttl: seconds an entry is trusted after the light was last seen
+        """
+        self.log = logging.getLogger(__name__)
+        self.filename = filename
+        self.ttl = ttl
+        self.lights = dict()
+        self.load()
+
+    def load(self):
+        """Read the cache file, expired or malformed entries are dropped."""
+        try:
+            with open(self.filename, 'r') as cache_file:
+                lights = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.log.warning(f"Failed to read light cache {self.filename}: {e}")
+            return
+        now = time()
+        for name, entry in lights.items():
+            try:
+                if now - entry['seen'] > self.ttl:
+                    self.log.info(f"Cached light {name} expired")
+                    continue
+                if not (entry['addr'] and entry['port'] and entry['info']):
+                    continue
+            except (KeyError, TypeError):
+                continue
+            self.lights[name] = entry
+
+    def save(self):
+        """Write the cache file atomically."""
+        temp_file = self.filename + '.tmp'
+        try:
+            with open(temp_file, 'w') as cache_file:
+                json.dump(self.lights, cache_file, indent=2)
+            os.replace(temp_file, self.filename)
+        except OSError as e:
+            self.log.warning(f"Failed to write light cache {self.filename}: {e}")
+
+    def entries(self) -> dict:
+        """Return the cached lights keyed by service name."""
+        return dict(self.lights)
+
+    def store(self, light):
+        """Add or refresh the entry of a light."""
+        entry = self.lights.get(light.name, dict())
+        if (entry.get('addr'), entry.get('port')) != (light.addr, light.port):
+            if entry:
+                self.log.info(f"Cached address of {light.name} changed to {light.full_addr}")
+            entry = dict()
+        entry['addr'] = light.addr
+        entry['port'] = light.port
+        entry['info'] = light.info
+        # only store settings that were actually loaded from the light
+        if light._settings is not None:
+            entry['settings'] = light._settings
+        entry['seen'] = time()
+        self.lights[light.name] = entry
+
+    def remove(self, name: str):
+        """Forget a light."""
+        self.lights.pop(name, None)
@@ -0,0 +1,269 @@
+"""
+In-process metrics with a Prometheus text endpoint.
+
+Counters, gauges and histograms live in a Registry. Every light request,
+transition, discovery event and timer firing updates the metrics defined
+at the bottom of this module, and MetricsServer serves them on localhost
+in the Prometheus text format.
+Updating a metric is a dict lookup and an add under a lock, cheap enough
+to leave on all the time.
+"""
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, the lights normally answer in a few milliseconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """Return `{name="value",...}`, or an empty string without labels."""
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """Base for a metric with optional labels."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        """Init the metric."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def key(self, labels: dict) -> tuple:
+        """Return the label values in the order they were declared."""
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def get(self, **labels):
+        """Return the current value for a set of labels."""
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def render(self) -> list:
+        """Return the lines of the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """Add `amount`."""
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        """Set the value."""
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        """Init the histogram."""
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """Record one observation."""
+        key = self.key(labels)
+        with self.lock:
+            # [count per bucket..., count above the last bucket, sum]
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[index] += 1
+                    break
+            else:
+                values[len(self.buckets)] += 1
+            values[-1] += value
+
+    def get(self, **labels) -> dict:
+        """Return {'count', 'sum'} for a set of labels."""
+        with self.lock:
+            values = self.values.get(self.key(labels))
+            if values is None:
+                return {'count': 0, 'sum': 0.0}
+            return {'count': sum(values[:-1]), 'sum': values[-1]}
+
+    def render(self) -> list:
+        """Return the lines of the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, values in self.values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, values):
+                    cumulative += count
+                    bucket = format_labels(self.labels, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+                count = sum(values[:-1])
+                bucket = format_labels(self.labels, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {values[-1]}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics, looked up by name."""
+
+    def __init__(self):
+        """Init the registry."""
+        self.lock = threading.Lock()
+        self.metrics = dict()
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric, returns the one already registered under its name if any."""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        """Return the counter called `name`, creating it if needed."""
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple = ()) -> Gauge:
+        """Return the gauge called `name`, creating it if needed."""
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple = (),
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """Return the histogram called `name`, creating it if needed."""
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def get(self, name: str) -> Metric:
+        """Return a metric by name, None if there is no such metric."""
+        with self.lock:
+            return self.metrics.get(name)
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serve a registry on http://HOST:PORT/metrics from a background thread."""
+
+    def __init__(self, registry: Registry = None, port: int = 9108,
+                 host: str = '127.0.0.1'):
+        """Init the server, nothing listens until start is called."""
+        self.log = logging.getLogger(__name__)
+        self.registry = registry if registry is not None else REGISTRY
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Start serving."""
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # scrapes would flood the controller log
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self.thread.start()
+        self.log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def stop(self):
+        """Stop serving."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+            self.thread = None
+
+
+def error_kind(error) -> str:
+    """Return 'timeout', 'connection' or 'error' for a failed request."""
+    name = type(error).__name__
+    if 'Timeout' in name or isinstance(error, TimeoutError):
+        return 'timeout'
+    if 'Connection' in name or isinstance(error, ConnectionError):
+        return 'connection'
+    return 'error'
+
+
+def observe_request(light: str, method: str, duration: float,
+                    status: int = None, error=None):
+    """Record one request to a light."""
+    REQUEST_SECONDS.observe(duration, light=light, method=method)
+    if error is not None:
+        REQUEST_ERRORS.inc(light=light, kind=error_kind(error))
+    elif status != 200:
+        REQUEST_ERRORS.inc(light=light, kind='status')
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram(
+    'light_request_seconds', "Time to get a response from a light.",
+    ('light', 'method'))
+REQUEST_ERRORS = REGISTRY.counter(
+    'light_request_errors_total',
+    "Failed light requests by kind (timeout, connection, status, error).",
+    ('light', 'kind'))
+TRANSITIONS = REGISTRY.counter(
+    'room_transitions_total', "Room transitions fired.", ('mode',))
+TIMER_LATENESS = REGISTRY.histogram(
+    'timer_lateness_seconds', "How long after its scheduled time a timer fired.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 3600.0))
+DISCOVERY_EVENTS = REGISTRY.counter(
+    'discovery_events_total', "Zeroconf service events applied to the room.",
+    ('event',))
+ROOM_LIGHTS = REGISTRY.gauge('room_lights', "Lights in the room.")
+BREAKER_CHANGES = REGISTRY.counter(
+    'light_breaker_changes_total',
+    "Circuit breaker state changes by light and new state.", ('light', 'state'))
+UNAVAILABLE_LIGHTS = REGISTRY.gauge(
+    'room_unavailable_lights', "Lights left out of the room after failing health checks.")
@@ -13,11 +13,17 @@ TODO: decide if ranges should be able to wrap around or be incomplete
 
 """
 import sys
+from collections import deque
 from timer import MONTH_LENGTH, WEEKDAYS
 
 # rules structured as below, pop, read, next, push
 # below and next are sets, pop, read, and push are strings
 # empty next sets mean anything can be next
+# a rule applies when the token below whatever is getting popped is in
+# {below}, every item in [pop] is at the top of the stack (last item on top),
+# the value read from the input equals *read* ('a' is any char that is not
+# a RESERVED_SYMBOL, '&' means nothing is read) and the value after it is in
+# {next}
 class Node:
     def __init__(self, operation: str = "NONE", cfg_type: str = "NONE", parameters = []):
         # if these matches dont work, will need to add the CFG symbol that goes with the state
@@ -82,203 +88,179 @@ RULES = [
     [set(), ['(', Node(cfg_type='E'), ')'], '&', set(), Node(cfg_type='P')], # ε, (E) → P
 ]
 
-def check_rule(rule, stack, input_str) -> bool:
+# the parse table is indexed by the category of the top of the stack and the
+# category of the next input token, see `category` and `input_category`
+# every category has a representative token used to build the table
+STACK_CATEGORIES = {
+    '$': '$', '(': '(', ')': ')', '|': '|', 'a': 'a',
+    'E': Node(cfg_type='E'), 'M': Node(cfg_type='M'), 'T': Node(cfg_type='T'),
+    'F': Node(cfg_type='F'), 'P': Node(cfg_type='P'),
+}
+INPUT_CATEGORIES = ('a', '*', '(', ')', '|', '⊣')
+
+
+def category(token) -> str:
+    """Return the table category of a stack token."""
+    if type(token) is Node:
+        return token.cfg_type
+    if token in RESERVED_SYMBOLS:
+        return token
+    return 'a'
+
+
+def input_category(token: str) -> str:
+    """Return the table category of an input token, stars are told apart for NOT_STAR."""
+    return '*' if token == '*' else category(token)
+
+
+def rule_matches_top(rule, top: str) -> bool:
+    """Return True if `rule` can apply when the top of the stack is in category `top`."""
+    below, pop_tokens, _, _, _ = rule
+    if pop_tokens == ['&']:
+        return not below or STACK_CATEGORIES[top] in below
+    if pop_tokens[-1] == 'a':
+        return top == 'a'
+    return top != 'a' and STACK_CATEGORIES[top] == pop_tokens[-1]
+
+
+def rule_matches_lookahead(rule, lookahead: str) -> bool:
+    """Return True if `rule` can apply when the next input token is in category `lookahead`."""
+    _, _, read, next_tokens, _ = rule
+    if read != '&':
+        # reading rules look at the token after the one they read,
+        # none of the rules do that
+        assert not next_tokens, f"unsupported rule: {rule}"
+        if read == 'a':
+            return lookahead in ('a', '*')
+        return lookahead == read
+    if 'NOT_STAR' in next_tokens:
+        return lookahead != '*'
+    return not next_tokens or lookahead in next_tokens
+
+
+def build_parse_table(rules: list) -> dict:
     """
-    Separate function to check rules so the main parser loop is less cluttered
-    Returns a boolean if the rule is allowed
-
-    the token below whatever is getting popped must be in the set {below}
-    every item in [pop] must be at the top of the stack in the reverse order they are presented (last first)
-    the value read from the input string must be equal to *read*. the character 'a' means any character that is not a RESERVED_SYMBOL
-    and '&' means nothing was read from the input string
-    the value after read in the input string must be found in the set {next_token}
+    Precompute the rules that can apply for every (stack top, lookahead).
+
+    Rules keep their order from RULES so the parser follows the same rule the
+    old linear scan would have, only the parts of the stack below the top
+    still have to be checked when parsing.
     """
-    below, pop_tokens, read, next_tokens, push_token = rule
-    # make sure the rules are well formed
-    assert type(below) is set, f"failed to read below from rule {rule}"
-    assert type(pop_tokens) is list, f"failed to read pop from rule {rule}"
-    assert type(read) is str, f"failed to read 'read' from rule {rule}"
-    assert type(next_tokens) is set, f"failed to read next_token from rule {rule}. Recieved token: {next_tokens}"
-    assert type(push_token) is str or Node, f"failed to read push from rule {rule}. Recieved token: {push_token}"
-    
-    # check below tokens
-    below_index = (len(pop_tokens) + 1)  * -1 if pop_tokens != ['&'] else -1
+    table = dict()
+    for top in STACK_CATEGORIES:
+        for lookahead in INPUT_CATEGORIES:
+            table[(top, lookahead)] = tuple(
+                rule for rule in rules
+                if rule_matches_top(rule, top)
+                and rule_matches_lookahead(rule, lookahead))
+    return table
+
+
+PARSE_TABLE = build_parse_table(RULES)
+
+
+def rule_matches_stack(rule, stack) -> bool:
+    """Check the part of the stack the parse table does not cover."""
+    below, pop_tokens, _, _, _ = rule
+    num_popped = 0 if pop_tokens == ['&'] else len(pop_tokens)
     if below:
-        if len(stack) <= (below_index * -1) -1:
+        if len(stack) <= num_popped or stack[-num_popped - 1] not in below:
             return False
-        if stack[below_index] not in below:
-            return False
-        
-    
-    # check pop items
-    if pop_tokens != ['&']:
-        stack_pop_items = stack[below_index + 1:]
-        if pop_tokens == ['a']:
-            if len(stack_pop_items) != 1:
-                return False
-            if stack_pop_items[0] in RESERVED_SYMBOLS:
-                return False
-            if type(stack_pop_items[0]) is Node:
-                return False
-        elif stack_pop_items != pop_tokens:
-            return False
-    
-    # check read value
-    # all node rules do not read from the input string
-    # if we arent supposed to read anything then dont worry too much about it
-    if read != '&':
-        # if we are supposed to read something but there is nothing there, obviously the check fails
-        if len(input_str) == 0:
-            return False
-        if read == 'a':
-            # any char that isnt reserved
-            if input_str[0] in RESERVED_SYMBOLS:
-                return False
-            # or a node
-            if type(input_str[0]) is Node:
-                return False
-        # if its a reserved symbol, make sure we are reading in the right one
-        elif input_str[0] != read:
-                return False
-    
-    # make sure the next thing in the input is in next_tokens
-    if len(next_tokens) != 0:
-        next_index = 0 if read == '&' else 1
-        if len(input_str) > next_index:
-            if 'NOT_STAR' in next_tokens:
-                # special case
-                if input_str[next_index] == '*':
-                    return False
-            elif input_str[next_index] not in next_tokens:
-                return False
-        else:
-            if 'NOT_STAR' not in next_tokens:
-                return False
-    # none of the checks failed so the rule applies
+    if num_popped > 1:
+        return stack[-num_popped:-1] == pop_tokens[:-1]
     return True
 
+
+def parse_symbol(token: str) -> Node:
+    """Turn a symbol read from the input into a P node."""
+    new_node = Node(cfg_type='P')
+    # months are the month abreviation
+    if token in MONTH_LENGTH:
+        # it is a month
+        new_node.operation = 'month'
+        new_node.parameters = [token]
+    elif token in WEEKDAYS:
+        new_node.operation = 'weekday'
+        new_node.parameters = [token]
+    elif token[0] == 'd':
+        new_node.operation = 'date'
+        new_node.parameters = [token[1:]]
+    elif token[0] == 'h':
+        new_node.operation = 'hour'
+        new_node.parameters = [token[1:]]
+    elif token[0] == 'm':
+        new_node.operation = 'minute'
+        new_node.parameters = [token[1:]]
+    else:
+        raise ValueError(f"failed to parse symbol: {token}")
+    return new_node
+
+
 def parser(regex: list):
     """
+    Parse a list of rule tokens into a tree of Nodes.
+
     basic approach:
-        List of transitions are all possible transitions.
-        For every char, find the transition that matches the input/stack 
-   
+        The parse table gives the rules that can apply for the top of the
+        stack and the next input token, the first one whose remaining stack
+        checks pass is followed (see RULES for what a rule means).
+        Every step is constant time, so parsing is linear in the input.
+
+        if all of the conditions of a rule are met,
+        every item in pop is popped from the stack
+        the value 'read' is read from input
+        the value 'push' is pushed to the top of the stack
+            if 'push' is a node:
+                the new node gets the cfg_type of the 'push' node
+                if it does not have an 'operation' then give it the operation of the node that got popped
+                    also give it the parameters of the node that got popped
+                if it does have an operation, its parameters are the items that got popped from the stack
+            if 'push' is not a node:
+                push the 'read' value that was obtained from the input
+
+        if no rule was met, we are done.
     """
-    remaining_input = ['⊣']
-    if len(regex) > 0:
-        remaining_input = list(regex + ['⊣']) if regex[-1] != '⊣' else list(regex)
+    remaining_input = deque(regex)
+    if not remaining_input or remaining_input[-1] != '⊣':
+        remaining_input.append('⊣')
     stack = ['$']
-    # when the stack does not change, it means we have an invalid regex (because we should always follow exactly one rule)
-    a_rule_was_followed = True
-
-    while a_rule_was_followed:
-        #print(f"stack: {stack}")
-        a_rule_was_followed = False
-        for rule in RULES:    
-            """
-            Checking rules:
-                the token below whatever is getting popped must be in the set {below}
-                every item in [pop] must be at the top of the stack in the reverse order they are presented (last first)
-                the value read from the input string must be equal to *read*. the character 'a' means any character that is not a RESERVED_SYMBOL
-                and '&' means nothing was read from the input string
-                the value after read in the input string must be found in the set {next_token}
-
-                if all of those rules are met, 
-                every item in pop is popped from the stack
-                the value 'read' is read from input
-                the value 'push' is pushed to the top of the stack
-                    if 'push' is a node:
-                        the new node gets the cfg_type of the 'push' node
-                        if it does not have an 'operation' then give it the operation of the node that got popped
-                            also give it the parameters of the node that got popped
-                        if it does have an operation, its parameters are the items that got popped from the stack
-                    if 'push' is not a node:
-                        push the 'read' value that was obtained from the input
-                
-                if no rule was met, we are done.
-            """
-            if not check_rule(rule, stack, remaining_input):
-                continue
-            
-            _, pop_tokens, read, _, push_token = rule
-            # now all of the conditions should be met, so we can perform the operation
-            # pop the old items
-
-            popped_from_stack = []
-            if pop_tokens != ['&']:
-                for token in reversed(pop_tokens):
-                    popped_token = stack.pop()
-                    if pop_tokens != ['a']:
-                        assert token == popped_token, f"when popping from stack tokens did not match: {token} != {popped_token}"
-                    else:
-                        assert token not in RESERVED_SYMBOLS, f"was supposed to pop arbitrary character but instead popped {token}"
-                        assert type(token) != Node, f"was supposed to pop arbitrary character but instead popped {token}"
-                    if popped_token not in RESERVED_SYMBOLS:
-                        popped_from_stack.insert(0, popped_token)
-                assert pop_tokens == ['a'] or popped_from_stack == list(filter(lambda x: x not in RESERVED_SYMBOLS, pop_tokens)), f"popped tokens do not match: {popped_from_stack} != {list(filter(lambda x: x not in RESERVED_SYMBOLS, pop_tokens))}"
-            
-            popped_from_input = ""
-            if read != '&':
-                assert len(remaining_input) > 0, "tried to pop input from empty list"
-                popped_from_input = remaining_input.pop(0)
-            
-            if type(push_token) is Node:
-                assert push_token.cfg_type != 'NONE', f"malformed node: {push_token}"
-                new_node = Node(cfg_type=push_token.cfg_type)
-                if push_token.operation == 'NONE':
-                    assert len(popped_from_stack) == 1, f"only one item was supposed to be popped but found a different number: {popped_from_stack}"
-                    assert type(popped_from_stack[0]) is Node, f"was supposed to pop a node but instead popped: {popped_from_stack[0]}"
-                    assert popped_from_stack[0].operation != 'NONE', f"popped node was supposed to have an operation but did not: {popped_from_stack[0]}"
-                    new_node.operation = popped_from_stack[0].operation
-                    new_node.parameters = popped_from_stack[0].parameters
-                else:
-                    if push_token.operation == "symbol":
-                        # need further parsing
-                        assert len(popped_from_stack) == 1, f"only one item was suppoed to be popped for symbol parsing, but found: {popped_from_stack}"
-                        assert type(popped_from_stack[0]) is str, f"was supposed to pop a string to parse into a symbol but instead found: {popped_from_stack}"
-                        token = popped_from_stack[0]
-                        # months are the month abreviation
-                        if token in MONTH_LENGTH:
-                            # it is a month
-                            new_node.operation = 'month'
-                            new_node.parameters = popped_from_stack
-                        elif token in WEEKDAYS:
-                            new_node.operation = 'weekday'
-                            new_node.parameters = popped_from_stack
-                        elif token[0] == 'd':
-                            new_node.operation = 'date'
-                            new_node.parameters = [token[1:]]
-                        elif token[0] == 'h':
-                            new_node.operation = 'hour'
-                            new_node.parameters = [token[1:]]
-                        elif token[0] == 'm':
-                            new_node.operation = 'minute'
-                            new_node.parameters = [token[1:]]
-                        else:
-                            raise ValueError(f"failed to parse symbol: {token}")
-                        
-                    else:
-                        new_node.operation = push_token.operation
-                        if push_token.operation == 'epsilon':
-                            new_node.parameters = ['&']
-                        else:
-                            new_node.parameters = popped_from_stack
-                assert new_node.operation != 'NONE', f"trying to push malformed node to stack - no operation"
-                assert new_node.parameters != [], f"trying to push malformed node to stack - no parameters"
-                stack.append(new_node)
-            else:
-                assert popped_from_input != "", f"was supposed to push the value from input but nothing was popped from input"
-                stack.append(popped_from_input)
 
-            a_rule_was_followed = True
-            break
-        if not a_rule_was_followed:
+    while True:
+        candidates = PARSE_TABLE[(category(stack[-1]), input_category(remaining_input[0]))]
+        for rule in candidates:
+            if rule_matches_stack(rule, stack):
+                break
+        else:
             # if we are at the end of the input and there is only one token left in the stack (it has to be a Node) then return that node
-            if len(stack) == 2:
-                assert type(stack[-1]) is Node, f"whoops, the last thing on the stack was not a Node, instead it was: {stack}"
+            if len(stack) == 2 and type(stack[-1]) is Node:
                 return stack.pop()
-        
-        assert a_rule_was_followed, "this is unnecessary, but whatever, the loop will break anyways if a rule isnt performed"
+            raise ValueError(f"invalid rule expression, stuck with stack: {stack}")
+
+        _, pop_tokens, read, _, push_token = rule
+        # pop the old items, reserved symbols are dropped
+        popped_from_stack = []
+        if pop_tokens != ['&']:
+            popped_from_stack = [
+                token for token in stack[-len(pop_tokens):]
+                if type(token) is Node or token not in RESERVED_SYMBOLS]
+            del stack[-len(pop_tokens):]
+
+        popped_from_input = ""
+        if read != '&':
+            popped_from_input = remaining_input.popleft()
+
+        if type(push_token) is not Node:
+            stack.append(popped_from_input)
+        elif push_token.operation == 'NONE':
+            # pass the single popped node up to the new cfg type
+            popped = popped_from_stack[0]
+            stack.append(Node(popped.operation, push_token.cfg_type, popped.parameters))
+        elif push_token.operation == 'symbol':
+            stack.append(parse_symbol(popped_from_stack[0]))
+        elif push_token.operation == 'epsilon':
+            stack.append(Node('epsilon', push_token.cfg_type, ['&']))
+        else:
+            stack.append(Node(push_token.operation, push_token.cfg_type, popped_from_stack))
 
 def main():
     """
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Record light traffic to JSONL and replay it against the simulator.
+
+A LightSession given a TrafficRecorder appends one line per request with
+the light, path, body, response and timing. Replaying a recording re-issues
+the same requests against simulator.py at the original pace (or faster), so
+real load patterns such as the morning transition burst can be reproduced
+offline and compared between versions.
+
+    python3 recorder.py RECORDING [FLAGS]
+"""
+import json
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep, time
+from urllib.parse import urlsplit
+
+
+def usage(status):
+    """Output a help statement for the program."""
+    print("""
+Light Traffic Replayer
+    USAGE python3 recorder.py RECORDING [FLAGS]
+
+    -f FAIL_RATE    share of simulated requests answered with 503
+    -h              display this message
+    -j JITTER_MS    random extra simulated latency
+    -l LATENCY_MS   simulated latency (default: the recorded median)
+    -s SPEED        replay this many times faster, 0 for as fast as possible
+    -w WORKERS      requests in flight at once
+    """)
+    sys.exit(status)
+
+
+class TrafficRecorder:
+    """Append every request a session sends to a JSONL file."""
+
+    def __init__(self, filename: str):
+        """Open `filename` for appending."""
+        self.log = logging.getLogger(__name__)
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.start = monotonic()
+        self.file = open(filename, 'a', buffering=1)
+
+    def record(self, method: str, light: str, path: str, body, start: float,
+               status: int = None, response: str = None, error=None):
+        """
+        Write one request.
+
+            light: addr:port of the light
+            start: monotonic time the request was sent
+        """
+        if isinstance(body, bytes):
+            body = body.decode('utf-8', errors='replace')
+        if isinstance(response, bytes):
+            response = response.decode('utf-8', errors='replace')
+        entry = {
+            'time': time() - (monotonic() - start),
+            'offset': round(start - self.start, 6),
+            'duration': round(monotonic() - start, 6),
+            'method': method,
+            'light': light,
+            'path': path,
+            'body': body,
+            'status': status,
+            'response': response,
+        }
+        if error is not None:
+            entry['error'] = f"{type(error).__name__}: {error}"
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line)
+
+    def record_url(self, method: str, url: str, body, start: float,
+                   status: int = None, response: str = None, error=None):
+        """Write one request sent to a full url."""
+        parts = urlsplit(url)
+        self.record(method, parts.netloc, parts.path, body, start,
+                    status, response, error)
+
+    def close(self):
+        """Close the file."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def load_recording(filename: str) -> list:
+    """Return the recorded requests ordered by when they were sent."""
+    entries = []
+    with open(filename, 'r') as recording:
+        for line in recording:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    # a file appended to by several runs restarts its offsets,
+    # the wall clock keeps them apart
+    entries.sort(key=lambda entry: entry['time'])
+    if entries:
+        first = entries[0]['time']
+        for entry in entries:
+            entry['offset'] = entry['time'] - first
+    return entries
+
+
+def percentile(values: list, share: float) -> float:
+    """Return the value `share` of the way through the sorted values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+class Replayer:
+    """Re-issue recorded requests against other lights."""
+
+    def __init__(self, entries: list, addresses: dict, speed: float = 1.0,
+                 max_workers: int = 32, session=None):
+        """
+        Init the replayer.
+
+            addresses: recorded addr:port -> addr:port to send to
+            speed: how many times faster than recorded, 0 for no waiting
+        """
+        # lightStripLib needs zeroconf, only import it when replaying
+        from lightStripLib import LightSession
+        self.log = logging.getLogger(__name__)
+        self.entries = entries
+        self.addresses = addresses
+        self.speed = speed
+        self.max_workers = max_workers
+        self.session = session if session is not None else LightSession()
+
+    def send(self, entry: dict, due: float) -> tuple:
+        """Send one request, returns (latency, lateness, ok)."""
+        lateness = monotonic() - due
+        start = monotonic()
+        try:
+            response = self.session.request(
+                entry['method'],
+                f"http://{self.addresses[entry['light']]}{entry['path']}",
+                data=entry['body'])
+            ok = response.status_code == 200
+        except Exception as e:
+            self.log.debug(f"Replayed request failed: {e}")
+            ok = False
+        return (monotonic() - start, lateness, ok)
+
+    def run(self) -> dict:
+        """Replay every request, returns a summary of how it went."""
+        start = monotonic()
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for entry in self.entries:
+                due = start
+                if self.speed:
+                    due += entry['offset'] / self.speed
+                    remaining = due - monotonic()
+                    if remaining > 0:
+                        sleep(remaining)
+                futures.append(executor.submit(self.send, entry, due))
+            results = [future.result() for future in futures]
+        wall = monotonic() - start
+        latencies = [latency for latency, _, _ in results]
+        recorded = [entry['duration'] for entry in self.entries]
+        return {
+            'requests': len(results),
+            'wall': round(wall, 3),
+            'errors': sum(1 for _, _, ok in results if not ok),
+            'recorded_errors': sum(1 for entry in self.entries
+                                   if entry.get('status') != 200),
+            'latency_p50': round(percentile(latencies, 0.5), 6),
+            'latency_p95': round(percentile(latencies, 0.95), 6),
+            'latency_max': round(max(latencies, default=0.0), 6),
+            'recorded_p50': round(percentile(recorded, 0.5), 6),
+            'recorded_p95': round(percentile(recorded, 0.95), 6),
+            'max_lateness': round(max((lateness for _, lateness, _ in results),
+                                      default=0.0), 6),
+        }
+
+
+def main():
+    """Replay a recording against simulated lights."""
+    arguments = sys.argv[1:]
+    if not arguments or arguments[0] == '-h':
+        usage(0 if arguments else 1)
+    recording = arguments.pop(0)
+    speed = 1.0
+    max_workers = 32
+    latency = None
+    jitter = 0.0
+    failure_rate = 0.0
+    while arguments:
+        arg = arguments.pop(0)
+        try:
+            if arg == '-s':
+                speed = float(arguments.pop(0))
+            elif arg == '-w':
+                max_workers = int(arguments.pop(0))
+            elif arg == '-l':
+                latency = float(arguments.pop(0)) / 1000
+            elif arg == '-j':
+                jitter = float(arguments.pop(0)) / 1000
+            elif arg == '-f':
+                failure_rate = float(arguments.pop(0))
+            elif arg == '-h':
+                usage(0)
+            else:
+                usage(1)
+        except (IndexError, ValueError):
+            print(f"Failed to parse {arg}")
+            usage(1)
+
+    from simulator import Simulator
+    entries = load_recording(recording)
+    lights = list(dict.fromkeys(entry['light'] for entry in entries))
+    if latency is None:
+        # the recorded median is a fair stand-in for the real lights
+        latency = percentile([entry['duration'] for entry in entries], 0.5)
+    simulator = Simulator(len(lights), latency=latency, jitter=jitter,
+                          failure_rate=failure_rate).start_in_thread()
+    addresses = {light: f"{simulator.host}:{port}"
+                 for light, port in zip(lights, simulator.ports)}
+    print(f"Replaying {len(entries)} requests to {len(lights)} lights "
+          f"at {speed}x with {latency * 1000:.1f}ms latency")
+    try:
+        summary = Replayer(entries, addresses, speed, max_workers).run()
+    finally:
+        simulator.stop_thread()
+    for key, value in summary.items():
+        print(f"{key:<16} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Timeouts, deadlines, retries and circuit breakers for light requests.
+
+A light that half-dies accepts connections but never answers, so every
+request gets a connect and read timeout, and a room operation gets an
+overall deadline that the requests it fans out (on the worker pool or as
+asyncio tasks) are cut short to. Failed requests are retried a bounded
+number of times with jittered backoff, and a per-light circuit breaker
+stops sending to a light that keeps failing until it is probed again.
+"""
+
+import contextlib
+import contextvars
+import logging
+import random
+import threading
+from time import monotonic
+
+import metrics
+
+# monotonic time the current room operation has to be done by
+DEADLINE = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The room operation ran out of time, the request was not sent."""
+
+
+class CircuitOpenError(ConnectionError):
+    """The light's circuit breaker is open, the request was not sent."""
+
+
+def remaining():
+    """Return the seconds left before the current deadline, None without one."""
+    end = DEADLINE.get()
+    return None if end is None else end - monotonic()
+
+
+def check_deadline():
+    """Raise DeadlineExceeded if the current deadline has passed."""
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("room operation deadline passed")
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """
+    Give every request made in the block at most `seconds` in total.
+
+    Nested deadlines keep the earliest one, None leaves the current one.
+    """
+    if seconds is None:
+        yield DEADLINE.get()
+        return
+    end = monotonic() + seconds
+    current = DEADLINE.get()
+    if current is not None and current < end:
+        end = current
+    token = DEADLINE.set(end)
+    try:
+        yield end
+    finally:
+        DEADLINE.reset(token)
+
+
+class CircuitBreaker:
+    """
+    Stop sending to a light after repeated failures.
+
+    closed: requests go through, consecutive failures are counted
+    open: requests fail right away until `reset_timeout` has passed
+    half-open: one probe request is let through, its result closes or
+    reopens the breaker
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name: str, failure_threshold: int = 3,
+                 reset_timeout: float = 30.0):
+        """Init a closed breaker."""
+        self.log = logging.getLogger(__name__)
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.changed_at = monotonic()
+
+    def allow(self) -> bool:
+        """Return True if a request may be sent now."""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if monotonic() - self.changed_at < self.reset_timeout:
+                return False
+            # open long enough, or the last probe never came back
+            self.set_state(self.HALF_OPEN)
+            return True
+
+    def record_success(self):
+        """The light answered."""
+        with self.lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self.set_state(self.CLOSED)
+
+    def record_failure(self):
+        """A request to the light failed."""
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                    self.state == self.CLOSED
+                    and self.failures >= self.failure_threshold):
+                self.set_state(self.OPEN)
+
+    def set_state(self, state: str):
+        """Change state and log it, the lock is held by the caller."""
+        self.changed_at = monotonic()
+        if state == self.state:
+            return
+        if state == self.OPEN:
+            self.log.warning(
+                f"Circuit breaker for {self.name} opened after {self.failures} "
+                f"failures, skipping it for {self.reset_timeout}s")
+        elif state == self.HALF_OPEN:
+            self.log.info(f"Circuit breaker for {self.name} is half-open, probing")
+        else:
+            self.log.info(f"Circuit breaker for {self.name} closed, the light is answering")
+        self.state = state
+        metrics.BREAKER_CHANGES.inc(light=self.name, state=state)
+
+
+class RequestPolicy:
+    """Timeouts, retries and circuit breakers shared by a room's sessions."""
+
+    def __init__(self,
+                 connect_timeout: float = 2.0,
+                 read_timeout: float = 3.0,
+                 operation_timeout: float = 15.0,
+                 retries: int = 2,
+                 backoff: float = 0.05,
+                 max_backoff: float = 1.0,
+                 failure_threshold: int = 3,
+                 reset_timeout: float = 30.0):
+        """
+        Init the policy.
+
+            connect_timeout, read_timeout: seconds per request attempt
+            operation_timeout: seconds a room operation (a color, a scene,
+            one side of a transition) may take, see deadline
+            retries: extra attempts after a connection error or a 5xx answer
+            backoff: the wait before retry n is random up to
+            backoff * 2 ** (n - 1), capped at max_backoff
+            failure_threshold: failed requests in a row that open a
+            light's breaker
+            reset_timeout: seconds an open breaker waits before a probe
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.operation_timeout = operation_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.breakers = dict()
+
+    def timeout(self, timeout=None):
+        """
+        Return the (connect, read) timeout for the next attempt.
+
+        `timeout` overrides the policy's, both are cut to the current
+        deadline. Raises DeadlineExceeded if the deadline has passed.
+        """
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        left = remaining()
+        if left is None:
+            return timeout
+        if left <= 0:
+            raise DeadlineExceeded("room operation deadline passed")
+        if isinstance(timeout, tuple):
+            return tuple(min(part, left) for part in timeout)
+        return min(timeout, left)
+
+    def deadline(self, seconds: float = None):
+        """Context manager giving the block `seconds` (default operation_timeout)."""
+        return deadline(self.operation_timeout if seconds is None else seconds)
+
+    def retry_delay(self, attempt: int, immediate: bool = False):
+        """
+        Return how long to wait before retry `attempt` (1 for the first).
+
+        Returns None when the retries are used up or the deadline would
+        pass before the retry could be sent.
+        """
+        if attempt > self.retries:
+            return None
+        delay = 0.0 if immediate else random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        left = remaining()
+        if left is not None and left <= delay:
+            return None
+        return delay
+
+    def breaker(self, light: str) -> CircuitBreaker:
+        """Return the breaker for a light (addr:port)."""
+        with self.lock:
+            if light not in self.breakers:
+                self.breakers[light] = CircuitBreaker(
+                    light, self.failure_threshold, self.reset_timeout)
+            return self.breakers[light]
+
+    def record(self, light: str, status: int = None, error=None):
+        """
+        Feed a finished request to the light's breaker.
+
+        Requests stopped by the room operation's deadline, before they were
+        sent or by a timeout cut short to it, say nothing about the light
+        and are left out.
+        """
+        if isinstance(error, DeadlineExceeded):
+            return
+        if error is not None and (left := remaining()) is not None and left <= 0:
+            return
+        if error is not None or status is None or status >= 500:
+            self.breaker(light).record_failure()
+        else:
+            self.breaker(light).record_success()
+
+    def open_breakers(self) -> list:
+        """Return the lights whose breaker is not closed."""
+        with self.lock:
+            return [light for light, breaker in self.breakers.items()
+                    if breaker.state != CircuitBreaker.CLOSED]
@@ -0,0 +1,126 @@
+"""
+Event driven scheduler for timers.
+
+Every timer knows the next time it should fire, the scheduler keeps the
+timers in a priority queue ordered by that time and sleeps until the
+earliest one is due.
+A timer is rescheduled from the time it was due (not from when the room
+finished working), so slow transitions make timers late but never make
+them skip or fire twice.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+from datetime import datetime, timedelta
+
+
+class Scheduler:
+    """Priority queue of timers keyed on their next fire time."""
+
+    def __init__(self, timers: list = None, grace_period: float = 3600):
+        """
+        Init the scheduler.
+
+            grace_period: seconds a timer may be late before it is skipped,
+            e.g. after the machine was suspended
+        """
+        self.log = logging.getLogger(__name__)
+        self.grace_period = timedelta(seconds=grace_period)
+        self.heap = []
+        # breaks ties between timers due at the same time
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.load(timers if timers else [])
+
+    def load(self, timers: list, now: datetime = None):
+        """Replace the timers and wake up anything waiting on the old ones."""
+        with self.lock:
+            self.heap = []
+        self.add(timers, now)
+
+    def add(self, timers: list, now: datetime = None):
+        """Schedule new timers, the ones already scheduled are left alone."""
+        now = now if now else datetime.now()
+        with self.lock:
+            for timer in timers:
+                fire_time = self.next_fire_time(timer, now)
+                if fire_time is None:
+                    self.log.warning(f"Timer {timer.get_activation_time()} never fires, skipping")
+                    continue
+                heapq.heappush(self.heap, (fire_time, next(self.counter), timer))
+        self.wake()
+
+    def remove(self, timers: list):
+        """Unschedule timers."""
+        if not timers:
+            return
+        removed = set(id(timer) for timer in timers)
+        with self.lock:
+            self.heap = [entry for entry in self.heap
+                         if id(entry[2]) not in removed]
+            heapq.heapify(self.heap)
+        self.wake()
+
+    def next_fire_time(self, timer, after: datetime):
+        """Return the timer's next fire time, None if it fails to compute one."""
+        try:
+            return timer.next_fire_time(after)
+        except Exception as e:
+            # one broken timer must not take the scheduler down
+            self.log.error(f"Timer {timer.get_activation_time()} failed to schedule: {e}")
+            return None
+
+    def wake(self):
+        """Make `wait` return early."""
+        self.wake_event.set()
+
+    def next_due(self):
+        """Return the time the next timer fires, or None if there are none."""
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: datetime = None) -> list:
+        """
+        Pop every timer that is due and reschedule it.
+
+        Returns a list of (fire time, timer) in firing order
+        """
+        now = now if now else datetime.now()
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                fire_time, _, timer = heapq.heappop(self.heap)
+                next_time = self.next_fire_time(timer, fire_time)
+                if next_time is not None:
+                    heapq.heappush(
+                        self.heap, (next_time, next(self.counter), timer))
+                if now - fire_time > self.grace_period:
+                    self.log.warning(
+                        f"Skipping timer {timer.get_activation_time()}, "
+                        f"it was due at {fire_time}")
+                    continue
+                due.append((fire_time, timer))
+        return due
+
+    def wait(self, max_wait: float = 60) -> list:
+        """
+        Sleep until the next timer is due, at most `max_wait` seconds.
+
+        Returns the due timers (see `pop_due`), which is empty if the wait
+        timed out or was woken by `wake`.
+        """
+        # cleared before looking at the heap, so a wake() from another
+        # thread after this point is never lost
+        self.wake_event.clear()
+        if due := self.pop_due():
+            return due
+        next_time = self.next_due()
+        timeout = max_wait
+        if next_time is not None:
+            timeout = min(max_wait,
+                          max(0, (next_time - datetime.now()).total_seconds()))
+        self.wake_event.wait(timeout)
+        return self.pop_due()
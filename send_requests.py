@@ -5,15 +5,17 @@ Miscelaneous setup and testing.
 """
 
 from lightStripLib import Room
+from light_cache import LightCache
 
 
 def main():
     """Msin driver for program."""
-    room = Room()
+    room = Room(light_cache=LightCache("light_cache.json"))
     room.setup()
 
     for light in room.lights:
         print(f"light: {light.data}")
+    room.close()
 
 
 if __name__ == "__main__":
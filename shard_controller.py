@@ -0,0 +1,470 @@
+#!/usr/bin/python3
+"""
+Sharded controller for large numbers of lights.
+
+One process with one Room is held back by the GIL once there are a few
+hundred lights, so here a supervisor splits the lights over worker
+processes. The supervisor owns the timer file, the scheduler and zeroconf
+discovery: every discovered service is routed to one worker (by a hash of
+its name or of its subnet) and every timer firing is sent to all workers
+over a pipe. Each worker runs its own Room, reconciler and health checker
+and fires transitions for its share of the lights. A worker that dies is
+restarted with its lights while the others carry on.
+
+    python3 shard_controller.py -w 4 [FLAGS]
+"""
+import ipaddress
+import logging
+import logging.handlers
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import socket
+import sys
+import threading
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from time import monotonic
+
+import tracing
+from controller import TimerCache
+from file_watcher import FileWatcher
+from light_cache import LightCache
+from lightStripLib import (Room, CompiledTransition, LightServiceListener,
+                           drain_service_events)
+from metrics import REGISTRY, MetricsServer, TIMER_LATENESS
+from recorder import TrafficRecorder
+from scheduler import Scheduler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+WORKER_RESTARTS = REGISTRY.counter(
+    'shard_worker_restarts_total', "Shard workers restarted after they died.",
+    ('shard',))
+
+# what a worker needs of a zeroconf ServiceInfo, see service_candidates
+ServiceRecord = namedtuple('ServiceRecord', ['addresses', 'port'])
+
+
+def usage(status):
+    """Output a help statement for the program."""
+    print("""
+Sharded Elgato Light Controller
+    USAGE python3 shard_controller.py [FLAGS]
+
+    -a              run transitions on the asyncio engine
+    -c CACHE_FILE   change location of the light caches (one per worker)
+    -h              display this message
+    -l LOG_FILE     change location of log file
+    -m PORT         serve metrics, the supervisor on PORT and worker N on PORT + 1 + N
+    -p SECONDS      probe every light this often (default: 10, 0 for off)
+    -q              turn off logging
+    -r RECORD_FILE  record every request to the lights, one file per worker
+    -s              release every light's requests at the same moment
+    -S              shard lights by subnet instead of by service name
+    -t TIMER_FILE   change location of timer file
+    -T TRACE_FILE   write tracing spans, one file per worker
+    -w WORKERS      number of worker processes (default: the number of cores)
+    """)
+    sys.exit(status)
+
+
+def shard_filename(filename: str, index: int) -> str:
+    """Return `filename` with the worker index before its extension."""
+    if filename is None:
+        return None
+    root, extension = os.path.splitext(filename)
+    return f"{root}.{index}{extension}"
+
+
+def run_worker(index: int, connection, log_queue, options: dict):
+    """
+    Run one shard until the supervisor says stop or goes away.
+
+    Runs in its own process. Messages from the supervisor are
+        ('service', event, name, addresses, port)   a discovery event
+        ('fire', fire_time, label, colors, end_scene)   a timer firing
+        ('stop',)
+    and after every firing ('fired', index, fire_time, successful, lights,
+    seconds) is sent back.
+    """
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    if options['quiet']:
+        logging.disable()
+    # __name__ is __mp_main__ in a spawned worker
+    log = logging.getLogger(f"shard_controller.shard{index}")
+
+    metrics_server = None
+    if options['metrics_port'] is not None:
+        metrics_server = MetricsServer(port=options['metrics_port'] + 1 + index)
+        metrics_server.start()
+    if options['trace_file'] is not None:
+        tracing.start_tracing(shard_filename(options['trace_file'], index))
+    recorder = None
+    if options['record_file'] is not None:
+        recorder = TrafficRecorder(shard_filename(options['record_file'], index))
+    light_cache = LightCache(shard_filename(options['cache_file'], index))
+    room = Room(light_cache=light_cache, recorder=recorder)
+    room.load_cached_lights()
+    room.start_reconciler()
+    if options['probe_interval'] > 0:
+        room.start_health_checker(options['probe_interval'])
+
+    firings = queue.Queue()
+    # compiled once per distinct timer, like TimerCache does in one process
+    transitions = dict()
+
+    def fire_transitions():
+        """Run the firings one after another, like controller.main does."""
+        while (firing := firings.get()) is not None:
+            fire_time, label, colors, end_scene = firing
+            lateness = (datetime.now() - fire_time).total_seconds()
+            TIMER_LATENESS.observe(lateness)
+            key = (tuple(colors), tuple(end_scene))
+            if key not in transitions:
+                transitions[key] = CompiledTransition(colors, end_scene)
+            transition = transitions[key]
+            lights = len(room.available_lights())
+            start = monotonic()
+            try:
+                with tracing.span('timer.fire', timer=label, lateness=lateness, shard=index):
+                    if options['use_async']:
+                        successful = room.room_transition_async(transition)
+                    elif options['synchronized']:
+                        successful = room.room_transition_synchronized(transition)
+                    else:
+                        successful = room.room_transition_threaded(transition)
+            except Exception as e:
+                log.error(f"Transition {label} failed: {e}")
+                successful = ()
+            try:
+                connection.send(('fired', index, fire_time, len(successful or ()),
+                                 lights, monotonic() - start))
+            except OSError:
+                # the supervisor is gone, the main loop notices too
+                pass
+
+    fire_thread = threading.Thread(
+        target=fire_transitions, name=f"shard{index}-fire", daemon=True)
+    fire_thread.start()
+    log.info(f"Shard {index} started (pid {os.getpid()})")
+    running = True
+    try:
+        while running:
+            # take everything that is waiting, so a burst of discovered
+            # lights is admitted together
+            timeout = 1.0
+            while running and connection.poll(timeout):
+                timeout = 0
+                message = connection.recv()
+                if message[0] == 'service':
+                    _, event, name, addresses, port = message
+                    info = ServiceRecord(addresses, port) if addresses is not None else None
+                    room.service_events.put((event, name, info))
+                elif message[0] == 'fire':
+                    firings.put(message[1:])
+                elif message[0] == 'stop':
+                    running = False
+            room.apply_service_events(0)
+    except (EOFError, OSError, KeyboardInterrupt):
+        # the supervisor went away
+        pass
+    finally:
+        firings.put(None)
+        fire_thread.join()
+        room.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+        tracing.stop_tracing()
+        log.info(f"Shard {index} stopped")
+
+
+class ShardSupervisor:
+    """Start the workers, route discovered lights to them and fan out firings."""
+
+    def __init__(self, num_workers: int, options: dict, by_subnet: bool = False,
+                 service_type: str = '_elg._tcp.local.', on_fired=None):
+        """
+        Init the supervisor, no worker runs until start is called.
+
+            options: the worker settings, see run_worker
+            by_subnet: put lights on the same subnet on the same worker
+            on_fired: called with (shard, fire time, successful, lights,
+            seconds) whenever a worker finishes a firing
+        """
+        self.log = logging.getLogger(__name__)
+        self.num_workers = num_workers
+        self.options = options
+        self.by_subnet = by_subnet
+        self.service_type = service_type
+        # spawn, forking a process that runs zeroconf threads is not safe
+        self.context = multiprocessing.get_context('spawn')
+        self.log_queue = self.context.Queue()
+        self.log_listener = logging.handlers.QueueListener(
+            self.log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        self.processes = [None] * num_workers
+        self.connections = [None] * num_workers
+        self.locks = [threading.Lock() for _ in range(num_workers)]
+        # zeroconf events, applied by the router thread
+        self.service_events = queue.Queue()
+        # service name -> worker, sticky so a light never moves between workers
+        self.assignments = dict()
+        # what each worker was told about, replayed when it is restarted
+        self.services = [dict() for _ in range(num_workers)]
+        self.on_fired = on_fired
+        self.stop_event = threading.Event()
+        self.router = None
+        self.reader = None
+        self.zeroconf = None
+        self.browser = None
+
+    def shard_for(self, name: str, info) -> int:
+        """Return the worker a service belongs to."""
+        if name in self.assignments:
+            return self.assignments[name]
+        key = name
+        if self.by_subnet and info is not None:
+            for addr in info.addresses:
+                try:
+                    key = str(ipaddress.ip_network(
+                        f"{socket.inet_ntoa(addr)}/24", strict=False))
+                    break
+                except OSError:
+                    # not an IPv4 address
+                    continue
+        shard = zlib.crc32(key.encode()) % self.num_workers
+        self.assignments[name] = shard
+        return shard
+
+    def start_worker(self, index: int):
+        """Start (or restart) worker `index` and tell it about its lights."""
+        supervisor_end, worker_end = self.context.Pipe()
+        process = self.context.Process(
+            target=run_worker, name=f"shard{index}",
+            args=(index, worker_end, self.log_queue, self.options), daemon=True)
+        process.start()
+        worker_end.close()
+        with self.locks[index]:
+            if self.connections[index] is not None:
+                self.connections[index].close()
+            self.processes[index] = process
+            self.connections[index] = supervisor_end
+        for name, (addresses, port) in self.services[index].items():
+            self.send(index, ('service', 'add', name, addresses, port))
+
+    def send(self, index: int, message: tuple) -> bool:
+        """Send a message to a worker, returns False if it is down."""
+        with self.locks[index]:
+            try:
+                self.connections[index].send(message)
+                return True
+            except (OSError, AttributeError) as e:
+                self.log.warning(f"Shard {index} is not reachable: {e}")
+                return False
+
+    def route(self, event: str, name: str, info):
+        """Send a zeroconf event to the worker that owns the service."""
+        index = self.shard_for(name, info)
+        if event == 'remove':
+            self.services[index].pop(name, None)
+            self.assignments.pop(name, None)
+            self.send(index, ('service', event, name, None, None))
+            return
+        record = (list(info.addresses), info.port)
+        self.services[index][name] = record
+        self.send(index, ('service', event, name) + record)
+
+    def fire(self, fire_time: datetime, timer) -> int:
+        """Send a timer firing to every worker, returns how many got it."""
+        transition = timer.compiled_transition
+        message = ('fire', fire_time, str(timer.get_activation_time()),
+                   transition.colors, transition.end_scene)
+        return sum(self.send(index, message) for index in range(self.num_workers))
+
+    def read_results(self):
+        """Log the firings the workers finish until stopped."""
+        while not self.stop_event.is_set():
+            connections = [connection for connection in self.connections
+                           if connection is not None]
+            try:
+                ready = multiprocessing.connection.wait(connections, timeout=0.5)
+            except (OSError, ValueError):
+                # a connection was closed by a restart, take the new list
+                continue
+            for connection in ready:
+                try:
+                    _, shard, fire_time, successful, lights, seconds = connection.recv()
+                except (EOFError, OSError):
+                    # the worker died, check_workers restarts it
+                    self.stop_event.wait(0.5)
+                    continue
+                if self.on_fired is not None:
+                    self.on_fired(shard, fire_time, successful, lights, seconds)
+                self.log.info(f"Shard {shard}: {successful}/{lights} lights transitioned "
+                              f"for {fire_time:%H:%M} in {seconds:.1f}s")
+
+    def check_workers(self):
+        """Restart any worker that died."""
+        for index, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                self.log.error(f"Shard {index} died (exit code {process.exitcode}), restarting it")
+                WORKER_RESTARTS.inc(shard=index)
+                self.start_worker(index)
+
+    def run_router(self):
+        """Route discovery events and watch the workers until stopped."""
+        while not self.stop_event.is_set():
+            for event, name, info in drain_service_events(self.service_events, 0.5):
+                self.route(event, name, info)
+            self.check_workers()
+
+    def start_discovery(self):
+        """Browse for lights over zeroconf, events go to the router."""
+        try:
+            import zeroconf
+        except ImportError:
+            raise ImportError("Please install zeroconf to use this method. You can install it using: pip install zeroconf")
+        self.zeroconf = zeroconf.Zeroconf()
+        self.browser = zeroconf.ServiceBrowser(
+            self.zeroconf, self.service_type, LightServiceListener(self.service_events),
+            question_type=zeroconf.DNSQuestionType.QU)
+
+    def start(self, discovery: bool = True):
+        """Start the workers, the router and (optionally) discovery."""
+        self.log_listener.start()
+        for index in range(self.num_workers):
+            self.start_worker(index)
+        self.router = threading.Thread(
+            target=self.run_router, name="shard-router", daemon=True)
+        self.router.start()
+        self.reader = threading.Thread(
+            target=self.read_results, name="shard-results", daemon=True)
+        self.reader.start()
+        if discovery:
+            self.start_discovery()
+        self.log.info(f"Started {self.num_workers} shards")
+
+    def stop(self):
+        """Stop discovery, the router and every worker."""
+        if self.browser is not None:
+            self.browser.cancel()
+            self.zeroconf.close()
+            self.browser = None
+        self.stop_event.set()
+        for thread in (self.router, self.reader):
+            if thread is not None:
+                thread.join()
+        self.router = None
+        self.reader = None
+        for index in range(self.num_workers):
+            self.send(index, ('stop',))
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+        self.log_listener.stop()
+
+
+def parse_args() -> dict:
+    """Return the settings."""
+    settings = {
+        'log_file': "controller.log",
+        'timer_file': "light.transition",
+        'workers': os.cpu_count() or 1,
+        'by_subnet': False,
+        'quiet': False,
+        'use_async': False,
+        'synchronized': False,
+        'cache_file': "light_cache.json",
+        'metrics_port': None,
+        'record_file': None,
+        'trace_file': None,
+        'probe_interval': 10.0,
+    }
+    flags = {'-c': ('cache_file', str), '-l': ('log_file', str),
+             '-m': ('metrics_port', int), '-p': ('probe_interval', float),
+             '-r': ('record_file', str), '-t': ('timer_file', str),
+             '-T': ('trace_file', str), '-w': ('workers', int)}
+    switches = {'-a': 'use_async', '-q': 'quiet', '-s': 'synchronized',
+                '-S': 'by_subnet'}
+    arguments = sys.argv[1:]
+    while arguments:
+        arg = arguments.pop(0)
+        if arg == '-h':
+            usage(0)
+        elif arg in switches:
+            settings[switches[arg]] = True
+        elif arg in flags:
+            key, parse = flags[arg]
+            try:
+                settings[key] = parse(arguments.pop(0))
+            except Exception:
+                logger.error(f"Failed to parse {arg}")
+                usage(1)
+        else:
+            usage(1)
+    if settings['workers'] < 1:
+        logger.error("Need at least one worker")
+        usage(1)
+    return settings
+
+
+def main():
+    """Run the supervisor."""
+    settings = parse_args()
+    if settings['quiet']:
+        logging.disable()
+    formatter = logging.Formatter(
+        '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s')
+    for handler in (logging.FileHandler(settings['log_file']), logging.StreamHandler()):
+        handler.setFormatter(formatter)
+        logging.getLogger().addHandler(handler)
+
+    metrics_server = None
+    if settings['metrics_port'] is not None:
+        metrics_server = MetricsServer(port=settings['metrics_port'])
+        metrics_server.start()
+
+    timer_file = settings['timer_file']
+    timer_cache = TimerCache()
+    timers, _, _, _ = timer_cache.reload(timer_file)
+    scheduler = Scheduler(timers)
+    watcher = FileWatcher(timer_file, on_change=scheduler.wake)
+    watcher.start()
+    options = {key: settings[key] for key in (
+        'quiet', 'use_async', 'synchronized', 'cache_file', 'metrics_port',
+        'record_file', 'trace_file', 'probe_interval')}
+    supervisor = ShardSupervisor(settings['workers'], options, settings['by_subnet'])
+    supervisor.start()
+    try:
+        while True:
+            if not timers:
+                raise ValueError("Timer list is empty")
+            for fire_time, timer in scheduler.wait():
+                sent = supervisor.fire(fire_time, timer)
+                logger.info("\t%s - Sent to %d of %d shards",
+                            timer.get_activation_time(), sent, supervisor.num_workers)
+            if watcher.has_changed():
+                logger.info("Checking for timers.")
+                timers, added, removed, kept = timer_cache.reload(timer_file)
+                scheduler.remove(removed)
+                scheduler.add(added)
+                logger.info("Timers added: %d, removed: %d, kept: %d",
+                            len(added), len(removed), len(kept))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
+        supervisor.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+
+
+if __name__ == "__main__":
+    main()
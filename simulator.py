@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Elgato light strips.
+
+Serves /elgato/lights, /elgato/accessory-info and /elgato/lights/settings
+for any number of simulated lights, each on its own localhost port, from a
+single asyncio event loop. Every response can be delayed (latency plus
+jitter), answered with an error, or dropped, so Room can be benchmarked
+and tested without real hardware.
+
+    python3 simulator.py -n 100 -l 5 -j 2 -f 0.01
+"""
+import asyncio
+import copy
+import json
+import logging
+import random
+import socket
+import sys
+import threading
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+           503: "Service Unavailable"}
+# fields that only belong to a scene, dropped when the light is set to a color
+SCENE_FIELDS = ('id', 'name', 'scene', 'numberOfSceneElements')
+
+
+def usage(status):
+    """Output a help statement for the program."""
+    print("""
+Elgato Light Simulator
+    USAGE python3 simulator.py [FLAGS]
+
+    -d DROP_RATE    share of requests whose connection is dropped
+    -f FAIL_RATE    share of requests answered with 503
+    -h              display this message
+    -j JITTER_MS    random extra latency, up to this many milliseconds
+    -l LATENCY_MS   latency added to every response
+    -n NUM_LIGHTS   number of lights to simulate
+    -p BASE_PORT    first port to listen on (default: any free port)
+    -z              advertise the lights over zeroconf
+
+    The listening ports are printed as a JSON list once the lights are up.
+    """)
+    sys.exit(status)
+
+
+class SimulatedLight:
+    """State of one simulated light strip."""
+
+    def __init__(self, index: int):
+        """Init the light with a plain color."""
+        self.index = index
+        self.info = {
+            'productName': 'Elgato Light Strip',
+            'hardwareBoardType': 70,
+            'firmwareBuildNumber': 219,
+            'firmwareVersion': '1.0.4',
+            'serialNumber': f'SIM{index:05d}',
+            'displayName': f'Simulated Light {index}',
+            'features': ['lights'],
+        }
+        self.settings = {
+            'powerOnBehavior': 1,
+            'powerOnBrightness': 20,
+            'powerOnHue': 40.0,
+            'powerOnSaturation': 20.0,
+            'switchOnDurationMs': 150,
+            'switchOffDurationMs': 400,
+            'colorChangeDurationMs': 150,
+        }
+        self.state = {'on': 1, 'hue': 40.0, 'saturation': 20.0, 'brightness': 20}
+
+    def lights(self) -> dict:
+        """Return the light data the way the light reports it."""
+        return {'numberOfLights': 1, 'lights': [copy.deepcopy(self.state)]}
+
+    def handle(self, method: str, path: str, body: bytes) -> tuple:
+        """Return (status, payload) for a request."""
+        try:
+            new_data = json.loads(body) if body else None
+        except ValueError:
+            return (400, {'error': 'invalid json'})
+        if path == '/elgato/lights':
+            if method == 'GET':
+                return (200, self.lights())
+            if method == 'PUT':
+                try:
+                    self.update(new_data['lights'][0])
+                except (KeyError, IndexError, TypeError):
+                    return (400, {'error': 'invalid light data'})
+                return (200, self.lights())
+        elif path == '/elgato/accessory-info':
+            if method == 'GET':
+                return (200, self.info)
+            if method == 'PUT' and isinstance(new_data, dict):
+                self.info.update(new_data)
+                return (200, self.info)
+        elif path == '/elgato/lights/settings':
+            if method == 'GET':
+                return (200, self.settings)
+            if method == 'PUT' and isinstance(new_data, dict):
+                self.settings.update(new_data)
+                return (200, self.settings)
+        return (404, {'error': 'not found'})
+
+    def update(self, light: dict):
+        """Apply the fields of a put request."""
+        if any(field in light for field in SCENE_FIELDS):
+            # a scene replaces whatever the light was doing
+            state = {'on': self.state.get('on', 1)}
+            state.update(light)
+            self.state = state
+        else:
+            for field in SCENE_FIELDS:
+                self.state.pop(field, None)
+            self.state.update(light)
+
+
+class Simulator:
+    """Many simulated lights served from one event loop."""
+
+    def __init__(self,
+                 num_lights: int = 1,
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 failure_rate: float = 0.0,
+                 drop_rate: float = 0.0,
+                 host: str = '127.0.0.1',
+                 base_port: int = 0,
+                 seed=None):
+        """
+        Init the simulator, nothing listens until start is called.
+
+            latency: seconds added to every response
+            jitter: up to this many seconds added on top of the latency
+            failure_rate: share of requests answered with a 503
+            drop_rate: share of requests whose connection is closed
+            without an answer
+            base_port: lights listen on base_port, base_port + 1, ...
+            or on any free port when 0
+        """
+        self.log = logging.getLogger(__name__)
+        self.lights = [SimulatedLight(index) for index in range(num_lights)]
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.host = host
+        self.base_port = base_port
+        self.random = random.Random(seed)
+        self.servers = []
+        self.ports = []
+        # tasks serving open keep-alive connections, cancelled on stop
+        self.connections = set()
+        self.loop = None
+        self.thread = None
+        self.zeroconf = None
+        self.requests = 0
+        self.failures = 0
+        self.drops = 0
+
+    async def start(self):
+        """Start listening, one port per light."""
+        for index, light in enumerate(self.lights):
+            port = self.base_port + index if self.base_port else 0
+            server = await asyncio.start_server(
+                lambda reader, writer, light=light: self.serve(light, reader, writer),
+                self.host, port)
+            self.servers.append(server)
+            self.ports.append(server.sockets[0].getsockname()[1])
+        self.log.info(f"Simulating {len(self.lights)} lights on {self.host}")
+
+    async def stop(self):
+        """Stop listening."""
+        for server in self.servers:
+            server.close()
+        connections = list(self.connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+
+    async def serve(self, light: SimulatedLight, reader, writer):
+        """Answer requests on a keep-alive connection."""
+        self.connections.add(asyncio.current_task())
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode().partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(
+                    int(headers.get('content-length', 0)))
+                self.requests += 1
+                delay = self.latency + self.random.uniform(0, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if self.random.random() < self.drop_rate:
+                    self.drops += 1
+                    break
+                if self.random.random() < self.failure_rate:
+                    self.failures += 1
+                    status, payload = (503, {'error': 'simulated failure'})
+                else:
+                    status, payload = light.handle(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError,
+                asyncio.CancelledError):
+            # cancelled by stop, the connection just closes
+            pass
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+    def start_in_thread(self):
+        """Run the simulator on a background event loop, returns once it listens."""
+        started = threading.Event()
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.stop())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name="simulator", daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop_thread(self):
+        """Stop a simulator started with start_in_thread."""
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+
+    def service_infos(self, service_type='_elg._tcp.local.') -> list:
+        """Return a (name, zeroconf.ServiceInfo) for every light, as discovery would."""
+        try:
+            from zeroconf import ServiceInfo
+        except ImportError:
+            raise ImportError("zeroconf is required for service_infos, "
+                              "install it with `pip install zeroconf`")
+        services = []
+        for light, port in zip(self.lights, self.ports):
+            name = f"{light.info['serialNumber']}.{service_type}"
+            services.append((name, ServiceInfo(
+                service_type, name,
+                addresses=[socket.inet_aton(self.host)],
+                port=port,
+                server=f"{light.info['serialNumber'].lower()}.local.")))
+        return services
+
+    def advertise(self, service_type='_elg._tcp.local.'):
+        """Register every light over zeroconf so Room.setup can find them."""
+        from zeroconf import Zeroconf
+        self.zeroconf = Zeroconf()
+        for _, info in self.service_infos(service_type):
+            self.zeroconf.register_service(info)
+
+    def stats(self) -> dict:
+        """Return the request counters."""
+        return {'requests': self.requests,
+                'failures': self.failures,
+                'drops': self.drops}
+
+
+def parse_args() -> tuple:
+    """Return (simulator settings, whether to advertise the lights)."""
+    settings = {'num_lights': 1, 'latency': 0.0, 'jitter': 0.0,
+                'failure_rate': 0.0, 'drop_rate': 0.0, 'base_port': 0}
+    advertise = False
+    flags = {'-n': ('num_lights', int), '-l': ('latency', float),
+             '-j': ('jitter', float), '-f': ('failure_rate', float),
+             '-d': ('drop_rate', float), '-p': ('base_port', int)}
+    arguments = sys.argv[1:]
+    while arguments:
+        arg = arguments.pop(0)
+        if arg == '-h':
+            usage(0)
+        elif arg == '-z':
+            advertise = True
+        elif arg in flags:
+            key, parse = flags[arg]
+            try:
+                settings[key] = parse(arguments.pop(0))
+            except Exception:
+                print(f"Failed to parse {arg}")
+                usage(1)
+        else:
+            usage(1)
+    # latencies are given in milliseconds
+    settings['latency'] /= 1000
+    settings['jitter'] /= 1000
+    return settings, advertise
+
+
+def main():
+    """Run the simulator until interrupted."""
+    settings, advertise = parse_args()
+    simulator = Simulator(**settings)
+
+    async def run():
+        await simulator.start()
+        if advertise:
+            simulator.advertise()
+        print(json.dumps(simulator.ports), flush=True)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 #! usr/bin/python3
 """Timer class."""
 
-from datetime import datetime
-# TODO: fill in bitmasks
+import calendar
+import functools
+from datetime import date, datetime, timedelta
 MONTH_LENGTH = {
     "january": 31,
     "feburary": 28,
@@ -22,31 +23,50 @@ WEEKDAYS = {
     "monday", "tuesday", "wednesday", "thursday",
     "friday", "saturday", "sunday"
 }
+# same order as datetime.weekday()
+DAYS_OF_THE_WEEK = ("monday", "tuesday", "wednesday", "thursday",
+                    "friday", "saturday", "sunday")
 
+MONTH_ORDER = ("january", "feburary", "march", "april", "may", "june",
+               "july", "august", "september", "october", "november",
+               "december")
+LEAP_MONTH_ORDER = ("january", "feburary-leap", "march", "april", "may",
+                    "june", "july", "august", "september", "october",
+                    "november", "december")
+
+# masks are laid out with january 1st as the most significant bit,
+# so day `d` (zero-indexed) of a year is bit `year_length - 1 - d`
+# every mask is cached, timers sharing a symbol share the same int
+
+# years of compiled masks a timer keeps
+MASK_CACHE_YEARS = 32
+
+
+def month_offsets(leap: bool = False) -> tuple:
+    """Return (month, first day of the month, month length) for every month."""
+    offsets = []
+    first_day = 0
+    for month in LEAP_MONTH_ORDER if leap else MONTH_ORDER:
+        offsets.append((month, first_day, MONTH_LENGTH[month]))
+        first_day += MONTH_LENGTH[month]
+    return tuple(offsets)
+
+
+@functools.lru_cache(maxsize=None)
 def generate_month_mask(
                         active_month: str, leap: bool = False) -> int:
     """Generate a bitmask for a given month."""
-    month_order = ("january", "feburary", "march", "april", "may", "june",
-                   "july", "august", "september", "october", "november",
-                   "december")
-    if leap:
-        month_order = ("january", "feburary-leap", "march", "april", "may",
-                       "june", "july", "august", "september", "october",
-                       "november", "december")
     assert active_month in MONTH_LENGTH, f"Invalid Month: {active_month}"
-    mask = ''
-    for month in month_order:
-        # see if there is a string method that fills these in more efficiently
-        if month in active_month:
-            # add the month filled in with 1s
-            mask += "".join("1" for _ in range(MONTH_LENGTH[month]))
-        else:
-            # add the month filled in with 0s
-            mask += "".join("0" for _ in range(MONTH_LENGTH[month]))
-    # return the int that represents the mask
-    return int(mask, 2)
+    year_length = 366 if leap else 365
+    # "feburary" and "feburary-leap" are the same month
+    active_month = active_month.split('-')[0]
+    for month, first_day, length in month_offsets(leap):
+        if month.split('-')[0] == active_month:
+            return ((1 << length) - 1) << (year_length - first_day - length)
+    return 0
 
 
+@functools.lru_cache(maxsize=None)
 def generate_weekday_mask(active_day: str,
                           days_of_the_week: tuple = (
                               "monday", "tuesday", "wednesday", "thursday",
@@ -56,128 +76,113 @@ def generate_weekday_mask(active_day: str,
                           ) -> int:
     """Generate int mask for a specific day of the week."""
     assert active_day in days_of_the_week, f"Invalid Day: {active_day}"
-    mask = ''
-    days = 0
-    shift = False
+    week_length = len(days_of_the_week)
     # Account for years that do not start on the first day of the week
-    # by inserting a partial week to the beginning of
-    for day in days_of_the_week:
-        if day == start_day:
-            shift = True
-        if shift:
-            mask += '1' if day in active_day else '0'
-            days += 1
-
-    while days < year_length:
-        for day in days_of_the_week:
-            mask += '1' if day in active_day else '0'
-            days += 1
-            if days >= year_length:
-                break
-
-    assert len(mask) == year_length, f"Invalid mask length, len: {len(mask)}"
-    return int(mask, 2)
-
-
+    start = days_of_the_week.index(start_day) if start_day in days_of_the_week else 0
+    first_day = (days_of_the_week.index(active_day) - start) % week_length
+    if first_day >= year_length:
+        return 0
+    # one bit every week, from first_day down to the end of the year
+    top_bit = year_length - 1 - first_day
+    num_days = top_bit // week_length + 1
+    every_week = ((1 << (week_length * num_days)) - 1) // ((1 << week_length) - 1)
+    return every_week << (top_bit % week_length)
+
+
+@functools.lru_cache(maxsize=None)
 def generate_date_mask(date: int, leap: bool = False) -> int:
     """Generate a mask of a date for every month that has it."""
-    month_order = ("january", "feburary", "march", "april", "may", "june",
-                   "july", "august", "september", "october", "november",
-                   "december")
-    if leap:
-        month_order = ("january", "feburary-leap", "march", "april", "may",
-                       "june", "july", "august", "september", "october",
-                       "november", "december")
     assert 0 < date and date < 32, f"Invalid date: {date}"
-    mask = ''
-    # adjust date for zero-indexed months
-    date -= 1
-    for month in month_order:
-        # see if there is a string method that fills these in more efficiently
-        mask += "".join(
-            "1" if d == date else "0" for d in range(MONTH_LENGTH[month]))
-
-    # return the int that represents the mask
-    return int(mask, 2)
-
-
-def sub_symbols(rules,
-                leap: bool = False,
-                year_length: int = 365,
-                year_start: str = "monday",
-                days_of_the_week: tuple = (
-                    "monday", "tuesday", "wednesday", "thursday",
-                    "friday", "saturday", "sunday"),
-                ) -> list:
-    """Change months/days/weekdays to the corresponding bitmask."""
-    for index, rule in enumerate(rules):
-        try:
-            rule = int(rule)
-        except Exception:
-            # if it isnt an int then it is fine, we just want to convert dates to ints
-            pass
+    year_length = 366 if leap else 365
+    mask = 0
+    for _, first_day, length in month_offsets(leap):
+        if date <= length:
+            mask |= 1 << (year_length - first_day - date)
+    return mask
 
-        if rule in days_of_the_week:
-            rules[index] = generate_weekday_mask(rule,
-                                                 year_length = year_length,
-                                                 days_of_the_week=days_of_the_week)
-        elif rule in MONTH_LENGTH:
-            rules[index] = generate_month_mask(rule, leap=leap)
 
-        elif rule is int:
-            rules[index] = generate_date_mask(rule, leap=leap)
+def year_info(year: int) -> tuple:
+    """Return (leap, year length, weekday of january 1st) for a year."""
+    leap = calendar.isleap(year)
+    return (leap, 366 if leap else 365, DAYS_OF_THE_WEEK[date(year, 1, 1).weekday()])
 
 
-def parse_rules(rules: list,
-                allowed_symbols: list = ["(", ")", "|", "-", "&"]
-                ) -> list:
+def compile_rule_tree(node, year: int) -> int:
     """
-    Parse the rules of a timer.
+    Compile a tree from parse_rules.parser into a day-of-year bitmask.
 
-    PROBLEM: calendar does not start on same day, each month is a different length, etc
+    The most significant bit is january 1st, the same layout as the
+    generate_*_mask functions.
+    Concatenation is a bit and, `|` is a bit or (see parse_rules),
+    the parser calls these nodes "or" and "and" respectively.
+    Symbols that do not select days (hours, minutes, epsilon) match every day.
+    """
+    leap, year_length, start_day = year_info(year)
+
+    def compile_node(node) -> int:
+        if node.operation == 'weekday':
+            return generate_weekday_mask(
+                node.parameters[0],
+                days_of_the_week=DAYS_OF_THE_WEEK,
+                year_length=year_length,
+                start_day=start_day)
+        if node.operation == 'month':
+            return generate_month_mask(node.parameters[0], leap=leap)
+        if node.operation == 'date':
+            return generate_date_mask(int(node.parameters[0]), leap=leap)
+        if node.operation == 'or':
+            mask = (1 << year_length) - 1
+            for parameter in node.parameters:
+                mask &= compile_node(parameter)
+            return mask
+        if node.operation == 'and':
+            mask = 0
+            for parameter in node.parameters:
+                mask |= compile_node(parameter)
+            return mask
+        return (1 << year_length) - 1
+
+    return compile_node(node)
+
+
+def parse_rules(rules: list):
+    """
+    Parse the rules of a timer.
 
-    this method is recursive
+    Returns the tree built by parse_rules.parser,
+    or None if there are no rules (the timer is active every day)
+    Raises ValueError if the rules can not be parsed
+    """
+    # parse_rules imports from this module, so import it lazily
+    from parse_rules import parser
+    rules = [rule for rule in rules if rule]
+    if not rules:
+        return None
+    try:
+        return parser(rules)
+    except (AssertionError, ValueError, IndexError) as e:
+        raise ValueError(f"Failed to parse rules {' '.join(rules)}: {e}")
+
+
+def parse_year_range(year_range: str) -> tuple:
+    """
+    Parse `YYYY`, `YYYY-YYYY`, `YYYY-` or `-YYYY` into (first, last).
 
-    replace this with theory implementation found in parse_rules.py
+    Either end is None when it is open, an empty range means every year.
+    Raises ValueError if the range can not be parsed
     """
-    if len(rules) <= 1:
-        return rules[0]
-    next_token = rules.pop(0)
-    # deal with parens
-    if next_token == '(':
-        # pop until you reach a close paren and feed that entire thing into
-        # a separate parse_rules loop
-        # PROBLEM: deal with nested parens
-        subrules = []
-        subdepth = 0
-        subtoken = rules.pop(0)
-        while subtoken != ")" and subdepth == 0:
-            if subtoken == "(":
-                subdepth += 1
-            elif subtoken == ")":
-                subdepth -= 1
-
-            # add current subtoken to subrules
-            if subtoken != ")" and subdepth == 0:
-                subrules.append(subtoken)
-            # pop next subtoken
-            subtoken = rules.pop(0)
-
-        # send the subrules off to a new `parse_rules` instance
-        new_token = parse_rules(subrules)
-        assert len(new_token) == 1, f"Subparser failed to parse to single value. Returned array: {new_token}"
-        new_token = new_token[0]
-        assert new_token is int, f"Token is not an int: {new_token}"
-        # push the generated token to the front of the rule list
-        rules.insert(0, new_token)
-
-    assert next_token is int, f"Invalid next token: {next_token}"
-    # peek the token after the current one
-    # to make sure it is a valid item
-    # aka it has to be in allowed_symbols
-    assert rules[0] in allowed_symbols, f"invalid symbol token: {rules[0]}"
-
-    return parse_rules(rules, allowed_symbols)
+    year_range = year_range.strip() if year_range else ""
+    if not year_range:
+        return (None, None)
+    first, separator, last = year_range.partition('-')
+    try:
+        first = int(first) if first.strip() else None
+        last = int(last) if last.strip() else None
+    except ValueError:
+        raise ValueError(f"Failed to parse year range: {year_range}")
+    if not separator:
+        last = first
+    return (first, last)
 
 
 class Timer:
@@ -189,8 +194,14 @@ class Timer:
                  time,
                  active_lights,
                  transition_scene,
-                 end_scene):
-        """Init the timer."""
+                 end_scene,
+                 compiled_transition=None):
+        """
+        Init the timer.
+
+            compiled_transition: the transition and end scene compiled into
+            request bodies (lightStripLib.CompiledTransition)
+        """
         # TODO: add assert statements to make sure everything
         # is the correct type
 
@@ -200,7 +211,54 @@ class Timer:
         self.activation_time = time
         self.transition_scene = transition_scene
         self.end_scene = end_scene
+        self.compiled_transition = compiled_transition
         self.activated = False
+        self.first_year, self.last_year = parse_year_range(year_range)
+        # parsed once, compiled into a mask once per year
+        self.rule_tree = parse_rules(list(rules))
+        # year -> mask, next_fire_time looks up to 28 years ahead
+        self.masks = dict()
+        # symbols like d40 parse fine but can not be compiled,
+        # reject them here rather than when the scheduler needs the mask
+        try:
+            self.year_mask(self.first_year if self.first_year is not None
+                           else date.today().year)
+        except (AssertionError, ValueError) as e:
+            raise ValueError(f"Failed to compile rules {' '.join(rules)}: {e}")
+
+    def in_year_range(self, year: int) -> bool:
+        """Return True if the timer can run in `year`."""
+        if self.first_year is not None and year < self.first_year:
+            return False
+        if self.last_year is not None and year > self.last_year:
+            return False
+        return True
+
+    def expired(self, year: int) -> bool:
+        """Return True if the timer will never run again after `year`."""
+        return self.last_year is not None and year > self.last_year
+
+    def year_mask(self, year: int) -> int:
+        """Return the day-of-year activation mask, built once per year."""
+        mask = self.masks.get(year)
+        if mask is None:
+            if not self.in_year_range(year):
+                mask = 0
+            elif self.rule_tree is None:
+                mask = (1 << year_info(year)[1]) - 1
+            else:
+                mask = compile_rule_tree(self.rule_tree, year)
+            if len(self.masks) >= MASK_CACHE_YEARS:
+                # drop the year cached first
+                del self.masks[next(iter(self.masks))]
+            self.masks[year] = mask
+        return mask
+
+    def is_active(self, day: date) -> bool:
+        """Return True if the timer runs on `day`."""
+        year_length = year_info(day.year)[1]
+        day_of_year = day.timetuple().tm_yday - 1
+        return bool(self.year_mask(day.year) >> (year_length - 1 - day_of_year) & 1)
 
     def check_timer(self):
         """
@@ -209,11 +267,43 @@ class Timer:
         Returns Boolean if timer hit, returns None if timer was not activated
         TODO: make a better return system for this
         """
-        weekday, month, year, time = tuple(
-            datetime.now().strftime('%w-%m-%y-%H%M').split('-'))
-        time = int(time)
-        # TODO: write check for rules
-        return time == self.activation_time  # and not self.activated
+        now = datetime.now()
+        time = int(now.strftime('%H%M'))
+        return time == self.activation_time and self.is_active(now.date())
+
+    def next_fire_time(self, after: datetime):
+        """
+        Return the first time after `after` that the timer fires.
+
+        Returns None if the activation time could not be parsed
+        or the timer never fires again
+        """
+        if not isinstance(self.activation_time, int):
+            return None
+        hour, minute = divmod(self.activation_time, 100)
+        if hour > 23 or minute > 59:
+            return None
+        fire_time = after.replace(
+            hour=hour, minute=minute, second=0, microsecond=0)
+        if fire_time <= after:
+            fire_time += timedelta(days=1)
+        # weekday and date rules line up again after 28 years
+        for year in range(fire_time.year, fire_time.year + 28):
+            if self.expired(year):
+                return None
+            mask = self.year_mask(year)
+            year_length = year_info(year)[1]
+            first_day = 0
+            if year == fire_time.year:
+                first_day = fire_time.timetuple().tm_yday - 1
+            # keep only the days from first_day onwards,
+            # the highest remaining bit is the earliest active day
+            mask &= (1 << (year_length - first_day)) - 1
+            if mask:
+                day = date(year, 1, 1) + timedelta(
+                    days=year_length - mask.bit_length())
+                return datetime.combine(day, fire_time.time())
+        return None
 
     def get_transition(self):
         """Return transition scene and end scene."""
@@ -0,0 +1,191 @@
+"""
+Optional tracing spans for timer firings and light requests.
+
+Wrap work in `with tracing.span("name", key=value):` and, once tracing is
+started, every span is written with its parent, duration and attributes
+either as JSONL or in the Chrome trace format (open it in chrome://tracing
+or https://ui.perfetto.dev) to see a whole transition on a timeline.
+While tracing is off span returns a shared object that does nothing, so
+the spans can stay in hot paths.
+"""
+
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import weakref
+from time import monotonic_ns, time_ns
+
+# the span the current thread or asyncio task is in
+CURRENT_SPAN = contextvars.ContextVar('current_span', default=None)
+
+
+class NoopSpan:
+    """Stand-in returned by span while tracing is off."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def set(self, **attrs):
+        """Ignore the attributes."""
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    """One timed piece of work."""
+
+    __slots__ = ('tracer', 'name', 'attrs', 'span_id', 'parent_id',
+                 'start', 'token')
+
+    def __init__(self, tracer, name: str, attrs: dict):
+        """Init the span, the clock starts when it is entered."""
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.span_id = next(tracer.ids)
+        self.parent_id = None
+        self.start = None
+        self.token = None
+
+    def __enter__(self):
+        parent = CURRENT_SPAN.get()
+        if parent is not None:
+            self.parent_id = parent.span_id
+        self.token = CURRENT_SPAN.set(self)
+        self.start = monotonic_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = monotonic_ns()
+        CURRENT_SPAN.reset(self.token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.export(self, end)
+        return False
+
+    def set(self, **attrs):
+        """Add attributes, e.g. a status that is only known at the end."""
+        self.attrs.update(attrs)
+
+
+class Tracer:
+    """Write finished spans to a file as they end."""
+
+    def __init__(self, filename: str, trace_format: str = None):
+        """
+        Open `filename`.
+
+            trace_format: 'chrome' or 'jsonl',
+            by default files ending in .json are written as Chrome traces
+        """
+        self.log = logging.getLogger(__name__)
+        if trace_format is None:
+            trace_format = 'chrome' if filename.endswith('.json') else 'jsonl'
+        if trace_format not in ('chrome', 'jsonl'):
+            raise ValueError(f"Unknown trace format: {trace_format}")
+        self.filename = filename
+        self.trace_format = trace_format
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # monotonic start of the trace, and the wall clock at that moment
+        self.origin = monotonic_ns()
+        self.wall_origin = time_ns()
+        # asyncio tasks share a thread, give each one its own timeline row
+        self.task_ids = weakref.WeakKeyDictionary()
+        self.file = open(filename, 'w', buffering=1)
+        self.exported = 0
+        if trace_format == 'chrome':
+            # the closing bracket is optional in the array format,
+            # so events can be streamed and a crash still leaves a valid trace
+            self.file.write("[")
+
+    def thread_id(self) -> int:
+        """Return the timeline row for the current thread or asyncio task."""
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            return threading.get_native_id()
+        with self.lock:
+            if task not in self.task_ids:
+                self.task_ids[task] = 1_000_000 + len(self.task_ids)
+            return self.task_ids[task]
+
+    def export(self, span: Span, end: int):
+        """Write a finished span."""
+        start_us = (span.start - self.origin) / 1000
+        duration_us = (end - span.start) / 1000
+        if self.trace_format == 'chrome':
+            args = dict(span.attrs)
+            args['span_id'] = span.span_id
+            args['parent_id'] = span.parent_id
+            event = {'name': span.name, 'ph': 'X', 'ts': start_us,
+                     'dur': duration_us, 'pid': self.pid,
+                     'tid': self.thread_id(), 'args': args}
+            line = json.dumps(event, default=str)
+        else:
+            event = {'name': span.name, 'span_id': span.span_id,
+                     'parent_id': span.parent_id,
+                     'start': (self.wall_origin + span.start - self.origin) / 1e9,
+                     'duration': duration_us / 1e6,
+                     'thread': self.thread_id(), 'attrs': span.attrs}
+            line = json.dumps(event, default=str) + "\n"
+        with self.lock:
+            if self.file is not None:
+                if self.trace_format == 'chrome':
+                    line = (",\n" if self.exported else "\n") + line
+                self.file.write(line)
+                self.exported += 1
+
+    def close(self):
+        """Close the file."""
+        with self.lock:
+            if self.file is not None:
+                if self.trace_format == 'chrome':
+                    self.file.write("\n]\n")
+                self.file.close()
+                self.file = None
+
+
+TRACER = None
+
+
+def start_tracing(filename: str, trace_format: str = None) -> Tracer:
+    """Start writing spans to `filename`, see Tracer."""
+    global TRACER
+    stop_tracing()
+    TRACER = Tracer(filename, trace_format)
+    TRACER.log.info(f"Tracing to {filename} ({TRACER.trace_format})")
+    return TRACER
+
+
+def stop_tracing():
+    """Stop tracing and close the file."""
+    global TRACER
+    tracer, TRACER = TRACER, None
+    if tracer is not None:
+        tracer.close()
+
+
+def enabled() -> bool:
+    """Return True while tracing is on."""
+    return TRACER is not None
+
+
+def span(name: str, **attrs):
+    """Return a span to use as a context manager, a no-op while tracing is off."""
+    if TRACER is None:
+        return NOOP_SPAN
+    return Span(TRACER, name, attrs)
@@ -0,0 +1,96 @@
+"""
+Long-lived worker pool shared by everything a room fans out to its lights.
+
+Creating a ThreadPoolExecutor for every scene or transition means paying
+for thread startup on each call, and two timers firing together would each
+start their own pool. A single bounded pool is reused instead, so
+concurrent work shares the same workers.
+"""
+
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+
+class WorkerPool:
+    """Bounded thread pool that keeps track of how busy it is."""
+
+    def __init__(self, max_workers: int = 16, name: str = "room-worker"):
+        """
+        Init the pool, the threads are started on demand.
+
+            max_workers: most tasks that run at the same time,
+            anything beyond that waits in the queue
+        """
+        self.log = logging.getLogger(__name__)
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.busy_time = 0.0
+        self.start_time = monotonic()
+
+    def run(self, fn, *args):
+        """Run a task on a worker and account for it."""
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+        start = monotonic()
+        try:
+            return fn(*args)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+                self.busy_time += monotonic() - start
+
+    def submit(self, fn, *args):
+        """
+        Queue `fn(*args)`, returns a Future.
+
+        The task runs in a copy of the caller's context, so tracing spans
+        opened on a worker nest under the span that submitted it.
+        """
+        with self.lock:
+            self.queued += 1
+        context = contextvars.copy_context()
+        try:
+            return self.executor.submit(context.run, self.run, fn, *args)
+        except RuntimeError:
+            # the pool has been shut down
+            with self.lock:
+                self.queued -= 1
+            raise
+
+    def map(self, fn, items) -> list:
+        """Run `fn` on every item, returns the results in the same order."""
+        futures = [self.submit(fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    def stats(self) -> dict:
+        """
+        Return queue depth and utilization.
+
+        utilization is the share of worker time spent on tasks since the
+        pool was created
+        """
+        with self.lock:
+            elapsed = monotonic() - self.start_time
+            return {
+                'workers': self.max_workers,
+                'queued': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'utilization': round(
+                    self.busy_time / (elapsed * self.max_workers), 4)
+                if elapsed > 0 else 0.0,
+            }
+
+    def shutdown(self, wait: bool = True):
+        """Stop the workers, queued tasks still run if `wait` is set."""
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)